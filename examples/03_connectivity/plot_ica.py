@@ -29,7 +29,9 @@ from sammba.registration import TemplateRegistrator
 registrator = TemplateRegistrator(brain_volume=400, caching=True,
                                   template=dorr.t2, use_rats_tool=False,
                                   template_brain_mask=dorr_masks.brain,
-                                  registration_kind='affine')
+                                  registration_kind='affine',
+                                  template_cache_dir=os.path.join('ica',
+                                                                  'template'))
 
 registered_funcs = []
 for anat, func in zip(retest.anat, retest.func):
@@ -7,6 +7,7 @@ from nilearn import image
 from nipype.caching import Memory
 from nipype.utils.filemanip import fname_presuffix
 from nipype.interfaces import afni
+from .threads import thread_environ
 
 
 def _get_afni_output_type(in_file):
@@ -94,9 +95,9 @@ def fix_obliquity(to_fix_filename, reference_filename, caching=False,
 
     if environ is None:
         if caching:
-            environ = {}
+            environ = thread_environ()
         else:
-            environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+            environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
 
     if caching:
         copy = memory.cache(afni.Copy)
@@ -3,6 +3,7 @@ import nibabel
 from nipype.caching import Memory
 from nipype.interfaces import afni, ants, fsl
 from nipype.utils.filemanip import fname_presuffix
+from ..threads import thread_environ
 
 def _compute_n4_max_shrink(in_file):
     """ Computes the maximal allowed shrink factor for ANTS
@@ -31,7 +32,7 @@ def ants_n4(in_file, write_dir=None, caching=False,
         write_dir = os.path.dirname(in_file)
 
     if environ is None:
-        environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+        environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
 
     if caching:
         memory = Memory(write_dir)
@@ -54,10 +55,17 @@ def ants_n4(in_file, write_dir=None, caching=False,
     else:                                     
         output_image = unbiased_file
 
+    # nipype runs ANTs programs with a single thread by default
+    n4_kwargs = {}
+    if 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS' in environ:
+        n4_kwargs['num_threads'] = int(
+            environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'])
+
     out_bias_correct = bias_correct(
         input_image=in_file,
         shrink_factor=_compute_n4_max_shrink(in_file),
-        output_image=output_image)
+        output_image=output_image,
+        **n4_kwargs)
 
     if copy_geometry:
         out_copy = copy(
@@ -77,7 +85,7 @@ def afni_unifize(in_file, write_dir=None, out_file=None, caching=False,
         write_dir = os.path.dirname(in_file)
 
     if environ is None:
-        environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+        environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
 
     if caching:
         memory = Memory(write_dir)
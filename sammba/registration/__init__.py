@@ -1,9 +1,13 @@
 from .func import fmri_sessions_to_template, coregister_fmri_session
-from .struct import anats_to_common, anats_to_template, anat_to_template
+from .struct import (anats_to_common, add_anats_to_common,
+                     merge_anats_to_common, hierarchical_anats_to_common,
+                     anats_to_template, anat_to_template)
 from .fmri_session import FMRISession
 from .template_registrator import TemplateRegistrator
 from .coregistrator import Coregistrator
 
-__all__ = ['fmri_sessions_to_template', 'anats_to_common', 'FMRISession',
+__all__ = ['fmri_sessions_to_template', 'anats_to_common',
+           'add_anats_to_common', 'merge_anats_to_common',
+           'hierarchical_anats_to_common', 'FMRISession',
            'anats_to_template', 'anat_to_template', 'coregister_fmri_session',
            'TemplateRegistrator', 'Coregistrator']
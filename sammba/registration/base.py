@@ -1,12 +1,52 @@
 import os
-import fnmatch
-import glob
+import json
+import hashlib
+import numpy as np
 import nibabel
+from scipy import sparse
+from joblib import Parallel, delayed
 from nipype.caching import Memory
-from nipype.interfaces import afni, fsl
+from nipype.interfaces import afni
 from nipype.utils.filemanip import fname_presuffix
-from nipype.interfaces.fsl.base import Info
 from ..orientation import fix_obliquity
+from ..threads import thread_environ
+from . import interfaces, resampling
+from .template_cache import TemplateCache, file_checksum
+from .transforms import compose_chain
+
+
+# Resampled grids computed by this process, by target checksum and voxel size
+_RESAMPLED_GRIDS = {}
+
+
+def _resample_grid(target_filename, voxel_size, write_dir, resample,
+                   suffix='_resampled', grid_cache_dir=None, **kwargs):
+    """ Resamples the target to the given voxel size, to serve as master
+    grid. The result is reused within the process for the same target
+    content and voxel size and, if `grid_cache_dir` is given, across
+    processes.
+    """
+    def compute(out_dir):
+        out_resample = resample(in_file=target_filename,
+                                voxel_size=voxel_size,
+                                out_file=fname_presuffix(target_filename,
+                                                         suffix=suffix,
+                                                         newpath=out_dir),
+                                **kwargs)
+        return out_resample.outputs.out_file
+
+    voxel_size = tuple(float(size) for size in voxel_size)
+    if grid_cache_dir is not None:
+        return TemplateCache(grid_cache_dir).get(
+            'resampled_grid', target_filename, compute,
+            voxel_size=voxel_size)
+
+    key = (file_checksum(target_filename), voxel_size)
+    if key not in _RESAMPLED_GRIDS or not os.path.isfile(
+            _RESAMPLED_GRIDS[key]):
+        _RESAMPLED_GRIDS[key] = compute(write_dir)
+
+    return _RESAMPLED_GRIDS[key]
 
 
 def _delete_orientation(in_file, write_dir=None, min_zoom=.1, caching=False,
@@ -56,7 +96,7 @@ def _rigid_body_register(moving_head_file, reference_head_file,
         write_dir = os.path.dirname(moving_head_file)
 
     if environ is None:
-        environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+        environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
 
     if caching:
         memory = Memory(write_dir)
@@ -124,7 +164,7 @@ def _warp(to_warp_file, reference_file, write_dir=None, caching=False,
         write_dir = os.path.dirname(to_warp_file)
 
     if environ is None:
-        environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+        environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
 
     if caching:
         memory = Memory(write_dir)
@@ -173,7 +213,7 @@ def _reorient(unifized_anat_file, unbiased_modality_file, write_dir,
         transform from anat to modality.
     """
     if environ is None:
-        environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+        environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
 
     if caching:
         memory = Memory(write_dir)
@@ -228,7 +268,7 @@ def _rigid_body_register_and_reorient(unifized_anat_file,
         transform from anat to modality.
     """
     if environ is None:
-        environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+        environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
 
     if caching:
         memory = Memory(write_dir)
@@ -272,105 +312,171 @@ def _rigid_body_register_and_reorient(unifized_anat_file,
     return registered_anat_oblique_file, transform_file
 
 
-def _get_fsl_slice_output_files(out_base_name, output_type):
-    ext = Info.output_type_to_ext(output_type)
-    suffix = '_slice_*' + ext
-    exact_pattern = '_slice_[0-9][0-9][0-9][0-9]' + ext
-    fname_template = os.path.abspath(
-        out_base_name + suffix)
-    fname_exact_pattern = os.path.abspath(
-        out_base_name + exact_pattern)
-    sliced_files = fnmatch.filter(sorted(glob.glob(fname_template)),
-                                  fname_exact_pattern)
-    return sliced_files
+def _map_slices(function, n_jobs, *slices_args):
+    """ Applies a per-slice function to each set of arguments and returns
+    the outputs in the slices order. Slices are processed in parallel
+    processes if n_jobs is not 1.
+    """
+    if n_jobs == 1:
+        return [function(*args) for args in zip(*slices_args)]
+
+    return Parallel(n_jobs=n_jobs)(
+        delayed(function)(*args)
+        for args in zip(*slices_args))
+
+
+def _check_backend(backend):
+    if backend not in ['afni', 'native']:
+        raise ValueError("Backend must be one of ['afni', 'native'], you "
+                         "entered {0}".format(backend))
+
+
+def _save_perslice_warps(warp_files, grid_file, out_file):
+    """ Stores the per-slice warps in a single NIfTI image, stacked along the
+    third dimension on the grid of the first slice. Slices without warp are
+    filled with zeros and the warped slices are listed in a header
+    extension. The image is not compressed, to be memory mapped.
+    """
+    grid_img = nibabel.load(grid_file)
+    data = np.zeros(grid_img.shape[:2] + (len(warp_files), 1, 3),
+                    dtype=np.float32)
+    for n, warp_file in enumerate(warp_files):
+        if warp_file is not None:
+            data[:, :, n:n + 1] = np.asarray(
+                nibabel.load(warp_file).dataobj).reshape(
+                    grid_img.shape[:2] + (1, 1, 3))
+
+    # The header of the warps is kept, with the grid of the first slice
+    warped_slices = [n for (n, warp_file) in enumerate(warp_files)
+                     if warp_file is not None]
+    if warped_slices:
+        header = nibabel.load(warp_files[warped_slices[0]]).header.copy()
+    else:
+        header = grid_img.header.copy()
+        header.set_intent('vector')
+    header.set_data_dtype(np.float32)
+    header.set_qform(grid_img.affine, code=int(header['qform_code']))
+    header.set_sform(grid_img.affine, code=int(header['sform_code']))
+    img = nibabel.Nifti1Image(data, None, header)
+    img.header.extensions.append(nibabel.nifti1.Nifti1Extension(
+        interfaces._COMMENT_CODE,
+        json.dumps({'warped_slices': warped_slices}).encode()))
+    img.to_filename(out_file)
+    return out_file
+
+
+def _split_perslice_warps(warps_file, write_dir):
+    """ Writes the warps of each slice stored by `_save_perslice_warps` to
+    separate files within `write_dir`, for AFNI. The stacked warps are read
+    once, memory mapped. Returns None for the slices without warp.
+    """
+    img = nibabel.load(warps_file)
+    data = np.asanyarray(img.dataobj)
+    warped_slices = interfaces._get_warped_slices(img)
+
+    warp_files = []
+    for n in range(img.shape[2]):
+        if n not in warped_slices:
+            warp_files.append(None)
+            continue
+        affine = img.affine.copy()
+        affine[:3, 3] = img.affine.dot([0, 0, n, 1])[:3]
+        warp_file = fname_presuffix(
+            warps_file, suffix='_slice_{0:04d}.nii.gz'.format(n),
+            newpath=write_dir, use_ext=False)
+        header = img.header.copy()
+        del header.extensions[:]
+        header.set_qform(affine, code=int(img.header['qform_code']))
+        header.set_sform(affine, code=int(img.header['sform_code']))
+        warp_img = nibabel.Nifti1Image(np.array(data[:, :, n:n + 1]), None,
+                                       header)
+        warp_img.to_filename(warp_file)
+        warp_files.append(warp_file)
+
+    return warp_files
 
 
 def _per_slice_qwarp(to_qwarp_file, reference_file,
                      voxel_size_x, voxel_size_y, apply_to_file=None,
                      write_dir=None,
                      caching=False,
-                     verbose=True, terminal_output='allatonce', environ=None):
+                     verbose=True, terminal_output='allatonce', environ=None,
+                     n_jobs=1, resample_volumes=False, backend='afni'):
+    _check_backend(backend)
     if write_dir is None:
-        write_dir = os.path.dirname(to_qwarp_file),
+        write_dir = os.path.dirname(to_qwarp_file)
 
+    # The threads of the given environment are shared by the slices
     if environ is None:
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+    environ = thread_environ(environ, n_jobs=n_jobs, override=True)
 
     if caching:
         memory = Memory(write_dir)
         resample = memory.cache(afni.Resample)
-        slicer = memory.cache(fsl.Slice)
-        warp_apply = memory.cache(afni.NwarpApply)
+        slicer = memory.cache(interfaces.Slice)
         qwarp = memory.cache(afni.Qwarp)
-        merge = memory.cache(fsl.Merge)
-        for step in [resample, slicer, warp_apply, qwarp, merge]:
+        merge = memory.cache(interfaces.Merge)
+        for step in [resample, qwarp]:
             step.interface().set_default_terminal_output(terminal_output)
     else:
         resample = afni.Resample(terminal_output=terminal_output).run
-        slicer = fsl.Slice(terminal_output=terminal_output).run
-        warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
+        slicer = interfaces.Slice().run
         qwarp = afni.Qwarp(terminal_output=terminal_output).run
-        merge = fsl.Merge(terminal_output=terminal_output).run
+        merge = interfaces.Merge().run
 
-    # Slice anatomical image
     reference_img = nibabel.load(reference_file)
     per_slice_dir = os.path.join(write_dir, 'per_slice')
     if not os.path.isdir(per_slice_dir):
         os.makedirs(per_slice_dir)
 
-    out_slicer = slicer(in_file=reference_file,
-                        out_base_name=fname_presuffix(reference_file,
-                                                      newpath=per_slice_dir,
-                                                      use_ext=False))
-    # XXX: workaround for nipype globbing to find slicer outputs
-    # Use out_slicer.outputs.out_files once fixed
-    sliced_reference_files = _get_fsl_slice_output_files(
-        out_slicer.inputs['out_base_name'], out_slicer.inputs['output_type'])
-
-    # Slice mean functional
-    out_slicer = slicer(in_file=to_qwarp_file,
-                        out_base_name=fname_presuffix(to_qwarp_file,
-                                                      newpath=per_slice_dir,
-                                                      use_ext=False))
-    sliced_to_qwarp_files = _get_fsl_slice_output_files(
-        out_slicer.inputs['out_base_name'], out_slicer.inputs['output_type'])
-
-    # Below line is to deal with slices where there is no signal (for example
-    # rostral end of some anatomicals)
+    def slice_volume(in_file):
+        out_slicer = slicer(in_file=in_file,
+                            out_base_name=fname_presuffix(
+                                in_file, newpath=per_slice_dir,
+                                use_ext=False))
+        return out_slicer.outputs.out_files
 
     # The inverse warp frequently fails, Resampling can help it work better
     # XXX why specifically .1 in voxel_size ?
     voxel_size_z = reference_img.header.get_zooms()[2]
-    resampled_sliced_reference_files = []
-    for sliced_reference_file in sliced_reference_files:
-        out_resample = resample(
-            in_file=sliced_reference_file,
-            voxel_size=(voxel_size_x, voxel_size_y, voxel_size_z),
-            out_file=fname_presuffix(sliced_reference_file,
-                                     suffix='_resampled'),
-            environ=environ)
-        resampled_sliced_reference_files.append(out_resample.outputs.out_file)
 
-    resampled_sliced_to_qwarp_files = []
-    for sliced_to_qwarp_file in sliced_to_qwarp_files:
+    def resample_to_qwarp_grid(in_file, out_dir=None):
         out_resample = resample(
-            in_file=sliced_to_qwarp_file,
+            in_file=in_file,
             voxel_size=(voxel_size_x, voxel_size_y, voxel_size_z),
-            out_file=fname_presuffix(sliced_to_qwarp_file,
-                                     suffix='_resampled'),
+            out_file=fname_presuffix(in_file, suffix='_resampled',
+                                     newpath=out_dir),
             environ=environ)
-        resampled_sliced_to_qwarp_files.append(
-            out_resample.outputs.out_file)
+        return out_resample.outputs.out_file
+
+    if resample_volumes:
+        # Resample the anatomical and the mean functional once, the
+        # in-plane grid of each slice being unchanged, and slice them
+        sliced_reference_files = []
+        sliced_to_qwarp_files = []
+        resampled_volumes = [
+            resample_to_qwarp_grid(in_file, out_dir=per_slice_dir)
+            for in_file in [reference_file, to_qwarp_file]]
+        resampled_sliced_reference_files = slice_volume(resampled_volumes[0])
+        resampled_sliced_to_qwarp_files = slice_volume(resampled_volumes[1])
+    else:
+        # Slice the anatomical and the mean functional, and resample each
+        # slice
+        resampled_volumes = []
+        sliced_reference_files = slice_volume(reference_file)
+        sliced_to_qwarp_files = slice_volume(to_qwarp_file)
+        resampled_sliced_files = _map_slices(
+            resample_to_qwarp_grid, n_jobs,
+            sliced_reference_files + sliced_to_qwarp_files)
+        resampled_sliced_reference_files = resampled_sliced_files[
+            :len(sliced_reference_files)]
+        resampled_sliced_to_qwarp_files = resampled_sliced_files[
+            len(sliced_reference_files):]
 
     # single slice non-linear functional to anatomical registration
-    warped_slices = []
-    warp_files = []
-    output_files = []
-    resampled_sliced_to_qwarp_files_to_remove = []
-    for (resampled_sliced_to_qwarp_file,
-         resampled_sliced_reference_file) in zip(
-            resampled_sliced_to_qwarp_files,
-            resampled_sliced_reference_files):
+    def qwarp_slice(resampled_sliced_to_qwarp_file,
+                    resampled_sliced_reference_file):
         warped_slice = fname_presuffix(resampled_sliced_to_qwarp_file,
                                        suffix='_qwarped')
         to_qwarp_data = nibabel.load(resampled_sliced_to_qwarp_file).get_data()
@@ -378,10 +484,8 @@ def _per_slice_qwarp(to_qwarp_file, reference_file,
 
         if to_qwarp_data.max() == 0 or ref_data.max() == 0:
             # deal with slices where there is no signal
-            warped_slices.append(resampled_sliced_to_qwarp_file)
-            warp_files.append(None)
+            return resampled_sliced_to_qwarp_file, None, []
         else:
-            resampled_sliced_to_qwarp_files_to_remove.append(resampled_sliced_to_qwarp_file)
             out_qwarp = qwarp(
                 in_file=resampled_sliced_to_qwarp_file,
                 base_file=resampled_sliced_reference_file,
@@ -399,47 +503,72 @@ def _per_slice_qwarp(to_qwarp_file, reference_file,
                 verb=verbose)
             # XXX fix qwarp bug : out_qwarp.outputs.warped_source extension is
             # +tlrc.HEAD if base_file and in_file are of different extensions
-            warped_slices.append(warped_slice)
-            warp_files.append(out_qwarp.outputs.source_warp)
             # There are files geenrated by the allineate option
-            output_files.extend([
+            return (warped_slice, out_qwarp.outputs.source_warp, [
                 fname_presuffix(out_qwarp.outputs.warped_source,
                                 suffix='_Allin.nii', use_ext=False),
                 fname_presuffix(out_qwarp.outputs.warped_source,
                                 suffix='_Allin.aff12.1D', use_ext=False)])
 
-    # Resample the mean volume back to the initial resolution,
+    qwarp_outputs = _map_slices(qwarp_slice, n_jobs,
+                                resampled_sliced_to_qwarp_files,
+                                resampled_sliced_reference_files)
+    warped_slices = [outputs[0] for outputs in qwarp_outputs]
+    warp_files = [outputs[1] for outputs in qwarp_outputs]
+    output_files = [output_file for outputs in qwarp_outputs
+                    for output_file in outputs[2]]
+    resampled_sliced_to_qwarp_files_to_remove = [
+        resampled_sliced_to_qwarp_file
+        for (resampled_sliced_to_qwarp_file, warp_file) in zip(
+            resampled_sliced_to_qwarp_files, warp_files)
+        if warp_file is not None]
+
+    # Resample the mean volume back to the initial resolution, and fix the
+    # obliquity
     voxel_size = nibabel.load(to_qwarp_file).header.get_zooms()[:3]
-    resampled_warped_slices = []
-    for warped_slice in warped_slices:
+
+    def resample_back_slice(warped_slice, sliced_reference_file):
         out_resample = resample(in_file=warped_slice,
                                 voxel_size=voxel_size,
                                 out_file=fname_presuffix(warped_slice,
                                                          suffix='_resampled'),
                                 environ=environ)
-        resampled_warped_slices.append(out_resample.outputs.out_file)
-
-    # fix the obliquity
-    oblique_resampled_warped_slices = []
-    for (sliced_reference_file, resampled_warped_slice) in zip(
-            sliced_reference_files, resampled_warped_slices):
-        oblique_slice = fix_obliquity(resampled_warped_slice,
-                                      sliced_reference_file,
-                                      verbose=verbose,
-                                      caching=caching,
-                                      caching_dir=per_slice_dir,
-                                      environ=environ)
-        oblique_resampled_warped_slices.append(oblique_slice)
-
-    out_merge_func = merge(
-        in_files=oblique_resampled_warped_slices,
-        dimension='z',
-        merged_file=fname_presuffix(to_qwarp_file, suffix='_perslice',
-                                    newpath=write_dir),
-        environ=environ)
+        return fix_obliquity(out_resample.outputs.out_file,
+                             sliced_reference_file,
+                             verbose=verbose,
+                             caching=caching,
+                             caching_dir=per_slice_dir,
+                             environ=environ)
+
+    merged_file = fname_presuffix(to_qwarp_file, suffix='_perslice',
+                                  newpath=write_dir)
+    if resample_volumes:
+        # Merge the warped slices and resample the merged volume once
+        oblique_resampled_warped_slices = []
+        out_merge_func = merge(
+            in_files=warped_slices,
+            dimension='z',
+            merged_file=fname_presuffix(merged_file, suffix='_qwarped',
+                                        newpath=per_slice_dir),
+            environ=environ)
+        resampled_volumes.append(out_merge_func.outputs.merged_file)
+        out_resample = resample(in_file=out_merge_func.outputs.merged_file,
+                                voxel_size=voxel_size,
+                                out_file=merged_file,
+                                environ=environ)
+        merged_file = out_resample.outputs.out_file
+    else:
+        oblique_resampled_warped_slices = _map_slices(
+            resample_back_slice, n_jobs, warped_slices, sliced_reference_files)
+        out_merge_func = merge(
+            in_files=oblique_resampled_warped_slices,
+            dimension='z',
+            merged_file=merged_file,
+            environ=environ)
+        merged_file = out_merge_func.outputs.merged_file
 
     # Fix the obliquity
-    oblique_merged = fix_obliquity(out_merge_func.outputs.merged_file,
+    oblique_merged = fix_obliquity(merged_file,
                                    reference_file,
                                    verbose=verbose,
                                    caching=caching, caching_dir=per_slice_dir,
@@ -450,134 +579,107 @@ def _per_slice_qwarp(to_qwarp_file, reference_file,
                         sliced_to_qwarp_files +
                         resampled_sliced_reference_files +
                         resampled_sliced_to_qwarp_files_to_remove +
-                        warped_slices + oblique_resampled_warped_slices)
+                        warped_slices + oblique_resampled_warped_slices +
+                        resampled_volumes)
 
-    # Apply the precomputed warp slice by slice
-    if apply_to_file is not None:
-        # slice functional
-        out_slicer = slicer(in_file=apply_to_file,
-                            out_base_name=fname_presuffix(apply_to_file,
-                                                          newpath=per_slice_dir,
-                                                          use_ext=False))
-        sliced_apply_to_files = _get_fsl_slice_output_files(
-                out_slicer.inputs['out_base_name'],
-                out_slicer.inputs['output_type'])
-        warped_apply_to_slices = []
-        sliced_apply_to_files_to_remove = []
-        for (sliced_apply_to_file, warp_file) in zip(
-                sliced_apply_to_files, warp_files):
-            if warp_file is None:
-                warped_apply_to_slices.append(sliced_apply_to_file)
-            else:
-                sliced_apply_to_files_to_remove.append(sliced_apply_to_file)
-                out_warp_apply = warp_apply(in_file=sliced_apply_to_file,
-                                            master=sliced_apply_to_file,
-                                            warp=warp_file,
-                                            out_file=fname_presuffix(
-                                                sliced_apply_to_file,
-                                                suffix='_qwarped'),
-                                            environ=environ)
-                warped_apply_to_slices.append(out_warp_apply.outputs.out_file)
-
-        # Fix the obliquity
-        oblique_warped_apply_to_slices = []
-        for (sliced_apply_to_file, warped_apply_to_slice) in zip(
-                sliced_apply_to_files, warped_apply_to_slices):
-            oblique_slice = fix_obliquity(warped_apply_to_slice,
-                                          sliced_apply_to_file,
-                                          verbose=verbose,
-                                          caching=caching,
-                                          caching_dir=per_slice_dir,
-                                          environ=environ)
-            oblique_warped_apply_to_slices.append(oblique_slice)
-
-        # Finally, merge all slices !
-        out_merge_apply_to = merge(
-            in_files=oblique_warped_apply_to_slices,
-            dimension='z',
-            merged_file=fname_presuffix(apply_to_file, suffix='_perslice',
-                                        newpath=write_dir),
-            environ=environ)
-
-        # Fix the obliquity
-        merged_apply_to_file = fix_obliquity(
-            out_merge_apply_to.outputs.merged_file, apply_to_file,
-            verbose=verbose, caching=caching,
-            caching_dir=per_slice_dir, environ=environ)
-
-        # Update the outputs
-        output_files.extend(sliced_apply_to_files_to_remove +
-                            oblique_warped_apply_to_slices)
-    else:
-        merged_apply_to_file = None
+    # Gather the warps in a single file
+    warps_file = _save_perslice_warps(
+        warp_files, resampled_sliced_reference_files[0],
+        fname_presuffix(to_qwarp_file, suffix='_perslice_warps.nii',
+                        newpath=write_dir, use_ext=False))
+    output_files.extend([warp_file for warp_file in warp_files
+                         if warp_file is not None])
 
     if not caching:
         for out_file in output_files:
             os.remove(out_file)
 
-    return (oblique_merged, warp_files,
+    # Apply the precomputed warp slice by slice
+    if apply_to_file is not None:
+        merged_apply_to_file = _apply_perslice_warp(
+            apply_to_file, warps_file, voxel_size_x, voxel_size_y,
+            write_dir=write_dir, caching=caching, verbose=verbose,
+            terminal_output=terminal_output, environ=environ, n_jobs=n_jobs,
+            backend=backend)
+    else:
+        merged_apply_to_file = None
+
+    return (oblique_merged, warps_file,
             merged_apply_to_file)
 
 
-def _apply_perslice_warp(apply_to_file, warp_files,
+def _apply_perslice_warp(apply_to_file, warps_file,
                          voxel_size_x, voxel_size_y,
                          write_dir=None,
                          caching=False,
                          verbose=True, terminal_output='allatonce',
-                         environ=None):
+                         environ=None, n_jobs=1, backend='afni'):
 
     # Apply the precomputed warp slice by slice
+    _check_backend(backend)
     if write_dir is None:
-        write_dir = os.path.dirname(apply_to_file),
+        write_dir = os.path.dirname(apply_to_file)
 
+    # The threads of the given environment are shared by the slices
     if environ is None:
         environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+    environ = thread_environ(environ, n_jobs=n_jobs, override=True)
 
     if caching:
         memory = Memory(write_dir)
-        resample = memory.cache(afni.Resample)
-        slicer = memory.cache(fsl.Slice)
+        slicer = memory.cache(interfaces.Slice)
         warp_apply = memory.cache(afni.NwarpApply)
-        qwarp = memory.cache(afni.Qwarp)
-        merge = memory.cache(fsl.Merge)
-        for step in [resample, slicer, warp_apply, qwarp, merge]:
-            step.interface().set_default_terminal_output(terminal_output)
+        per_slice_warp_apply = memory.cache(interfaces.PerSliceNwarpApply)
+        merge = memory.cache(interfaces.Merge)
+        warp_apply.interface().set_default_terminal_output(terminal_output)
     else:
-        resample = afni.Resample(terminal_output=terminal_output).run
-        slicer = fsl.Slice(terminal_output=terminal_output).run
+        slicer = interfaces.Slice().run
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
-        qwarp = afni.Qwarp(terminal_output=terminal_output).run
-        merge = fsl.Merge(terminal_output=terminal_output).run
+        per_slice_warp_apply = interfaces.PerSliceNwarpApply().run
+        merge = interfaces.Merge().run
 
     apply_to_img = nibabel.load(apply_to_file)
     n_slices = apply_to_img.header.get_data_shape()[2]
 
-    if len(warp_files) != n_slices:
-        raise ValueError('number of warp files {0} does not match number of '
-                         'slices {1}'.format(len(warp_files), n_slices))
-    # Slice anatomical image
-    output_files = []
+    n_warps = nibabel.load(warps_file).shape[2]
+    if n_warps != n_slices:
+        raise ValueError('number of warps {0} does not match number of '
+                         'slices {1}'.format(n_warps, n_slices))
     per_slice_dir = os.path.join(write_dir, 'per_slice')
     if not os.path.isdir(per_slice_dir):
         os.makedirs(per_slice_dir)
 
+    merged_file = fname_presuffix(apply_to_file, suffix='_perslice',
+                                  newpath=write_dir)
+    if backend == 'native':
+        # Warp all the slices at once, in-process
+        out_warp_apply = per_slice_warp_apply(in_file=apply_to_file,
+                                              warps=warps_file,
+                                              out_file=merged_file)
+        return fix_obliquity(out_warp_apply.outputs.out_file, apply_to_file,
+                             verbose=verbose, caching=caching,
+                             caching_dir=per_slice_dir, environ=environ)
+
+    warp_files = _split_perslice_warps(warps_file, per_slice_dir)
+    output_files = [warp_file for warp_file in warp_files
+                    if warp_file is not None]
+
     # slice functional
-    sliced_apply_to_files = []
     out_slicer = slicer(in_file=apply_to_file,
                         out_base_name=fname_presuffix(apply_to_file,
                                                       newpath=per_slice_dir,
                                                       use_ext=False))
-    sliced_apply_to_files = _get_fsl_slice_output_files(
-        out_slicer.inputs['out_base_name'], out_slicer.inputs['output_type'])
+    sliced_apply_to_files = out_slicer.outputs.out_files
 
-    warped_apply_to_slices = []
-    sliced_apply_to_files_to_remove = []
-    for (sliced_apply_to_file, warp_file) in zip(
-            sliced_apply_to_files, warp_files):
+    sliced_apply_to_files_to_remove = [
+        sliced_apply_to_file for (sliced_apply_to_file, warp_file) in zip(
+            sliced_apply_to_files, warp_files) if warp_file is not None]
+
+    # Warp each slice and fix its obliquity
+    def warp_apply_slice(sliced_apply_to_file, warp_file):
         if warp_file is None:
-            warped_apply_to_slices.append(sliced_apply_to_file)
+            warped_apply_to_slice = sliced_apply_to_file
         else:
-            sliced_apply_to_files_to_remove.append(sliced_apply_to_file)
             out_warp_apply = warp_apply(in_file=sliced_apply_to_file,
                                         master=sliced_apply_to_file,
                                         warp=warp_file,
@@ -585,26 +687,23 @@ def _apply_perslice_warp(apply_to_file, warp_files,
                                             sliced_apply_to_file,
                                             suffix='_qwarped'),
                                         environ=environ)
-            warped_apply_to_slices.append(out_warp_apply.outputs.out_file)
+            warped_apply_to_slice = out_warp_apply.outputs.out_file
 
-    # Fix the obliquity
-    oblique_warped_apply_to_slices = []
-    for (sliced_apply_to_file, warped_apply_to_slice) in zip(
-            sliced_apply_to_files, warped_apply_to_slices):
-        oblique_slice = fix_obliquity(warped_apply_to_slice,
-                                      sliced_apply_to_file,
-                                      verbose=verbose,
-                                      caching=caching,
-                                      caching_dir=per_slice_dir,
-                                      environ=environ)
-        oblique_warped_apply_to_slices.append(oblique_slice)
+        return fix_obliquity(warped_apply_to_slice,
+                             sliced_apply_to_file,
+                             verbose=verbose,
+                             caching=caching,
+                             caching_dir=per_slice_dir,
+                             environ=environ)
+
+    oblique_warped_apply_to_slices = _map_slices(
+        warp_apply_slice, n_jobs, sliced_apply_to_files, warp_files)
 
     # Finally, merge all slices !
     out_merge_apply_to = merge(
         in_files=oblique_warped_apply_to_slices,
         dimension='z',
-        merged_file=fname_presuffix(apply_to_file, suffix='_perslice',
-                                    newpath=write_dir),
+        merged_file=merged_file,
         environ=environ)
 
     # Fix the obliquity
@@ -629,7 +728,7 @@ def _transform_to_template(to_register_filename, template_filename, write_dir,
                            anat_to_template_oned_filename,
                            anat_to_template_warp_filename,
                            voxel_size=None,
-                           caching=False, verbose=True):
+                           caching=False, verbose=True, grid_cache_dir=None):
     """ Applies successive transforms to a given image to put it in
     template space.
 
@@ -660,8 +759,12 @@ def _transform_to_template(to_register_filename, template_filename, write_dir,
     verbose : bool, optional
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
+
+    grid_cache_dir : str or None, optional
+        Directory where the template resampled to `voxel_size` is cached
+        across processes. Within a process, it is computed once in any case.
     """
-    environ = {}
+    environ = thread_environ()
     if verbose:
         terminal_output = 'allatonce'
     else:
@@ -678,33 +781,78 @@ def _transform_to_template(to_register_filename, template_filename, write_dir,
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         environ['AFNI_DECONFLICT'] = 'OVERWRITE'
 
-    current_dir = os.getcwd()
-    os.chdir(write_dir)
     normalized_filename = fname_presuffix(to_register_filename,
                                           suffix='_normalized')
 
     if voxel_size is None:
         resampled_template_filename = template_filename
     else:
-        out_resample = resample(in_file=template_filename,
-                                voxel_size=voxel_size,
-                                outputtype='NIFTI_GZ')
-        resampled_template_filename = out_resample.outputs.out_file
-
-    transforms = [anat_to_template_warp_filename,
-                  anat_to_template_oned_filename,
-                  func_to_anat_oned_filename]
+        resampled_template_filename = _resample_grid(
+            template_filename, voxel_size, write_dir, resample,
+            suffix='_resample', grid_cache_dir=grid_cache_dir,
+            outputtype='NIFTI_GZ', environ=environ)
+
+    transforms = compose_chain(
+        [anat_to_template_warp_filename, anat_to_template_oned_filename,
+         func_to_anat_oned_filename],
+        fname_presuffix(normalized_filename, suffix='', use_ext=False),
+        source_file=to_register_filename, target_file=template_filename)
     warp = "'"
     warp += " ".join(transforms)
     warp += "'"
     _ = warp_apply(in_file=to_register_filename,
                    master=resampled_template_filename,
                    warp=warp,
-                   out_file=normalized_filename)
-    os.chdir(current_dir)
+                   out_file=normalized_filename,
+                   environ=environ)
     return normalized_filename
 
 
+def _get_resampling_operator(to_register_filename, target_filename,
+                              resampled_target_filename, write_dir,
+                              transforms, transforms_kind='nonlinear',
+                              voxel_size=None, inverse=False,
+                              mask_filename=None, caching=False,
+                              verbose=True, grid_cache_dir=None):
+    """ Returns the file of the sparse matrix resampling the volumes of the
+    source grid through the transforms. The matrix is computed once for the
+    source grid, the resampled target, the transforms and the mask, by
+    transforming an image of the source voxel coordinates with linear
+    interpolation, and then reused from `write_dir`.
+    """
+    img = nibabel.load(to_register_filename)
+    key = [img.shape[:3], img.affine.tolist(),
+           file_checksum(resampled_target_filename),
+           [file_checksum(transform) for transform in transforms],
+           transforms_kind, inverse]
+    if mask_filename is not None:
+        key.append(file_checksum(mask_filename))
+    key = hashlib.sha1(json.dumps(key).encode()).hexdigest()
+    operator_filename = os.path.join(write_dir,
+                                     'resampling_operator_{0}.npz'.format(key))
+    if os.path.isfile(operator_filename):
+        return operator_filename
+
+    coordinates_filename = resampling.write_coordinates(
+        to_register_filename,
+        os.path.join(write_dir, 'coordinates_{0}.nii.gz'.format(key)))
+    transformed_coordinates_filename = _apply_transforms(
+        coordinates_filename, target_filename, write_dir, transforms,
+        transforms_kind=transforms_kind, interpolation='linear',
+        voxel_size=voxel_size, inverse=inverse, caching=caching,
+        verbose=verbose, grid_cache_dir=grid_cache_dir)
+    operator = resampling.compute_operator(transformed_coordinates_filename,
+                                           img.shape[:3],
+                                           mask_file=mask_filename)
+    sparse.save_npz(operator_filename, operator)
+    if not caching:
+        for filename in set([coordinates_filename,
+                             transformed_coordinates_filename]):
+            os.remove(filename)
+
+    return operator_filename
+
+
 def _apply_transforms(to_register_filename, target_filename,
                       write_dir,
                       transforms,
@@ -712,7 +860,8 @@ def _apply_transforms(to_register_filename, target_filename,
                       transforms_kind='nonlinear',
                       interpolation=None,
                       voxel_size=None, inverse=False,
-                      caching=False, verbose=True):
+                      caching=False, verbose=True, grid_cache_dir=None,
+                      resampling_operator=False, mask_filename=None):
     """ Applies successive transforms to a given image to put it in
     template space.
 
@@ -750,8 +899,22 @@ def _apply_transforms(to_register_filename, target_filename,
     verbose : bool, optional
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
+
+    grid_cache_dir : str or None, optional
+        Directory where the target resampled to `voxel_size` is cached
+        across processes. Within a process, it is computed once in any case.
+
+    resampling_operator : bool, optional
+        If True, the transforms are applied as a sparse matrix of linear
+        interpolation, computed once for the source grid and stored in
+        `write_dir`, and all the volumes are resampled with a matrix product.
+        `interpolation` is then ignored.
+
+    mask_filename : str or None, optional
+        Mask of the target voxels computed with the resampling operator.
+        Voxels outside the mask are set to zero.
     """
-    environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+    environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
     if verbose:
         terminal_output = 'allatonce'
     else:
@@ -759,15 +922,13 @@ def _apply_transforms(to_register_filename, target_filename,
 
     if caching:
         memory = Memory(write_dir)
-        catmatvec = memory.cache(afni.CatMatvec)
         allineate = memory.cache(afni.Allineate)
         warp_apply = memory.cache(afni.NwarpApply)
-        resample = memory.cache(afni.Resample)        
+        resample = memory.cache(afni.Resample)
         for step in [resample, allineate, warp_apply]:
             step.interface().set_default_terminal_output(terminal_output)
     else:
         resample = afni.Resample(terminal_output=terminal_output).run
-        catmatvec = afni.CatMatvec().run
         allineate = afni.Allineate(terminal_output=terminal_output).run
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
 
@@ -782,30 +943,30 @@ def _apply_transforms(to_register_filename, target_filename,
     if voxel_size is None:
         resampled_target_filename = target_filename
     else:
-        out_resample = resample(in_file=target_filename,
-                                voxel_size=voxel_size,
-                                out_file=fname_presuffix(target_filename,
-                                                         suffix='_resampled',
-                                                         newpath=write_dir),
-                                environ=environ)
-        resampled_target_filename = out_resample.outputs.out_file
-    if transforms_kind is not 'nonlinear':
-        affine_transform_filename = fname_presuffix(transformed_filename,
-                                                    suffix='.aff12.1D',
-                                                    use_ext=False)
-        out_catmatvec = catmatvec(in_file=[(transform, 'ONELINE')
-                                           for transform in transforms],
-                                  oneline=True,
-                                  out_file=affine_transform_filename,
-                                  environ=environ)
+        resampled_target_filename = _resample_grid(
+            target_filename, voxel_size, write_dir, resample,
+            grid_cache_dir=grid_cache_dir, environ=environ)
+    if resampling_operator:
+        operator_filename = _get_resampling_operator(
+            to_register_filename, target_filename, resampled_target_filename,
+            write_dir, transforms, transforms_kind=transforms_kind,
+            voxel_size=voxel_size, inverse=inverse,
+            mask_filename=mask_filename, caching=caching, verbose=verbose,
+            grid_cache_dir=grid_cache_dir)
+        resampling.apply_operator(operator_filename, to_register_filename,
+                                  resampled_target_filename,
+                                  transformed_filename)
+    # Successive affine transforms are composed in-process
+    elif transforms_kind != 'nonlinear':
         if inverse:
-            affine_transform_filename = fname_presuffix(transformed_filename,
-                                                        suffix='_INV.aff12.1D',
-                                                        use_ext=False)
-            _ = catmatvec(in_file=[(out_catmatvec.outputs.out_file, 'I')],
-                          oneline=True,
-                          out_file=affine_transform_filename,
-                          environ=environ)
+            suffix = '_INV'
+        else:
+            suffix = ''
+        affine_transform_filename, = compose_chain(
+            transforms, fname_presuffix(transformed_filename, suffix=suffix,
+                                        use_ext=False),
+            source_file=to_register_filename, target_file=target_filename,
+            inverse=inverse)
         if interpolation is None:
             _ = allineate(
                 in_file=to_register_filename,
@@ -822,6 +983,10 @@ def _apply_transforms(to_register_filename, target_filename,
                 out_file=transformed_filename,
                 environ=environ)
     else:
+        transforms = compose_chain(
+            transforms, fname_presuffix(transformed_filename, suffix='',
+                                        use_ext=False),
+            source_file=to_register_filename, target_file=target_filename)
         warp = "'"
         warp += " ".join(transforms)
         warp += "'"
@@ -847,4 +1012,95 @@ def _apply_transforms(to_register_filename, target_filename,
                                          verbose=verbose, caching=caching,
                                          caching_dir=write_dir,
                                          environ=environ)
-    return transformed_filename
\ No newline at end of file
+    return transformed_filename
+
+
+def _get_crop_box(mask_files, margin):
+    """ Returns the slices of the smallest box containing the nonzero voxels
+    of all the masks, extended by `margin` mm and clipped to the grid.
+    The masks must share the same grid.
+    """
+    mask_img = nibabel.load(mask_files[0])
+    shape = mask_img.shape[:3]
+    in_mask = np.zeros(shape, dtype=bool)
+    for mask_file in mask_files:
+        mask_data = np.asarray(nibabel.load(mask_file).dataobj)
+        in_mask |= mask_data.reshape(shape + (-1,)).any(axis=-1)
+
+    if not in_mask.any():
+        raise ValueError('Can not crop to empty masks {0}'.format(mask_files))
+
+    zooms = np.sqrt(np.sum(mask_img.affine[:3, :3] ** 2, axis=0))
+    margins = np.ceil(margin / zooms).astype(int)
+    box = []
+    for axis in range(3):
+        other_axes = tuple(n for n in range(3) if n != axis)
+        indices = np.where(in_mask.any(axis=other_axes))[0]
+        box.append(slice(int(max(indices[0] - margins[axis], 0)),
+                         int(min(indices[-1] + 1 + margins[axis],
+                                 shape[axis]))))
+
+    return tuple(box)
+
+
+def _crop(in_file, box, write_dir=None, suffix='_cropped'):
+    """ Crops the image to the box, keeping the world coordinates of the
+    voxels.
+    """
+    img = nibabel.load(in_file)
+    start = np.array([axis_slice.start for axis_slice in box])
+    affine = img.affine.copy()
+    affine[:3, 3] = img.affine[:3, :3].dot(start) + img.affine[:3, 3]
+    cropped_img = nibabel.Nifti1Image(np.asarray(img.dataobj)[box], affine,
+                                      header=img.header)
+    cropped_file = fname_presuffix(in_file, suffix=suffix, newpath=write_dir)
+    cropped_img.to_filename(cropped_file)
+    return cropped_file
+
+
+def _pad_linear(data, pad_width):
+    """ Pads the first axes of the array by extrapolating linearly from
+    the two outer slices.
+    """
+    for axis, (before, after) in enumerate(pad_width):
+        if data.shape[axis] > 1:
+            start_slope = np.take(data, [0], axis) - np.take(data, [1], axis)
+            end_slope = np.take(data, [-1], axis) - np.take(data, [-2], axis)
+        else:
+            start_slope = end_slope = np.zeros_like(np.take(data, [0], axis))
+        steps_shape = [1] * data.ndim
+        steps_shape[axis] = -1
+        before_steps = np.arange(before, 0, -1).reshape(steps_shape)
+        after_steps = np.arange(1, after + 1).reshape(steps_shape)
+        data = np.concatenate(
+            [np.take(data, [0], axis) + start_slope * before_steps, data,
+             np.take(data, [-1], axis) + end_slope * after_steps], axis=axis)
+
+    return data
+
+
+def _uncrop_warp(warp_file, reference_file, write_dir=None,
+                 suffix='_uncropped'):
+    """ Extends a warp computed on a crop of the reference grid to the whole
+    reference grid. Displacements are linearly extrapolated outside the
+    cropped box, which is exact for the affine part of the warp, as with
+    the -expad option of AFNI 3dNwarpCat.
+    """
+    warp_img = nibabel.load(warp_file)
+    reference_img = nibabel.load(reference_file)
+    start = np.linalg.solve(reference_img.affine, warp_img.affine[:, 3])[:3]
+    start = np.round(start).astype(int)
+    stop = start + np.array(warp_img.shape[:3])
+    if np.any(start < 0) or np.any(stop > reference_img.shape[:3]):
+        raise ValueError('Warp {0} is not defined on a crop of {1}'.format(
+            warp_file, reference_file))
+
+    pad_width = list(zip(start, np.array(reference_img.shape[:3]) - stop))
+    warp_data = _pad_linear(np.asarray(warp_img.dataobj, dtype=np.float32),
+                            pad_width)
+    uncropped_img = nibabel.Nifti1Image(warp_data, reference_img.affine,
+                                        header=warp_img.header)
+    uncropped_file = fname_presuffix(warp_file, suffix=suffix,
+                                     newpath=write_dir)
+    uncropped_img.to_filename(uncropped_file)
+    return uncropped_file
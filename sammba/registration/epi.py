@@ -2,6 +2,7 @@ import warnings
 from sklearn.utils import Bunch
 from nilearn._utils.exceptions import VisibleDeprecationWarning
 from .base import _reorient, _rigid_body_register_and_reorient, _per_slice_qwarp
+from ..threads import thread_environ
 
 
 def _coregister_epi(
@@ -18,6 +19,9 @@ def _coregister_epi(
     voxel_size_y=0.1,
     caching=False,
     verbose=True,
+    n_jobs=1,
+    resample_volumes=False,
+    backend="afni",
     **environ_kwargs
 ):
     """
@@ -46,6 +50,17 @@ def _coregister_epi(
     verbose : bool, optional
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
+    n_jobs : int, optional
+        Number of slices registered in parallel. -1 means all the CPUs.
+    resample_volumes : bool, optional
+        If True, the volumes are resampled to `voxel_size_x` and
+        `voxel_size_y` once before slicing and back once after merging,
+        instead of slice by slice.
+    backend : one of {'afni', 'native'}, optional
+        Backend of the per-slice warps application to `apply_to_file`.
+        With 'native', all the slices are warped at once in-process, with
+        linear interpolation, instead of running AFNI 3dNwarpApply on each
+        slice.
     environ_kwargs : extra arguments keywords
         Extra arguments keywords, passed to interfaces environ variable.
 
@@ -59,6 +74,9 @@ def _coregister_epi(
                           Path to paths to the coregistered EPI image.
         - `coreg_transform_` : str
                                Path to the transform from anat to EPI.
+        - `coreg_warps_` : str
+                           Path to the per-slice warps, stored in a single
+                           image.
     """
     if prior_rigid_body_registration is not None:
         warn_str = (
@@ -69,7 +87,7 @@ def _coregister_epi(
         warnings.warn(warn_str, VisibleDeprecationWarning, stacklevel=2)
         reorient_only = not (prior_rigid_body_registration)
 
-    environ = {"AFNI_DECONFLICT": "OVERWRITE"}
+    environ = thread_environ({"AFNI_DECONFLICT": "OVERWRITE"})
     for key, value in environ_kwargs.items():
         environ[key] = value
 
@@ -119,7 +137,7 @@ def _coregister_epi(
     #################################################
     # Per-slice non-linear registration EPI -> anat #
     #################################################
-    warped_epi_file, warp_files, warped_apply_to_file = _per_slice_qwarp(
+    warped_epi_file, warps_file, warped_apply_to_file = _per_slice_qwarp(
         unbiased_epi_file,
         registered_anat_oblique_file,
         voxel_size_x,
@@ -130,6 +148,9 @@ def _coregister_epi(
         caching=caching,
         terminal_output=terminal_output,
         environ=environ,
+        n_jobs=n_jobs,
+        resample_volumes=resample_volumes,
+        backend=backend,
     )
 
     return Bunch(
@@ -137,6 +158,6 @@ def _coregister_epi(
         coreg_epi_=warped_epi_file,
         coreg_anat_=registered_anat_oblique_file,
         coreg_transform_=transform_file,
-        coreg_warps_=warp_files,
+        coreg_warps_=warps_file,
     )
 
@@ -10,16 +10,19 @@ from nipype.utils.filemanip import fname_presuffix
 from nilearn._utils.exceptions import VisibleDeprecationWarning
 from sammba import segmentation
 from ..orientation import fix_obliquity
+from ..threads import thread_environ
 from .fmri_session import FMRISession
 from .struct import anats_to_template
-from .base import _rigid_body_register, _warp, _per_slice_qwarp
+from .base import (_rigid_body_register, _warp, _per_slice_qwarp,
+                   _apply_transforms)
+from . import interfaces
 
 
 def _realign(
     func_filename, write_dir, caching=False, terminal_output="allatonce", environ=None
 ):
     if environ is None:
-        environ = {"AFNI_DECONFLICT": "OVERWRITE"}
+        environ = thread_environ({"AFNI_DECONFLICT": "OVERWRITE"})
 
     if caching:
         memory = Memory(write_dir)
@@ -128,7 +131,7 @@ def _slice_time(
     func_file, t_r, write_dir, caching=False, terminal_output="allatonce", environ=None
 ):
     if environ is None:
-        environ = {"AFNI_DECONFLICT": "OVERWRITE"}
+        environ = thread_environ({"AFNI_DECONFLICT": "OVERWRITE"})
 
     if caching:
         memory = Memory(write_dir)
@@ -161,6 +164,8 @@ def coregister(
     voxel_size_y=0.1,
     caching=False,
     verbose=True,
+    n_jobs=1,
+    resample_volumes=False,
     **environ_kwargs
 ):
     """
@@ -192,6 +197,12 @@ def coregister(
     verbose : bool, optional
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
+    n_jobs : int, optional
+        Number of slices registered in parallel. -1 means all the CPUs.
+    resample_volumes : bool, optional
+        If True, the volumes are resampled to `voxel_size_x` and
+        `voxel_size_y` once before slicing and back once after merging,
+        instead of slice by slice.
     environ_kwargs : extra arguments keywords
         Extra arguments keywords, passed to interfaces environ variable.
 
@@ -206,6 +217,9 @@ def coregister(
                           image.
         - `coreg_transform_` : str
                                Path to the transform from anat to func.
+        - `coreg_warps_` : str
+                           Path to the per-slice warps, stored in a single
+                           image.
     Notes
     -----
     If `use_rats_tool` is turned on, RATS tool is used for brain extraction
@@ -221,7 +235,7 @@ def coregister(
         warnings.warn(warn_str, VisibleDeprecationWarning, stacklevel=2)
         reorient_only = not (prior_rigid_body_registration)
 
-    environ = {"AFNI_DECONFLICT": "OVERWRITE"}
+    environ = thread_environ({"AFNI_DECONFLICT": "OVERWRITE"})
     if verbose:
         terminal_output = "allatonce"
     else:
@@ -299,7 +313,7 @@ def coregister(
     ##################################################
     # Per-slice non-linear registration func -> anat #
     ##################################################
-    warped_mean_func_file, warp_files, _ = _per_slice_qwarp(
+    warped_mean_func_file, warps_file, _ = _per_slice_qwarp(
         unbiased_mean_func_file,
         registered_anat_oblique_file,
         voxel_size_x,
@@ -309,6 +323,8 @@ def coregister(
         caching=caching,
         terminal_output=terminal_output,
         environ=environ,
+        n_jobs=n_jobs,
+        resample_volumes=resample_volumes,
     )
 
     # Update the outputs
@@ -320,7 +336,7 @@ def coregister(
         coreg_func_=warped_mean_func_file,
         coreg_anat_=registered_anat_oblique_file,
         coreg_transform_=transform_file,
-        coreg_warps_=warp_files,
+        coreg_warps_=warps_file,
     )
 
 
@@ -412,7 +428,7 @@ def coregister_fmri_session(
     func_filename = session_data.func
     anat_filename = session_data.anat
 
-    environ = {"AFNI_DECONFLICT": "OVERWRITE"}
+    environ = thread_environ({"AFNI_DECONFLICT": "OVERWRITE"})
     for key, value in environ_kwargs.items():
         environ[key] = value
 
@@ -448,10 +464,10 @@ def coregister_fmri_session(
         catmatvec = memory.cache(afni.CatMatvec)
         warp = memory.cache(afni.Warp)
         resample = memory.cache(afni.Resample)
-        slicer = memory.cache(afni.ZCutUp)
+        slicer = memory.cache(interfaces.Slice)
         warp_apply = memory.cache(afni.NwarpApply)
         qwarp = memory.cache(afni.Qwarp)
-        merge = memory.cache(afni.Zcat)
+        merge = memory.cache(interfaces.Merge)
         copy_geom = memory.cache(fsl.CopyGeom)
         overwrite = False
         for step in [
@@ -464,10 +480,8 @@ def coregister_fmri_session(
             calc,
             unifize,
             resample,
-            slicer,
             warp_apply,
             qwarp,
-            merge,
         ]:
             step.interface().set_default_terminal_output(terminal_output)
     else:
@@ -486,18 +500,16 @@ def coregister_fmri_session(
         catmatvec = afni.CatMatvec().run
         warp = afni.Warp().run
         resample = afni.Resample(terminal_output=terminal_output).run
-        slicer = afni.ZCutUp(terminal_output=terminal_output).run
+        slicer = interfaces.Slice().run
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         qwarp = afni.Qwarp(terminal_output=terminal_output).run
-        merge = afni.Zcat(terminal_output=terminal_output).run
+        merge = interfaces.Merge().run
         copy_geom = fsl.CopyGeom(terminal_output=terminal_output).run
         overwrite = True
 
     session_data._check_inputs()
     output_dir = os.path.join(os.path.abspath(write_dir), session_data.animal_id)
     session_data._set_output_dir_(output_dir)
-    current_dir = os.getcwd()
-    os.chdir(output_dir)
     output_files = []
 
     #######################################
@@ -506,6 +518,9 @@ def coregister_fmri_session(
     if slice_timing:
         out_tshift = tshift(
             in_file=func_filename,
+            out_file=fname_presuffix(
+                func_filename, suffix="_tshift", newpath=output_dir
+            ),
             outputtype="NIFTI_GZ",
             tpattern="altplus",
             tr=str(t_r),
@@ -522,12 +537,18 @@ def coregister_fmri_session(
     out_calc_threshold = calc(
         in_file_a=func_filename,
         expr="ispositive(a-{0}) * a".format(out_clip_level.outputs.clip_val),
+        out_file=fname_presuffix(func_filename, suffix="_calc", newpath=output_dir),
         outputtype="NIFTI_GZ",
+        environ=environ,
     )
     thresholded_filename = out_calc_threshold.outputs.out_file
 
     out_volreg = volreg(  # XXX dfile not saved
         in_file=thresholded_filename,
+        out_file=fname_presuffix(thresholded_filename, suffix="_volreg"),
+        md1d_file=fname_presuffix(
+            thresholded_filename, suffix="_md.1D", use_ext=False
+        ),
         outputtype="NIFTI_GZ",
         environ=environ,
         oned_file=fname_presuffix(
@@ -551,7 +572,9 @@ def coregister_fmri_session(
     # removes motion correction info in the header if it were an AFNI file...as
     # it happens it's NIfTI which does not store that so irrelevant!
     out_copy_geom = copy_geom(
-        dest_file=out_allineate.outputs.out_file, in_file=out_volreg.outputs.out_file
+        dest_file=out_allineate.outputs.out_file,
+        in_file=out_volreg.outputs.out_file,
+        environ=environ,
     )
 
     allineated_filename = out_copy_geom.outputs.out_file
@@ -559,6 +582,7 @@ def coregister_fmri_session(
     # Create a (hopefully) nice mean image for use in the registration
     out_tstat = tstat(
         in_file=allineated_filename,
+        out_file=fname_presuffix(allineated_filename, suffix="_tstat"),
         args="-mean",
         outputtype="NIFTI_GZ",
         environ=environ,
@@ -579,12 +603,31 @@ def coregister_fmri_session(
     ###########################################
     # Corret anat and func for intensity bias #
     ###########################################
-    # Correct the functional average for intensities bias
-    out_bias_correct = bias_correct(input_image=out_tstat.outputs.out_file)
+    # Correct the functional average for intensities bias. nipype runs
+    # ANTs programs with a single thread by default
+    n4_kwargs = {}
+    if "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS" in environ:
+        n4_kwargs["num_threads"] = int(
+            environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"])
+    out_bias_correct = bias_correct(
+        input_image=out_tstat.outputs.out_file,
+        output_image=fname_presuffix(
+            out_tstat.outputs.out_file, suffix="_corrected"
+        ),
+        environ=environ,
+        **n4_kwargs
+    )
     unbiased_func_filename = out_bias_correct.outputs.output_image
 
     # Bias correct the antomical image
-    out_unifize = unifize(in_file=anat_filename, outputtype="NIFTI_GZ", environ=environ)
+    out_unifize = unifize(
+        in_file=anat_filename,
+        out_file=fname_presuffix(
+            anat_filename, suffix="_unifized", newpath=output_dir
+        ),
+        outputtype="NIFTI_GZ",
+        environ=environ,
+    )
     unbiased_anat_filename = out_unifize.outputs.out_file
 
     # Update outputs
@@ -598,6 +641,7 @@ def coregister_fmri_session(
         out_clip_level = clip_level(in_file=unbiased_func_filename)
         out_compute_mask_func = compute_mask(
             in_file=unbiased_func_filename,
+            out_file=fname_presuffix(unbiased_func_filename, suffix="_mask"),
             volume_threshold=brain_volume,
             intensity_threshold=int(out_clip_level.outputs.clip_val),
         )
@@ -605,6 +649,7 @@ def coregister_fmri_session(
             in_file_a=unbiased_func_filename,
             in_file_b=out_compute_mask_func.outputs.out_file,
             expr="a*b",
+            out_file=fname_presuffix(unbiased_func_filename, suffix="_calc"),
             outputtype="NIFTI_GZ",
             environ=environ,
         )
@@ -613,6 +658,7 @@ def coregister_fmri_session(
         out_clip_level = clip_level(in_file=unbiased_anat_filename)
         out_compute_mask_anat = compute_mask(
             in_file=unbiased_anat_filename,
+            out_file=fname_presuffix(unbiased_anat_filename, suffix="_mask"),
             volume_threshold=brain_volume,
             intensity_threshold=int(out_clip_level.outputs.clip_val),
         )
@@ -620,6 +666,7 @@ def coregister_fmri_session(
             in_file_a=unbiased_anat_filename,
             in_file_b=out_compute_mask_anat.outputs.out_file,
             expr="a*b",
+            out_file=fname_presuffix(unbiased_anat_filename, suffix="_calc"),
             outputtype="NIFTI_GZ",
             environ=environ,
         )
@@ -655,6 +702,7 @@ def coregister_fmri_session(
             in_file=[(rigid_transform_file, "I")],
             oneline=True,
             out_file=catmatvec_out_file,
+            environ=environ,
         )
         output_files.append(out_catmatvec.outputs.out_file)
         out_allineate = allineate(
@@ -679,6 +727,9 @@ def coregister_fmri_session(
     # making sure they are removed at the end
     out_warp = warp(
         in_file=allineated_anat_filename,
+        out_file=fname_presuffix(
+            allineated_anat_filename, suffix="_warp", newpath=output_dir
+        ),
         oblique_parent=unbiased_func_filename,
         interp="quintic",
         gridset=unbiased_func_filename,
@@ -688,7 +739,8 @@ def coregister_fmri_session(
     )
     registered_anat_filename = out_warp.outputs.out_file
     registered_anat_oblique_filename = fix_obliquity(
-        registered_anat_filename, unbiased_func_filename, verbose=verbose
+        registered_anat_filename, unbiased_func_filename, verbose=verbose,
+        environ=environ
     )
 
     # Concatenate all the anat to func tranforms
@@ -708,12 +760,14 @@ def coregister_fmri_session(
             in_file=[(mat_filename, "ONELINE"), (rigid_transform_file, "ONELINE")],
             oneline=True,
             out_file=transform_filename,
+            environ=environ,
         )
     else:
         _ = catmatvec(
             in_file=[(mat_filename, "ONELINE")],
             oneline=True,
             out_file=transform_filename,
+            environ=environ,
         )
 
     ##################################################
@@ -721,37 +775,32 @@ def coregister_fmri_session(
     ##################################################
     # Slice anatomical image
     anat_img = nibabel.load(registered_anat_oblique_filename)
-    anat_n_slices = anat_img.header.get_data_shape()[2]
+    out_slicer = slicer(
+        in_file=registered_anat_oblique_filename,
+        out_base_name=fname_presuffix(registered_anat_oblique_filename, use_ext=False),
+        environ=environ,
+    )
     sliced_registered_anat_filenames = []
-    for slice_n in range(anat_n_slices):
-        out_slicer = slicer(
-            in_file=registered_anat_oblique_filename,
-            keep="{0} {0}".format(slice_n),
-            out_file=fname_presuffix(
-                registered_anat_oblique_filename, suffix="Sl%d" % slice_n
-            ),
-            environ=environ,
-        )
+    for sliced_filename in out_slicer.outputs.out_files:
         oblique_slice = fix_obliquity(
-            out_slicer.outputs.out_file,
+            sliced_filename,
             registered_anat_oblique_filename,
             verbose=verbose,
+            environ=environ,
         )
         sliced_registered_anat_filenames.append(oblique_slice)
 
     # Slice mean functional
+    out_slicer = slicer(
+        in_file=unbiased_func_filename,
+        out_base_name=fname_presuffix(unbiased_func_filename, use_ext=False),
+        environ=environ,
+    )
     sliced_bias_corrected_filenames = []
-    img = nibabel.load(func_filename)
-    n_slices = img.header.get_data_shape()[2]
-    for slice_n in range(n_slices):
-        out_slicer = slicer(
-            in_file=unbiased_func_filename,
-            keep="{0} {0}".format(slice_n),
-            out_file=fname_presuffix(unbiased_func_filename, suffix="Sl%d" % slice_n),
-            environ=environ,
-        )
+    for sliced_filename in out_slicer.outputs.out_files:
         oblique_slice = fix_obliquity(
-            out_slicer.outputs.out_file, unbiased_func_filename, verbose=verbose
+            sliced_filename, unbiased_func_filename, verbose=verbose,
+            environ=environ
         )
         sliced_bias_corrected_filenames.append(oblique_slice)
 
@@ -766,6 +815,9 @@ def coregister_fmri_session(
         out_resample = resample(
             in_file=sliced_registered_anat_filename,
             voxel_size=(voxel_size_x, voxel_size_y, voxel_size_z),
+            out_file=fname_presuffix(
+                sliced_registered_anat_filename, suffix="_resample"
+            ),
             outputtype="NIFTI_GZ",
             environ=environ,
         )
@@ -776,6 +828,9 @@ def coregister_fmri_session(
         out_resample = resample(
             in_file=sliced_bias_corrected_filename,
             voxel_size=(voxel_size_x, voxel_size_y, voxel_size_z),
+            out_file=fname_presuffix(
+                sliced_bias_corrected_filename, suffix="_resample"
+            ),
             outputtype="NIFTI_GZ",
             environ=environ,
         )
@@ -829,6 +884,7 @@ def coregister_fmri_session(
         out_resample = resample(
             in_file=warped_slice,
             voxel_size=voxel_size,
+            out_file=fname_presuffix(warped_slice, suffix="_resample"),
             outputtype="NIFTI_GZ",
             environ=environ,
         )
@@ -840,21 +896,22 @@ def coregister_fmri_session(
         sliced_registered_anat_filenames, resampled_warped_slices
     ):
         oblique_slice = fix_obliquity(
-            resampled_warped_slice, sliced_registered_anat_filename, verbose=verbose
+            resampled_warped_slice, sliced_registered_anat_filename,
+            verbose=verbose, environ=environ
         )
         resampled_warped_slices_oblique.append(oblique_slice)
 
     # slice functional
+    out_slicer = slicer(
+        in_file=allineated_filename,
+        out_base_name=fname_presuffix(allineated_filename, use_ext=False),
+        environ=environ,
+    )
     sliced_func_filenames = []
-    for slice_n in range(n_slices):
-        out_slicer = slicer(
-            in_file=allineated_filename,
-            keep="{0} {0}".format(slice_n),
-            out_file=fname_presuffix(allineated_filename, suffix="Sl%d" % slice_n),
-            environ=environ,
-        )
+    for sliced_filename in out_slicer.outputs.out_files:
         oblique_slice = fix_obliquity(
-            out_slicer.outputs.out_file, allineated_filename, verbose=verbose
+            sliced_filename, allineated_filename, verbose=verbose,
+            environ=environ
         )
         sliced_func_filenames.append(oblique_slice)
 
@@ -874,19 +931,22 @@ def coregister_fmri_session(
 
     # Finally, merge all slices !
     out_merge_func = merge(
-        in_files=warped_func_slices, outputtype="NIFTI_GZ", environ=environ
+        in_files=warped_func_slices,
+        dimension="z",
+        merged_file=fname_presuffix(warped_func_slices[0], suffix="_zcat"),
+        environ=environ,
     )
 
     # Fix the obliquity
     merged_oblique = fix_obliquity(
-        out_merge_func.outputs.out_file, allineated_filename, verbose=verbose
+        out_merge_func.outputs.merged_file, allineated_filename,
+        verbose=verbose, environ=environ
     )
 
     # Update the fmri data
     setattr(session_data, "coreg_func_", merged_oblique)
     setattr(session_data, "coreg_anat_", registered_anat_oblique_filename)
     setattr(session_data, "coreg_transform_", transform_filename)
-    os.chdir(current_dir)
 
     # Collect the outputs
     output_files.extend(
@@ -954,7 +1014,7 @@ def _func_to_template(
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
     """
-    environ = {}
+    environ = thread_environ()
     if verbose:
         terminal_output = "allatonce"
     else:
@@ -975,8 +1035,6 @@ def _func_to_template(
         warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         environ["AFNI_DECONFLICT"] = "OVERWRITE"
 
-    current_dir = os.getcwd()
-    os.chdir(write_dir)  # XXX to remove
     normalized_filename = fname_presuffix(func_coreg_filename, suffix="_normalized")
     if voxel_size is None:
         func_template_filename = template_filename
@@ -984,6 +1042,9 @@ def _func_to_template(
         out_resample = resample(
             in_file=template_filename,
             voxel_size=voxel_size,
+            out_file=fname_presuffix(
+                template_filename, suffix="_resample", newpath=write_dir
+            ),
             outputtype="NIFTI_GZ",
             environ=environ,
         )
@@ -1023,7 +1084,6 @@ def _func_to_template(
             out_file=normalized_filename,
             environ=environ,
         )
-    os.chdir(current_dir)
     return normalized_filename
 
 
@@ -1046,6 +1106,8 @@ def fmri_sessions_to_template(
     registration_kind="nonlinear",
     maxlev=2,
     func_voxel_size=None,
+    resampling_operator=False,
+    mask_filename=None,
     caching=False,
     verbose=True,
 ):
@@ -1092,6 +1154,15 @@ def fmri_sessions_to_template(
     func_voxel_size : 3-tuple of floats, optional
         Voxel size of the registered functional, in mm.
 
+    resampling_operator : bool, optional
+        If True, the functional volumes are normalized with a sparse matrix of
+        linear interpolation, computed once per session, instead of
+        3dNwarpApply.
+
+    mask_filename : str or None, optional
+        Template mask restricting the voxels computed with the resampling
+        operator.
+
     caching : bool, optional
         Wether or not to use caching.
 
@@ -1199,17 +1270,39 @@ def fmri_sessions_to_template(
     ) in enumerate(
         zip(sessions, anats_registration.pre_transforms, anats_registration.transforms)
     ):
-        normalized_func_filename = _func_to_template(
-            animal_data.coreg_func_,
-            head_template_filename,
-            animal_data.output_dir_,
-            animal_data.coreg_transform_,
-            anat_to_template_oned_filename,
-            anat_to_template_warp_filename,
-            voxel_size=func_voxel_size,
-            caching=caching,
-            verbose=verbose,
-        )
+        if resampling_operator:
+            transforms = [
+                anat_to_template_warp_filename,
+                anat_to_template_oned_filename,
+                animal_data.coreg_transform_,
+            ]
+            normalized_func_filename = _apply_transforms(
+                animal_data.coreg_func_,
+                head_template_filename,
+                animal_data.output_dir_,
+                [transform for transform in transforms if transform is not None],
+                transformed_filename=fname_presuffix(
+                    animal_data.coreg_func_, suffix="_normalized"
+                ),
+                transforms_kind=registration_kind,
+                voxel_size=func_voxel_size,
+                caching=caching,
+                verbose=verbose,
+                resampling_operator=True,
+                mask_filename=mask_filename,
+            )
+        else:
+            normalized_func_filename = _func_to_template(
+                animal_data.coreg_func_,
+                head_template_filename,
+                animal_data.output_dir_,
+                animal_data.coreg_transform_,
+                anat_to_template_oned_filename,
+                anat_to_template_warp_filename,
+                voxel_size=func_voxel_size,
+                caching=caching,
+                verbose=verbose,
+            )
 
         setattr(animal_data, "registered_func_", normalized_func_filename)
         sessions[n] = animal_data
@@ -0,0 +1,645 @@
+""" In-process replacements, based on nibabel and NumPy, for the AFNI and
+FSL interfaces used for trivial voxelwise operations and for slicing. They
+accept the inputs of the corresponding nipype interfaces that are used within
+sammba, and write NIfTI images with the geometry of their input.
+"""
+import os
+import json
+import numpy as np
+from scipy import ndimage
+import nibabel
+from nipype.interfaces.base import (TraitedSpec,
+                                    BaseInterfaceInputSpec,
+                                    BaseInterface,
+                                    InputMultiPath,
+                                    OutputMultiPath,
+                                    traits,
+                                    isdefined)
+from nipype.utils.filemanip import fname_presuffix
+
+
+_EXTENSIONS = {'NIFTI_GZ': '.nii.gz', 'NIFTI': '.nii'}
+
+# Functions of the AFNI expressions, applied to float64 arrays
+_EXPRESSION_FUNCTIONS = {
+    'ispositive': lambda x: (x > 0).astype(float),
+    'isnegative': lambda x: (x < 0).astype(float),
+    'iszero': lambda x: (x == 0).astype(float),
+    'notzero': lambda x: (x != 0).astype(float),
+    'step': lambda x: (x > 0).astype(float),
+    'bool': lambda x: (x != 0).astype(float),
+    'abs': np.abs,
+    'sqrt': np.sqrt,
+    'exp': np.exp,
+    'log': np.log,
+    'min': np.minimum,
+    'max': np.maximum}
+
+
+def _evaluate_expression(expr, variables):
+    """ Evaluates an AFNI 3dcalc expression of the given variables.
+    """
+    namespace = dict(_EXPRESSION_FUNCTIONS, **variables)
+    try:
+        return eval(expr.replace('^', '**'), {'__builtins__': {}}, namespace)
+    except (NameError, SyntaxError) as error:
+        raise ValueError('Unsupported expression "{0}": {1}'.format(expr,
+                                                                   error))
+
+
+def _cast_like(data, dtype):
+    """ Casts the float data to the given datatype, rounding and clipping
+    to its range for integers as AFNI does.
+    """
+    dtype = np.dtype(dtype)
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        data = np.clip(np.rint(data), info.min, info.max)
+    return data.astype(dtype)
+
+
+def _save_like(data, reference_img, out_file):
+    """ Saves the data with the affines and header of the reference image.
+    """
+    header = reference_img.header.copy()
+    header.set_data_dtype(data.dtype)
+    img = nibabel.Nifti1Image(data, reference_img.affine, header)
+    img.to_filename(out_file)
+
+
+class NativeInputSpec(BaseInterfaceInputSpec):
+    environ = traits.DictStrStr(
+        desc='Ignored, for compatibility with the AFNI interfaces')
+    outputtype = traits.Enum('NIFTI_GZ', 'NIFTI', usedefault=True,
+                             desc='Output image format')
+
+
+class NativeInterface(BaseInterface):
+    """ Base class for the native interfaces. The output file defaults to
+    the basename of the first input with `_suffix` in the current directory.
+    """
+    _suffix = ''
+
+    def _source_file(self):
+        return self.inputs.in_file
+
+    def _get_out_file(self):
+        if isdefined(self.inputs.out_file):
+            return os.path.abspath(self.inputs.out_file)
+
+        return os.path.abspath(
+            fname_presuffix(os.path.basename(self._source_file()),
+                            suffix=self._suffix + _EXTENSIONS[
+                                self.inputs.outputtype],
+                            use_ext=False))
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = self._get_out_file()
+        return outputs
+
+
+class OutFileSpec(TraitedSpec):
+    out_file = traits.File(desc='Output image', exists=True)
+
+
+class CalcInputSpec(NativeInputSpec):
+    in_file_a = traits.File(desc='Input image a', exists=True,
+                            mandatory=True)
+    in_file_b = traits.File(desc='Input image b', exists=True)
+    in_file_c = traits.File(desc='Input image c', exists=True)
+    expr = traits.Str(desc='AFNI expression of a, b and c', mandatory=True)
+    out_file = traits.File(desc='Output image')
+
+
+class Calc(NativeInterface):
+    """ Voxelwise expression of up to 3 images, as computed by AFNI 3dcalc.
+    The output has the datatype of the first image.
+
+    Examples
+    ========
+    >>> from sammba.registration.interfaces import Calc
+    >>> calc = Calc()
+    >>> calc.inputs.in_file_a = 'anat.nii.gz'
+    >>> calc.inputs.in_file_b = 'mask.nii.gz'
+    >>> calc.inputs.expr = 'a*b'
+    >>> res = calc.run()  # doctest: +SKIP
+    """
+    input_spec = CalcInputSpec
+    output_spec = OutFileSpec
+    _suffix = '_calc'
+
+    def _source_file(self):
+        return self.inputs.in_file_a
+
+    def _run_interface(self, runtime):
+        img = nibabel.load(self.inputs.in_file_a)
+        variables = {'a': np.asarray(img.dataobj, dtype=float)}
+        for name in ['b', 'c']:
+            in_file = getattr(self.inputs, 'in_file_' + name)
+            if isdefined(in_file):
+                variables[name] = np.asarray(nibabel.load(in_file).dataobj,
+                                             dtype=float)
+        data = _evaluate_expression(self.inputs.expr, variables)
+        data = np.broadcast_to(data, img.shape)
+        _save_like(_cast_like(data, img.get_data_dtype()), img,
+                   self._get_out_file())
+        return runtime
+
+
+class TStatInputSpec(NativeInputSpec):
+    in_file = traits.File(desc='Input image', exists=True, mandatory=True)
+    args = traits.Enum('-mean', desc='Statistic to compute, only the mean '
+                                     'is supported')
+    out_file = traits.File(desc='Output image')
+
+
+class TStat(NativeInterface):
+    """ Mean along the fourth dimension, as computed by AFNI 3dTstat.
+    """
+    input_spec = TStatInputSpec
+    output_spec = OutFileSpec
+    _suffix = '_tstat'
+
+    def _run_interface(self, runtime):
+        img = nibabel.load(self.inputs.in_file)
+        data = np.asarray(img.dataobj, dtype=float)
+        if data.ndim > 3:
+            data = data.reshape(data.shape[:3] + (-1,)).mean(axis=-1)
+        _save_like(data.astype(np.float32), img, self._get_out_file())
+        return runtime
+
+
+class TCatInputSpec(NativeInputSpec):
+    in_files = InputMultiPath(traits.File(exists=True), mandatory=True,
+                              desc='Input images')
+    out_file = traits.File(desc='Output image')
+    verbose = traits.Bool(desc='Ignored, for compatibility with AFNI')
+
+
+class TCat(NativeInterface):
+    """ Concatenation along the fourth dimension, as computed by AFNI
+    3dTcat. The output has the geometry of the first image.
+    """
+    input_spec = TCatInputSpec
+    output_spec = OutFileSpec
+    _suffix = '_tcat'
+
+    def _source_file(self):
+        return self.inputs.in_files[0]
+
+    def _run_interface(self, runtime):
+        imgs = [nibabel.load(in_file) for in_file in self.inputs.in_files]
+        dtype = np.result_type(*[img.get_data_dtype() for img in imgs])
+        data = np.concatenate(
+            [np.asarray(img.dataobj).reshape(img.shape[:3] + (-1,))
+             for img in imgs], axis=-1)
+        _save_like(data.astype(dtype), imgs[0], self._get_out_file())
+        return runtime
+
+
+class CopyInputSpec(NativeInputSpec):
+    in_file = traits.File(desc='Input image', exists=True, mandatory=True)
+    out_file = traits.File(desc='Output image')
+    verbose = traits.Bool(desc='Ignored, for compatibility with AFNI')
+
+
+class Copy(NativeInterface):
+    """ Copy of a NIfTI image, as done by AFNI 3dcopy.
+    """
+    input_spec = CopyInputSpec
+    output_spec = OutFileSpec
+    _suffix = '_copy'
+
+    def _run_interface(self, runtime):
+        nibabel.load(self.inputs.in_file).to_filename(self._get_out_file())
+        return runtime
+
+
+class UndumpInputSpec(NativeInputSpec):
+    in_file = traits.File(desc='Master image', exists=True, mandatory=True)
+    out_file = traits.File(desc='Output image')
+
+
+class Undump(NativeInterface):
+    """ Empty image on the 3D grid of the master, as created by AFNI
+    3dUndump without coordinates.
+    """
+    input_spec = UndumpInputSpec
+    output_spec = OutFileSpec
+    _suffix = '_undumped'
+
+    def _run_interface(self, runtime):
+        img = nibabel.load(self.inputs.in_file)
+        _save_like(np.zeros(img.shape[:3], dtype=np.int16), img,
+                   self._get_out_file())
+        return runtime
+
+
+class SliceInputSpec(NativeInputSpec):
+    in_file = traits.File(desc='Input image', exists=True, mandatory=True)
+    out_base_name = traits.Str(desc='Outputs prefix')
+
+
+class SliceOutputSpec(TraitedSpec):
+    out_files = OutputMultiPath(traits.File(exists=True),
+                                desc='Images of the slices')
+
+
+class Slice(NativeInterface):
+    """ Split along the third dimension into single slice images, named as
+    by FSL fslslice. The image is loaded once and each slice keeps its
+    position in space.
+    """
+    input_spec = SliceInputSpec
+    output_spec = SliceOutputSpec
+
+    def _out_files(self):
+        if isdefined(self.inputs.out_base_name):
+            out_base_name = self.inputs.out_base_name
+        else:
+            out_base_name = fname_presuffix(
+                os.path.basename(self.inputs.in_file), use_ext=False)
+        n_slices = nibabel.load(self.inputs.in_file).shape[2]
+        return [os.path.abspath('{0}_slice_{1:04d}{2}'.format(
+                    out_base_name, n, _EXTENSIONS[self.inputs.outputtype]))
+                for n in range(n_slices)]
+
+    def _run_interface(self, runtime):
+        img = nibabel.load(self.inputs.in_file)
+        data = np.asarray(img.dataobj)
+        for n, out_file in enumerate(self._out_files()):
+            affine = img.affine.copy()
+            affine[:3, 3] = img.affine.dot([0, 0, n, 1])[:3]
+            header = img.header.copy()
+            header.set_qform(affine, code=int(img.header['qform_code']))
+            header.set_sform(affine, code=int(img.header['sform_code']))
+            nibabel.Nifti1Image(data[:, :, n:n + 1], None,
+                                header).to_filename(out_file)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_files'] = self._out_files()
+        return outputs
+
+
+class MergeInputSpec(NativeInputSpec):
+    in_files = InputMultiPath(traits.File(exists=True), mandatory=True,
+                              desc='Input images')
+    dimension = traits.Enum('z', usedefault=True,
+                            desc="Only 'z' is supported")
+    merged_file = traits.File(desc='Output image')
+
+
+class MergeOutputSpec(TraitedSpec):
+    merged_file = traits.File(desc='Output image', exists=True)
+
+
+class Merge(NativeInterface):
+    """ Concatenation along the third dimension, as computed by FSL fslmerge
+    with `-z`. The output has the geometry and the datatype of the first
+    image.
+    """
+    input_spec = MergeInputSpec
+    output_spec = MergeOutputSpec
+    _suffix = '_merged'
+
+    def _source_file(self):
+        return self.inputs.in_files[0]
+
+    def _get_out_file(self):
+        if isdefined(self.inputs.merged_file):
+            return os.path.abspath(self.inputs.merged_file)
+
+        return fname_presuffix(os.path.basename(self._source_file()),
+                               suffix=self._suffix + _EXTENSIONS[
+                                   self.inputs.outputtype],
+                               newpath=os.getcwd(), use_ext=False)
+
+    def _run_interface(self, runtime):
+        imgs = [nibabel.load(in_file) for in_file in self.inputs.in_files]
+        data = np.concatenate([np.asarray(img.dataobj) for img in imgs],
+                              axis=2)
+        _save_like(_cast_like(data, imgs[0].get_data_dtype()), imgs[0],
+                   self._get_out_file())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['merged_file'] = self._get_out_file()
+        return outputs
+
+
+class RefitInputSpec(BaseInterfaceInputSpec):
+    in_file = traits.File(desc='Image to modify in place', exists=True,
+                          mandatory=True, copyfile=True)
+    xorigin = traits.Enum('cen', desc="Only 'cen' is supported: the grid "
+                                      "center is placed at 0")
+    yorigin = traits.Enum('cen', desc="Only 'cen' is supported")
+    zorigin = traits.Enum('cen', desc="Only 'cen' is supported")
+    duporigin_file = traits.File(
+        desc='Image to copy the position of the first voxel from',
+        exists=True)
+    environ = traits.DictStrStr(
+        desc='Ignored, for compatibility with the AFNI interfaces')
+
+
+class Refit(BaseInterface):
+    """ Change of the origin of an image, in place, as done by AFNI 3drefit
+    with `-xorigin cen` or `-duporigin`. Both the qform and the sform are
+    modified.
+    """
+    input_spec = RefitInputSpec
+    output_spec = OutFileSpec
+
+    def _run_interface(self, runtime):
+        # The file is overwritten, so it must not be memory mapped
+        img = nibabel.load(self.inputs.in_file, mmap=False)
+        affine = img.affine.copy()
+        if isdefined(self.inputs.duporigin_file):
+            affine[:3, 3] = nibabel.load(self.inputs.duporigin_file).affine[
+                :3, 3]
+
+        center = affine[:3, :3].dot((np.array(img.shape[:3]) - 1) / 2.)
+        for n, origin in enumerate([self.inputs.xorigin,
+                                    self.inputs.yorigin,
+                                    self.inputs.zorigin]):
+            if isdefined(origin):
+                affine[n, 3] = -center[n]
+
+        header = img.header.copy()
+        header.set_qform(affine, int(header['qform_code']) or 1)
+        header.set_sform(affine, int(header['sform_code']) or 1)
+        data = np.asarray(img.dataobj)
+        nibabel.Nifti1Image(data, affine, header).to_filename(
+            self.inputs.in_file)
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        outputs['out_file'] = os.path.abspath(self.inputs.in_file)
+        return outputs
+
+
+# AFNI warps store displacements in mm in DICOM order, where x and y
+# increase towards the left and the back
+_DICOM_TO_RAS = np.array([-1., -1., 1.])
+
+
+def _grid_coordinates(img):
+    """ Returns the world coordinates of the voxels of the image 3D grid,
+    with the coordinates along the last axis.
+    """
+    voxels = np.rollaxis(np.indices(img.shape[:3], dtype=float), 0, 4)
+    return voxels.dot(img.affine[:3, :3].T) + img.affine[:3, 3]
+
+
+def _sample(data, affine, points, order=1):
+    """ Interpolates the 3D data, or its components along the last axis,
+    at the given world coordinates.
+    """
+    inverse_affine = np.linalg.inv(affine)
+    voxels = np.rollaxis(points.dot(inverse_affine[:3, :3].T) +
+                         inverse_affine[:3, 3], -1)
+    if data.ndim == 3:
+        return ndimage.map_coordinates(data, voxels, order=order,
+                                       mode='nearest')
+
+    return np.stack([ndimage.map_coordinates(data[..., n], voxels,
+                                             order=order, mode='nearest')
+                     for n in range(data.shape[-1])], axis=-1)
+
+
+def _load_warp(warp_file):
+    """ Returns the image of an AFNI warp and its displacements in mm in
+    RAS order, with the components along the last axis.
+    """
+    img = nibabel.load(warp_file, mmap=False)
+    displacements = np.asarray(img.dataobj, dtype=float).reshape(
+        img.shape[:3] + (3,))
+    return img, displacements * _DICOM_TO_RAS
+
+
+class NwarpAdjustInputSpec(NativeInputSpec):
+    warps = InputMultiPath(traits.File(exists=True), minlen=5,
+                           mandatory=True,
+                           desc='Warps to adjust, on the same grid')
+    adjusted_warps = InputMultiPath(
+        traits.File(), desc='Output adjusted warps, one per warp. Defaults to '
+                            'the warps basenames with `_adjusted` in the '
+                            'current directory')
+    in_files = InputMultiPath(traits.File(exists=True), minlen=5,
+                              desc='Images to warp by the adjusted warps and '
+                                   'average, on the same grid')
+    out_file = traits.File(desc='Output mean image', requires=['in_files'])
+    max_iter = traits.Int(50, usedefault=True,
+                          desc='Maximal number of iterations of the mean '
+                               'warp inversion')
+    tol = traits.Float(1e-3, usedefault=True,
+                       desc='Tolerance of the mean warp inversion, as a '
+                            'fraction of the smallest voxel size')
+
+
+class NwarpAdjustOutputSpec(TraitedSpec):
+    out_file = traits.File(desc='Output mean image')
+    adjusted_warps = OutputMultiPath(traits.File(exists=True),
+                                     desc='Adjusted warps')
+
+
+class NwarpAdjust(NativeInterface):
+    """ Adjustment of warps so that their average is the identity, as done
+    by AFNI 3dNwarpAdjust. Each warp is composed with the inverse of the
+    mean warp and saved to a new file, leaving the input warps unchanged.
+    If images are given, they are warped by the adjusted warps, with linear
+    interpolation, and averaged.
+
+    The warps and images are read one at a time, so that the memory use
+    does not depend on the number of warps.
+
+    Examples
+    ========
+    >>> from sammba.registration.interfaces import NwarpAdjust
+    >>> adjust = NwarpAdjust()
+    >>> adjust.inputs.warps = ['warp1.nii.gz', 'warp2.nii.gz', 'warp3.nii.gz',
+    ...                        'warp4.nii.gz', 'warp5.nii.gz']
+    >>> res = adjust.run()  # doctest: +SKIP
+    """
+    input_spec = NwarpAdjustInputSpec
+    output_spec = NwarpAdjustOutputSpec
+    _suffix = '_NwarpAdjust'
+
+    def _source_file(self):
+        return self.inputs.in_files[0]
+
+    def _adjusted_warps(self):
+        if isdefined(self.inputs.adjusted_warps):
+            if len(self.inputs.adjusted_warps) != len(self.inputs.warps):
+                raise ValueError(
+                    'number of adjusted warps {0} does not match number of '
+                    'warps {1}'.format(len(self.inputs.adjusted_warps),
+                                       len(self.inputs.warps)))
+            return [os.path.abspath(warp_file)
+                    for warp_file in self.inputs.adjusted_warps]
+
+        return [fname_presuffix(warp_file, suffix='_adjusted',
+                                newpath=os.getcwd())
+                for warp_file in self.inputs.warps]
+
+    def _invert_mean_warp(self, mean_displacements, img):
+        # Fixed point iterations y = x - mean(y) for the inverse y of the
+        # mean warp at each grid point x
+        grid = _grid_coordinates(img)
+        tol = self.inputs.tol * np.min(img.header.get_zooms()[:3])
+        inverse = grid - mean_displacements
+        for _ in range(self.inputs.max_iter):
+            previous_inverse = inverse
+            inverse = grid - _sample(mean_displacements, img.affine, inverse)
+            if np.max(np.abs(inverse - previous_inverse)) < tol:
+                break
+
+        return inverse
+
+    def _run_interface(self, runtime):
+        adjusted_warps = self._adjusted_warps()
+        for n, warp_file in enumerate(self.inputs.warps):
+            img, displacements = _load_warp(warp_file)
+            if n == 0:
+                mean_displacements = displacements
+            else:
+                mean_displacements += (displacements -
+                                       mean_displacements) / (n + 1.)
+
+        inverse = self._invert_mean_warp(mean_displacements, img)
+        del mean_displacements
+        grid = _grid_coordinates(img)
+        if isdefined(self.inputs.in_files):
+            source_imgs = [nibabel.load(in_file)
+                           for in_file in self.inputs.in_files]
+            out_grid = _grid_coordinates(source_imgs[0])
+            mean = np.zeros(source_imgs[0].shape[:3])
+
+        for n, (warp_file, adjusted_warp_file) in enumerate(
+                zip(self.inputs.warps, adjusted_warps)):
+            img, displacements = _load_warp(warp_file)
+            displacements = inverse + _sample(displacements, img.affine,
+                                              inverse) - grid
+            data = (displacements * _DICOM_TO_RAS).reshape(img.shape)
+            _save_like(data.astype(img.get_data_dtype()), img,
+                       adjusted_warp_file)
+            if isdefined(self.inputs.in_files):
+                source_img = source_imgs[n]
+                points = out_grid + _sample(displacements, img.affine,
+                                            out_grid)
+                warped = _sample(np.asarray(source_img.dataobj, dtype=float),
+                                 source_img.affine, points)
+                mean += (warped - mean) / (n + 1.)
+
+        if isdefined(self.inputs.in_files):
+            _save_like(mean.astype(np.float32), source_imgs[0],
+                       self._get_out_file())
+        return runtime
+
+    def _list_outputs(self):
+        outputs = self.output_spec().get()
+        if isdefined(self.inputs.in_files):
+            outputs['out_file'] = self._get_out_file()
+        outputs['adjusted_warps'] = self._adjusted_warps()
+        return outputs
+
+
+# NIfTI extension code of the comments, listing the warped slices of the
+# per-slice warps
+_COMMENT_CODE = 6
+
+
+def _get_warped_slices(img):
+    """ Returns the indices of the warped slices of per-slice warps stacked
+    in a single image.
+    """
+    for extension in img.header.extensions:
+        if extension.get_code() == _COMMENT_CODE:
+            return json.loads(
+                extension.get_content().decode())['warped_slices']
+
+    return []
+
+
+class PerSliceNwarpApplyInputSpec(NativeInputSpec):
+    in_file = traits.File(desc='3D or 4D image to warp', exists=True,
+                          mandatory=True)
+    warps = traits.File(desc='Per-slice warps stacked along the third '
+                             'dimension, one per slice of the input',
+                        exists=True, mandatory=True)
+    interp = traits.Enum('linear', 'nearest', 'cubic', usedefault=True,
+                         desc='Interpolation of the input')
+    block_size = traits.Int(64, usedefault=True,
+                            desc='Number of time points warped at once')
+    out_file = traits.File(desc='Output image')
+
+
+class PerSliceNwarpApply(NativeInterface):
+    """ Warping of each slice of an image by its own 2D warp, as done by
+    AFNI 3dNwarpApply on each slice with the slice as master. The warps are
+    read once, memory mapped, and all the slices are interpolated at once
+    for blocks of time points. Slices without warp are copied. The output
+    has the geometry of the input and is stored as float.
+    """
+    input_spec = PerSliceNwarpApplyInputSpec
+    output_spec = OutFileSpec
+    _suffix = '_perslice_warped'
+    _orders = {'nearest': 0, 'linear': 1, 'cubic': 3}
+
+    def _source_voxels(self, img):
+        # In-plane position within each input slice of the source of each
+        # voxel of the input grid
+        warps_img = nibabel.load(self.inputs.warps)
+        if warps_img.shape[2] != img.shape[2]:
+            raise ValueError('number of warps {0} does not match number of '
+                             'slices {1}'.format(warps_img.shape[2],
+                                                 img.shape[2]))
+
+        warps = np.asanyarray(warps_img.dataobj)
+        grid = _grid_coordinates(img)
+        inverse_affine = np.linalg.inv(warps_img.affine)
+        warp_voxels = np.rollaxis(grid.dot(inverse_affine[:3, :3].T) +
+                                  inverse_affine[:3, 3], -1)
+        warp_voxels[2] = np.arange(img.shape[2])
+        displacements = np.stack(
+            [ndimage.map_coordinates(
+                np.asarray(warps[:, :, :, 0, n], dtype=float), warp_voxels,
+                order=1, mode='nearest') for n in range(3)], axis=-1)
+        points = grid + displacements * _DICOM_TO_RAS
+
+        inverse_affine = np.linalg.inv(img.affine)
+        source_voxels = np.rollaxis(points.dot(inverse_affine[:3, :3].T) +
+                                    inverse_affine[:3, 3], -1)
+        source_voxels[2] = np.arange(img.shape[2])
+        unwarped = np.ones(img.shape[2], dtype=bool)
+        unwarped[_get_warped_slices(warps_img)] = False
+        source_voxels[:, :, :, unwarped] = np.indices(img.shape[:3])[
+            :, :, :, unwarped]
+        return source_voxels
+
+    def _run_interface(self, runtime):
+        img = nibabel.load(self.inputs.in_file)
+        source_voxels = self._source_voxels(img)
+        n_volumes = int(np.prod(img.shape[3:]))
+        data = np.zeros(img.shape[:3] + (n_volumes,), dtype=np.float32)
+        for start in range(0, n_volumes, self.inputs.block_size):
+            stop = min(start + self.inputs.block_size, n_volumes)
+            if len(img.shape) == 3:
+                block = np.asarray(img.dataobj, dtype=float)[..., np.newaxis]
+            else:
+                block = np.asarray(img.dataobj[..., start:stop], dtype=float)
+            volumes = np.arange(stop - start, dtype=float)
+            voxels = [np.broadcast_to(coordinates[..., np.newaxis],
+                                      block.shape)
+                      for coordinates in source_voxels]
+            voxels.append(np.broadcast_to(volumes, block.shape))
+            data[..., start:stop] = ndimage.map_coordinates(
+                block, voxels, order=self._orders[self.inputs.interp],
+                mode='constant')
+
+        _save_like(data.reshape(img.shape), img, self._get_out_file())
+        return runtime
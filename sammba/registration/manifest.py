@@ -0,0 +1,165 @@
+"""
+On-disk record of the completed stages of a long registration run.
+"""
+import os
+import json
+import hashlib
+
+
+def _file_checksum(filename, block_size=2 ** 20):
+    checksum = hashlib.md5()
+    with open(filename, 'rb') as fp:
+        for block in iter(lambda: fp.read(block_size), b''):
+            checksum.update(block)
+
+    return checksum.hexdigest()
+
+
+def _file_stat(filename):
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def _list_files(outputs):
+    """ Returns the existing files within the nested outputs.
+    """
+    if isinstance(outputs, dict):
+        outputs = list(outputs.values())
+    if isinstance(outputs, (list, tuple)):
+        files = []
+        for output in outputs:
+            files.extend(_list_files(output))
+        return files
+    if isinstance(outputs, str) and os.path.isfile(outputs):
+        return [outputs]
+    return []
+
+
+def hash_parameters(parameters):
+    """ Returns a hash of the parameters of a run. Existing files are
+    identified by their path, size and modification time.
+
+    Parameters
+    ----------
+    parameters : dict
+        JSON serializable parameters.
+    """
+    files = dict((filename, _file_stat(filename))
+                 for filename in _list_files(parameters))
+    description = json.dumps([parameters, files], sort_keys=True)
+    return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+
+class RunManifest(object):
+    """ JSON file recording the outputs of the completed stages of a run, in
+    completion order. A stage is valid if all its output files still exist
+    with the recorded size and modification time or, failing that, with the
+    recorded checksum.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the JSON manifest.
+
+    parameters_hash : str
+        Hash of the run parameters. Recorded stages are discarded if it
+        differs from the recorded one.
+
+    verbose : int, optional
+        Verbosity level.
+    """
+    def __init__(self, filename, parameters_hash, verbose=0):
+        self.filename = filename
+        self.parameters_hash = parameters_hash
+        self.verbose = verbose
+        self.stages = []
+        if os.path.isfile(filename):
+            with open(filename) as fp:
+                manifest = json.load(fp)
+            if manifest['parameters'] == parameters_hash:
+                self.stages = manifest['stages']
+            elif verbose:
+                print('Parameters changed, discarding {}'.format(filename))
+
+    def _is_valid(self, stage):
+        for filename, description in stage['files'].items():
+            if not os.path.isfile(filename):
+                return False
+            stat = _file_stat(filename)
+            if stat['size'] != description['size']:
+                return False
+            if stat['mtime'] != description['mtime']:
+                if _file_checksum(filename) != description['checksum']:
+                    return False
+                description.update(stat)
+
+        return True
+
+    def get(self, stage_name):
+        """ Returns the recorded outputs of the stage if it is valid, None
+        otherwise. An invalid stage is discarded with all the stages
+        completed after it.
+        """
+        for n, stage in enumerate(self.stages):
+            if stage['name'] == stage_name:
+                if self._is_valid(stage):
+                    if self.verbose:
+                        print('Skipping completed stage {}'.format(
+                            stage_name))
+                    return stage['outputs']
+                break
+        else:
+            return None
+
+        del self.stages[n:]
+        self._save()
+        return None
+
+    def record(self, stage_name, outputs):
+        """ Records the outputs of a completed stage.
+        """
+        files = {}
+        for filename in _list_files(outputs):
+            files[filename] = _file_stat(filename)
+            files[filename]['checksum'] = _file_checksum(filename)
+
+        self.stages = [stage for stage in self.stages
+                       if stage['name'] != stage_name]
+        self.stages.append({'name': stage_name, 'outputs': outputs,
+                            'files': files})
+        self._save()
+
+    def _save(self):
+        # Write to a temporary file first, to never leave a partial manifest
+        temporary_filename = self.filename + '.tmp'
+        with open(temporary_filename, 'w') as fp:
+            json.dump({'parameters': self.parameters_hash,
+                       'stages': self.stages}, fp, indent=1)
+        os.replace(temporary_filename, self.filename)
+
+
+def run_stage(manifest, stage_name, function):
+    """ Returns the recorded outputs of the stage if valid, otherwise runs
+    the stage function and records its outputs.
+
+    Parameters
+    ----------
+    manifest : RunManifest or None
+        The run manifest. If None, the stage is always run.
+
+    stage_name : str
+        Unique name of the stage within the run.
+
+    function : callable
+        Function without arguments running the stage and returning its
+        JSON serializable outputs.
+    """
+    if manifest is None:
+        return function()
+
+    outputs = manifest.get(stage_name)
+    if outputs is None:
+        outputs = function()
+        manifest.record(stage_name, outputs)
+
+    return outputs
@@ -2,6 +2,7 @@ import warnings
 from sklearn.utils import Bunch
 from nilearn._utils.exceptions import VisibleDeprecationWarning
 from .base import _reorient, _rigid_body_register_and_reorient
+from ..threads import thread_environ
 
 
 def _coregister_nonepi(
@@ -63,7 +64,7 @@ def _coregister_nonepi(
         warnings.warn(warn_str, VisibleDeprecationWarning, stacklevel=2)
         reorient_only = not (prior_rigid_body_registration)
 
-    environ = {"AFNI_DECONFLICT": "OVERWRITE"}
+    environ = thread_environ({"AFNI_DECONFLICT": "OVERWRITE"})
     for key, value in environ_kwargs.items():
         environ[key] = value
 
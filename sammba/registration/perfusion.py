@@ -6,6 +6,7 @@ from nipype.interfaces import afni
 from nipype.utils.filemanip import fname_presuffix
 from nilearn._utils.exceptions import VisibleDeprecationWarning
 from .base import _rigid_body_register, _warp, _per_slice_qwarp
+from ..threads import thread_environ
 
 
 def coregister(
@@ -21,6 +22,9 @@ def coregister(
     voxel_size_y=0.1,
     caching=False,
     verbose=True,
+    n_jobs=1,
+    resample_volumes=False,
+    backend="afni",
     **environ_kwargs
 ):
     """
@@ -52,6 +56,17 @@ def coregister(
     verbose : bool, optional
         If True, all steps are verbose. Note that caching implies some
         verbosity in any case.
+    n_jobs : int, optional
+        Number of slices registered in parallel. -1 means all the CPUs.
+    resample_volumes : bool, optional
+        If True, the volumes are resampled to `voxel_size_x` and
+        `voxel_size_y` once before slicing and back once after merging,
+        instead of slice by slice.
+    backend : one of {'afni', 'native'}, optional
+        Backend of the per-slice warps application to `apply_to_file`.
+        With 'native', all the slices are warped at once in-process, with
+        linear interpolation, instead of running AFNI 3dNwarpApply on each
+        slice.
     environ_kwargs : extra arguments keywords
         Extra arguments keywords, passed to interfaces environ variable.
 
@@ -67,6 +82,9 @@ def coregister(
                           image.
         - `coreg_transform_` : str
                                Path to the transform from anat to func.
+        - `coreg_warps_` : str
+                           Path to the per-slice warps, stored in a single
+                           image.
     Notes
     -----
     If `use_rats_tool` is turned on, RATS tool is used for brain extraction
@@ -82,7 +100,7 @@ def coregister(
         warnings.warn(warn_str, VisibleDeprecationWarning, stacklevel=2)
         reorient_only = not (prior_rigid_body_registration)
 
-    environ = {"AFNI_DECONFLICT": "OVERWRITE"}
+    environ = thread_environ({"AFNI_DECONFLICT": "OVERWRITE"})
     for key, value in environ_kwargs.items():
         environ[key] = value
 
@@ -153,7 +171,7 @@ def coregister(
     ##################################################
     # Per-slice non-linear registration func -> anat #
     ##################################################
-    warped_m0_file, warp_files, warped_apply_to_file = _per_slice_qwarp(
+    warped_m0_file, warps_file, warped_apply_to_file = _per_slice_qwarp(
         unbiased_m0_file,
         registered_anat_oblique_file,
         voxel_size_x,
@@ -164,6 +182,9 @@ def coregister(
         caching=caching,
         terminal_output=terminal_output,
         environ=environ,
+        n_jobs=n_jobs,
+        resample_volumes=resample_volumes,
+        backend=backend,
     )
 
     # Remove the intermediate outputs
@@ -176,5 +197,5 @@ def coregister(
         coreg_m0_=warped_m0_file,
         coreg_anat_=registered_anat_oblique_file,
         coreg_transform_=transform_file,
-        coreg_warps_=warp_files,
+        coreg_warps_=warps_file,
     )
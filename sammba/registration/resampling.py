@@ -0,0 +1,95 @@
+"""
+Sparse matrices resampling images through a chain of transforms, so that
+the volumes of runs on the same grid are normalized with a single product.
+"""
+import itertools
+import numpy as np
+import nibabel
+from scipy import sparse
+from nilearn import image
+from .interfaces import _save_like
+
+
+def write_coordinates(source_file, out_file):
+    """ Writes the voxel coordinates of the 3D grid of the source image,
+    followed by a volume of ones, as a 4D image with the source geometry.
+    Transformed with linear interpolation, they give the position in the
+    source of each target voxel and its weight inside the source grid.
+    """
+    img = nibabel.load(source_file)
+    coordinates = np.indices(img.shape[:3], dtype=np.float32)
+    coordinates = np.concatenate(
+        [coordinates, np.ones((1,) + img.shape[:3], dtype=np.float32)])
+    _save_like(np.rollaxis(coordinates, 0, 4), img, out_file)
+    return out_file
+
+
+def compute_operator(coordinates_file, source_shape, mask_file=None):
+    """ Returns the sparse matrix of the trilinear interpolation of the
+    flattened source volumes at the target voxels, from the transformed
+    coordinates written by `write_coordinates`. Rows of the voxels outside
+    the mask, if given, are empty.
+    """
+    img = nibabel.load(coordinates_file)
+    coordinates = np.asarray(img.dataobj, dtype=float).reshape(
+        img.shape[:3] + (4,))
+    weights = coordinates[..., 3]
+    inside = weights > 1e-3
+    if mask_file is not None:
+        mask_img = image.resample_to_img(mask_file, image.index_img(img, 0),
+                                         interpolation='nearest')
+        inside = np.logical_and(inside, mask_img.get_fdata() > 0)
+
+    rows = np.flatnonzero(inside)
+    weights = weights[inside]
+    positions = coordinates[inside][:, :3] / weights[:, np.newaxis]
+    corners = np.floor(positions).astype(int)
+    fractions = positions - corners
+    all_rows, all_columns, all_values = [], [], []
+    for shift in itertools.product([0, 1], repeat=3):
+        voxels = corners + shift
+        values = weights * np.prod(np.where(shift, fractions, 1 - fractions),
+                                   axis=1)
+        in_source = np.logical_and(
+            np.all((voxels >= 0) & (voxels < source_shape), axis=1),
+            values > 0)
+        all_rows.append(rows[in_source])
+        all_columns.append(np.ravel_multi_index(voxels[in_source].T,
+                                                source_shape))
+        all_values.append(values[in_source])
+
+    return sparse.csr_matrix(
+        (np.concatenate(all_values),
+         (np.concatenate(all_rows), np.concatenate(all_columns))),
+        shape=(int(np.prod(img.shape[:3])), int(np.prod(source_shape))))
+
+
+def apply_operator(operator_file, in_file, target_file, out_file,
+                   block_size=64):
+    """ Resamples all the volumes of the image on the target grid with the
+    sparse matrix stored in `operator_file`, for blocks of volumes at once.
+    The output is stored as float.
+    """
+    operator = sparse.load_npz(operator_file)
+    img = nibabel.load(in_file)
+    target_img = nibabel.load(target_file)
+    n_volumes = int(np.prod(img.shape[3:]))
+    data = np.zeros((operator.shape[0], n_volumes), dtype=np.float32)
+    for start in range(0, n_volumes, block_size):
+        stop = min(start + block_size, n_volumes)
+        if len(img.shape) == 3:
+            block = np.asarray(img.dataobj, dtype=float)
+        else:
+            block = np.asarray(img.dataobj[..., start:stop], dtype=float)
+        data[:, start:stop] = operator.dot(
+            block.reshape((operator.shape[1], stop - start)))
+
+    # The target grid, with the sampling in time of the input
+    header = target_img.header.copy()
+    data = data.reshape(target_img.shape[:3] + img.shape[3:])
+    header.set_data_shape(data.shape)
+    header.set_zooms(target_img.header.get_zooms()[:3] +
+                     img.header.get_zooms()[3:])
+    reference_img = nibabel.Nifti1Image(data, target_img.affine, header)
+    _save_like(data, reference_img, out_file)
+    return out_file
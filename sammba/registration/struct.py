@@ -1,11 +1,620 @@
 import os
+import shutil
+import warnings
+import numpy as np
+import nibabel
+from joblib import Parallel, delayed
 from nipype.interfaces import afni, fsl
 from nipype.utils.filemanip import fname_presuffix
 from nipype.caching import Memory
 from sklearn.datasets.base import Bunch
-from sklearn.utils import deprecated
+from sklearn.utils import deprecated, check_random_state
 from sammba import segmentation
 from ..orientation import fix_obliquity
+from ..threads import thread_environ
+from .workflows import _create_anats_to_common_workflow, _run_workflow
+from .manifest import RunManifest, hash_parameters, run_stage
+from .base import _get_crop_box, _crop, _uncrop_warp
+from .interfaces import _save_like
+from . import interfaces
+
+
+def _interface_run(interface, **interface_kwargs):
+    """ Returns a function running a new instance of the given interface at
+    each call, so that the inputs of previous calls are never reused.
+    """
+    def run(**inputs):
+        return interface(**interface_kwargs).run(**inputs)
+
+    return run
+
+
+def _map_animals(function, n_jobs, *animals_args):
+    """ Applies a per-animal function to each set of arguments and returns
+    the outputs in the animals order. Animals are processed in parallel
+    processes if n_jobs is not 1.
+    """
+    if n_jobs == 1:
+        return [function(*args) for args in zip(*animals_args)]
+
+    return Parallel(n_jobs=n_jobs)(
+        delayed(function)(*args)
+        for args in zip(*animals_args))
+
+
+def _get_compute_mask_interface(use_rats_tool):
+    if use_rats_tool:
+        if segmentation.interfaces.Info().version() is None:
+            raise ValueError('Can not locate RATS')
+        else:
+            return segmentation.MathMorphoMask
+    else:
+        return segmentation.HistogramMask
+
+
+def _get_verbosity_kwargs(verbose):
+    """ Returns the terminal output and the verbosity inputs of the AFNI
+    interfaces for the given verbosity level.
+    """
+    if verbose:
+        terminal_output = 'stream'
+        verbosity_kwargs = {'verbose': verbose > 1}
+        quietness_kwargs = {}
+        verb_quietness_kwargs = {'verb': verbose > 2}
+        verbosity_quietness_kwargs = {'verbose': verbose > 2}
+    else:
+        terminal_output = 'none'
+        verbosity_kwargs = {}
+        quietness_kwargs = {'quiet': True}
+        verb_quietness_kwargs = {'quiet': True}
+        verbosity_quietness_kwargs = {'quiet': True}
+
+    return (terminal_output, verbosity_kwargs, quietness_kwargs,
+            verb_quietness_kwargs, verbosity_quietness_kwargs)
+
+
+def _with_inputs(step, **default_inputs):
+    """ Returns a function running the step with the given default inputs.
+    """
+    def run(**inputs):
+        return step(**dict(default_inputs, **inputs))
+
+    return run
+
+
+def _copy_and_adjust(nwarp_adjust):
+    """ Returns a function running AFNI 3dNwarpAdjust, which adjusts the
+    warps in place, on copies of the warps named `adjusted_warps`. Its
+    outputs are those of the native interface.
+    """
+    def run(warps, adjusted_warps, **inputs):
+        for warp_file, adjusted_warp_file in zip(warps, adjusted_warps):
+            shutil.copy(warp_file, adjusted_warp_file)
+        out_adjust = nwarp_adjust(warps=adjusted_warps, **inputs)
+        return Bunch(outputs=Bunch(out_file=out_adjust.outputs.out_file,
+                                   adjusted_warps=list(adjusted_warps)))
+
+    return run
+
+
+def _adjust_warps(nwarp_adjust, warp_files, write_dir, **inputs):
+    """ Adjusts the warps so that their average is the identity, and returns
+    the adjusted warps, saved in write_dir with the `_adjusted` suffix. The
+    given warps are left unchanged.
+    """
+    adjusted_warp_files = [fname_presuffix(warp_file, suffix='_adjusted',
+                                           newpath=write_dir)
+                           for warp_file in warp_files]
+    out_adjust = nwarp_adjust(warps=warp_files,
+                              adjusted_warps=adjusted_warp_files, **inputs)
+    return out_adjust.outputs.adjusted_warps
+
+
+_BACKENDS = {'afni': afni, 'native': interfaces}
+
+# Steps for which an in-process interface exists
+_NATIVE_STEPS = {'copy_file': 'Copy', 'calc': 'Calc', 'refit': 'Refit',
+                 'tcat': 'TCat', 'tstat': 'TStat', 'undump': 'Undump',
+                 'nwarp_adjust': 'NwarpAdjust'}
+
+
+def _get_template_steps(compute_mask_interface, write_dir, caching=False,
+                        terminal_output='stream', environ=None,
+                        backend='afni', n_jobs=1):
+    """ Returns the functions running the template building steps, with
+    caching in write_dir if required. If given, environ is passed to all the
+    AFNI interfaces, with the number of threads of the thread budget for
+    n_jobs animals processed in parallel. With the 'native' backend, the
+    trivial voxelwise steps and the warps adjustment run in-process with
+    nibabel and NumPy.
+    """
+    if backend not in _BACKENDS:
+        raise ValueError('Backend must be one of {0}, you entered '
+                         '{1}'.format(sorted(_BACKENDS), backend))
+
+    voxelwise = dict((step_name, getattr(_BACKENDS[backend], interface_name))
+                     for step_name, interface_name in _NATIVE_STEPS.items())
+    if caching:
+        memory = Memory(write_dir)
+        steps = Bunch(
+            copy_file=memory.cache(voxelwise['copy_file']),
+            unifize=memory.cache(afni.Unifize),
+            clip_level=memory.cache(afni.ClipLevel),
+            compute_mask=memory.cache(compute_mask_interface),
+            calc=memory.cache(voxelwise['calc']),
+            center_mass=memory.cache(afni.CenterMass),
+            refit=memory.cache(voxelwise['refit']),
+            tcat=memory.cache(voxelwise['tcat']),
+            tstat=memory.cache(voxelwise['tstat']),
+            undump=memory.cache(voxelwise['undump']),
+            resample=memory.cache(afni.Resample),
+            allineate=memory.cache(afni.Allineate),
+            mask_tool=memory.cache(afni.MaskTool),
+            catmatvec=memory.cache(afni.CatMatvec),
+            qwarp=memory.cache(afni.Qwarp),
+            nwarp_adjust=memory.cache(voxelwise['nwarp_adjust']),
+            nwarp_cat=memory.cache(afni.NwarpCat),
+            warp_apply=memory.cache(afni.NwarpApply))
+        for step_name, step in steps.items():
+            # XXX fix nipype bug with 'none'
+            if step_name not in ['clip_level', 'compute_mask',
+                                 'center_mass'] and (
+                    backend == 'afni' or step_name not in _NATIVE_STEPS):
+                step.interface().set_default_terminal_output(terminal_output)
+    else:
+        # New interfaces are created at each call, as with caching, so that
+        # the inputs of an animal are never reused for another one
+        if backend == 'afni':
+            voxelwise_kwargs = {'terminal_output': terminal_output}
+        else:
+            voxelwise_kwargs = {}
+        voxelwise = dict((step_name,
+                          _interface_run(interface, **voxelwise_kwargs))
+                         for step_name, interface in voxelwise.items())
+        steps = Bunch(
+            copy_file=voxelwise['copy_file'],
+            unifize=_interface_run(afni.Unifize,
+                                   terminal_output=terminal_output),
+            # XXX fix nipype bug with 'none'
+            clip_level=_interface_run(afni.ClipLevel),
+            compute_mask=_interface_run(compute_mask_interface),
+            calc=voxelwise['calc'],
+            # XXX fix nipype bug with 'none'
+            center_mass=_interface_run(afni.CenterMass),
+            refit=voxelwise['refit'],
+            tcat=voxelwise['tcat'],
+            tstat=voxelwise['tstat'],
+            undump=voxelwise['undump'],
+            resample=_interface_run(afni.Resample,
+                                    terminal_output=terminal_output),
+            allineate=_interface_run(afni.Allineate,
+                                     terminal_output=terminal_output),
+            mask_tool=_interface_run(afni.MaskTool,
+                                     terminal_output=terminal_output),
+            catmatvec=_interface_run(afni.CatMatvec,
+                                     terminal_output=terminal_output),
+            qwarp=_interface_run(afni.Qwarp, terminal_output=terminal_output),
+            nwarp_adjust=voxelwise['nwarp_adjust'],
+            nwarp_cat=_interface_run(afni.NwarpCat,
+                                     terminal_output=terminal_output),
+            warp_apply=_interface_run(afni.NwarpApply,
+                                      terminal_output=terminal_output))
+
+    if backend == 'afni':
+        steps['nwarp_adjust'] = _copy_and_adjust(steps['nwarp_adjust'])
+
+    environ = thread_environ(environ, n_jobs=n_jobs)
+    if environ:
+        for step_name in steps:
+            if step_name != 'compute_mask':
+                steps[step_name] = _with_inputs(steps[step_name],
+                                                environ=environ)
+
+    return steps
+
+
+def _template_change(previous_template_file, template_file, mask_file):
+    """ Returns the root mean square difference between the two templates
+    within the mask, relative to the root mean square of the previous
+    template.
+    """
+    mask = nibabel.load(mask_file).get_data() > 0
+    previous_template = nibabel.load(previous_template_file).get_data()
+    previous_template = previous_template[mask].astype(float)
+    template = nibabel.load(template_file).get_data()[mask].astype(float)
+    return np.sqrt(np.mean((template - previous_template) ** 2) /
+                   np.mean(previous_template ** 2))
+
+
+def _mean_anats(in_files, out_file):
+    """ Computes the voxelwise mean of images on the same grid by reading
+    each one once, without stacking them, and saves it with the geometry of
+    the first image.
+    """
+    for n, in_file in enumerate(in_files):
+        data = nibabel.load(in_file).get_fdata()
+        if n == 0:
+            mean = data
+        else:
+            mean += (data - mean) / (n + 1.)
+
+    _save_like(mean.astype(np.float32), nibabel.load(in_files[0]), out_file)
+    return out_file
+
+
+_TEMPLATE_AVERAGES = ['mean', 'median', 'trimmed_mean']
+
+# Fraction of the animals discarded at each end for the trimmed mean
+_TRIM_PROPORTION = .1
+
+
+def _average_anats(in_files, out_file, template_average='mean',
+                   memory_limit=512):
+    """ Computes the voxelwise average of images on the same grid and saves
+    it with the geometry of the first image.
+
+    Parameters
+    ----------
+    in_files : list of str
+        Paths to the images.
+
+    out_file : str
+        Path to the output average.
+
+    template_average : one of {'mean', 'median', 'trimmed_mean'}, optional
+        Voxelwise statistic across the images. The mean is computed by
+        streaming the images. The robust statistics are computed over slabs
+        of slices of all the images.
+
+    memory_limit : float, optional
+        Memory budget of the slabs, in megabytes.
+    """
+    if template_average not in _TEMPLATE_AVERAGES:
+        raise ValueError(
+            'Template average must be one of {0}, you entered {1}'.format(
+                _TEMPLATE_AVERAGES, template_average))
+
+    if template_average == 'mean':
+        return _mean_anats(in_files, out_file)
+
+    imgs = [nibabel.load(in_file) for in_file in in_files]
+    shape = imgs[0].shape[:3]
+    slice_bytes = len(imgs) * shape[0] * shape[1] * 8
+    n_slices = max(1, int(memory_limit * 1024 ** 2 // slice_bytes))
+    n_trimmed = int(_TRIM_PROPORTION * len(imgs))
+    average = np.zeros(shape, dtype=np.float32)
+    for start in range(0, shape[2], n_slices):
+        stop = min(start + n_slices, shape[2])
+        slab = np.empty((len(imgs),) + shape[:2] + (stop - start,))
+        for n, img in enumerate(imgs):
+            slab[n] = img.dataobj[:, :, start:stop]
+        if template_average == 'median':
+            average[..., start:stop] = np.median(slab, axis=0)
+        else:
+            slab.sort(axis=0)
+            average[..., start:stop] = slab[
+                n_trimmed:len(imgs) - n_trimmed].mean(axis=0)
+
+    _save_like(average, imgs[0], out_file)
+    return out_file
+
+
+def _select_subset(n_animals, subset_size, strata=None, random_state=None):
+    """ Returns the sorted indices of a random subset of the animals. The
+    animals are drawn within each stratum, proportionally to its size.
+    """
+    rng = check_random_state(random_state)
+    if strata is None:
+        strata = np.zeros(n_animals)
+    strata = np.asarray(strata)
+    if len(strata) != n_animals:
+        raise ValueError('One stratum per animal is required, you entered '
+                         '{0} strata for {1} animals'.format(len(strata),
+                                                            n_animals))
+
+    labels, stratum_sizes = np.unique(strata, return_counts=True)
+    # Allocate the subset to the strata by the largest remainder method
+    shares = subset_size * stratum_sizes / float(n_animals)
+    counts = np.floor(shares).astype(int)
+    remainders_order = np.argsort(counts - shares, kind='mergesort')
+    counts[remainders_order[:subset_size - counts.sum()]] += 1
+
+    indices = []
+    for label, count in zip(labels, counts):
+        stratum_indices = np.where(strata == label)[0]
+        indices.extend(rng.choice(stratum_indices, count, replace=False))
+
+    return sorted(int(index) for index in indices)
+
+
+def _copy_anat(n, anat_file, write_dir, steps, verbosity_kwargs):
+    """ Copies the image to write_dir, with the animal number as suffix.
+    """
+    suffixed_file = fname_presuffix(anat_file, suffix='_{}'.format(n))
+    out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
+    out_copy = steps.copy_file(in_file=anat_file, out_file=out_file,
+                               **verbosity_kwargs)
+    return out_copy.outputs.out_file
+
+
+def _center_anat(anat_file, master_file, brain_volume, write_dir, steps,
+                 unifize_kwargs, brain_masking_unifize_kwargs):
+    """ Bias corrects the head image, extracts its brain and places the brain
+    center of mass at the center of the master grid.
+
+    Returns
+    -------
+    centered_brain_file, centered_head_file : str
+        Paths to the centered brain and head images.
+
+    center : tuple of float
+        Brain center of mass of the image, in DICOM coordinates.
+    """
+    # bias correction for images to be used for brain mask creation
+    out_unifize = steps.unifize(in_file=anat_file,
+                                out_file=os.path.join(
+                                    write_dir,
+                                    '%s_Unifized_for_brain_masking'),
+                                outputtype='NIFTI_GZ',
+                                **brain_masking_unifize_kwargs)
+    brain_masking_in_file = out_unifize.outputs.out_file
+
+    # brain mask creation
+    out_clip_level = steps.clip_level(in_file=brain_masking_in_file)
+    out_compute_mask = steps.compute_mask(
+        in_file=brain_masking_in_file,
+        out_file=fname_presuffix(brain_masking_in_file, suffix='_mask'),
+        volume_threshold=brain_volume,
+        intensity_threshold=int(out_clip_level.outputs.clip_val))
+    brain_mask_file = out_compute_mask.outputs.out_file
+
+    # bias correction for images to be both brain-extracted with the mask
+    # generated above and then passed on to the rest of the pipeline
+    out_unifize = steps.unifize(in_file=anat_file,
+                                out_file=os.path.join(
+                                    write_dir,
+                                    '%s_Unifized_for_brain_extraction'),
+                                outputtype='NIFTI_GZ',
+                                **unifize_kwargs)
+    unifized_file = out_unifize.outputs.out_file
+
+    # extract brain and set NIfTI image center (as defined in the header)
+    # to the brain CoM
+    out_calc_mask = steps.calc(in_file_a=unifized_file,
+                               in_file_b=brain_mask_file,
+                               expr='a*b',
+                               out_file=fname_presuffix(unifized_file,
+                                                        suffix='_calc',
+                                                        newpath=write_dir),
+                               outputtype='NIFTI_GZ')
+    out_center_mass = steps.center_mass(
+        in_file=out_calc_mask.outputs.out_file,
+        cm_file=fname_presuffix(unifized_file, suffix='_cm.txt',
+                                use_ext=False),
+        set_cm=(0, 0, 0))
+    brain_file = out_center_mass.outputs.out_file
+
+    # apply center change to head file too
+    out_refit = steps.refit(in_file=unifized_file, duporigin_file=brain_file)
+    head_file = out_refit.outputs.out_file
+
+    # shift brain and head to place their new centers at the same central
+    # position
+    out_resample = steps.resample(in_file=brain_file,
+                                  resample_mode='Cu',
+                                  master=master_file,
+                                  out_file=fname_presuffix(
+                                      brain_file, suffix='_resample',
+                                      newpath=write_dir),
+                                  outputtype='NIFTI_GZ')
+    centered_brain_file = out_resample.outputs.out_file
+    out_resample = steps.resample(in_file=head_file,
+                                  resample_mode='Cu',
+                                  master=master_file,
+                                  out_file=fname_presuffix(
+                                      head_file, suffix='_resample',
+                                      newpath=write_dir),
+                                  outputtype='NIFTI_GZ')
+    return (centered_brain_file, out_resample.outputs.out_file,
+            out_center_mass.outputs.cm[0])
+
+
+def _rigid_register_anat(centered_brain_file, centered_head_file,
+                         reference_file, write_dir, steps, convergence,
+                         blur_radius_coarse, verbosity_quietness_kwargs):
+    """ Rigid-body registers the centered brain to the reference and applies
+    the transform to the centered head.
+
+    Returns
+    -------
+    rigid_transform_file, shift_rotated_brain_file, shift_rotated_head_file
+        Paths to the transform and to the registered brain and head.
+    """
+    suffixed_matrix = fname_presuffix(centered_brain_file,
+                                      suffix='_shr.aff12.1D',
+                                      use_ext=False)
+    out_matrix = os.path.join(write_dir, os.path.basename(suffixed_matrix))
+    out_allineate = steps.allineate(
+        in_file=centered_brain_file,
+        reference=reference_file,
+        out_matrix=out_matrix,
+        convergence=convergence,
+        two_blur=blur_radius_coarse,
+        warp_type='shift_rotate',
+        out_file=fname_presuffix(centered_brain_file, suffix='_shr'),
+        **verbosity_quietness_kwargs)
+    rigid_transform_file = out_allineate.outputs.out_matrix
+    shift_rotated_brain_file = out_allineate.outputs.out_file
+
+    # application to the head image
+    suffixed_file = fname_presuffix(centered_head_file, suffix='_shr')
+    out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
+    out_allineate = steps.allineate(
+        in_file=centered_head_file,
+        master=reference_file,
+        in_matrix=rigid_transform_file,
+        out_file=out_file,
+        **verbosity_quietness_kwargs)
+    return (rigid_transform_file, shift_rotated_brain_file,
+            out_allineate.outputs.out_file)
+
+
+def _affine_register_anat(shift_rotated_head_file, rigid_transform_file,
+                          centered_brain_file, centered_head_file,
+                          reference_file, weight_file, write_dir, steps,
+                          convergence, blur_radius_coarse,
+                          verbosity_quietness_kwargs):
+    """ Affine registers the rigid-body registered head to the reference,
+    concatenates the rigid-body and affine transforms and applies the result
+    to the centered brain and head.
+
+    Returns
+    -------
+    affine_transform_file, allineated_brain_file, allineated_head_file
+        Paths to the catenated transform and to the registered brain and
+        head.
+    """
+    weight_kwargs = {}
+    if weight_file is not None:
+        weight_kwargs['weight'] = weight_file
+
+    out_allineate = steps.allineate(
+        in_file=shift_rotated_head_file,
+        reference=reference_file,
+        out_matrix=fname_presuffix(shift_rotated_head_file,
+                                   suffix='_affine.aff12.1D',
+                                   use_ext=False),
+        convergence=convergence,
+        two_blur=blur_radius_coarse,
+        one_pass=True,
+        out_file=fname_presuffix(shift_rotated_head_file,
+                                 suffix='_affine'),
+        **dict(weight_kwargs, **verbosity_quietness_kwargs))
+    # matrix concatenation
+    suffixed_matrix = fname_presuffix(shift_rotated_head_file,
+                                      suffix='_affine_catenated.aff12.1D',
+                                      use_ext=False)
+    catmatvec_out_file = os.path.join(write_dir,
+                                      os.path.basename(suffixed_matrix))
+    out_catmatvec = steps.catmatvec(
+        in_file=[(rigid_transform_file, 'ONELINE'),
+                 (out_allineate.outputs.out_matrix, 'ONELINE')],
+        out_file=catmatvec_out_file)
+    affine_transform_file = out_catmatvec.outputs.out_file
+
+    # application to brain
+    out_allineate = steps.allineate(
+        in_file=centered_brain_file,
+        master=reference_file,
+        in_matrix=affine_transform_file,
+        out_file=fname_presuffix(centered_brain_file,
+                                 suffix='_shr_affine_catenated'),
+        **verbosity_quietness_kwargs)
+    allineated_brain_file = out_allineate.outputs.out_file
+
+    # application to head
+    suffixed_file = fname_presuffix(centered_head_file,
+                                    suffix='_shr_affine_catenated')
+    out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
+    out_allineate = steps.allineate(
+        in_file=centered_head_file,
+        master=reference_file,
+        in_matrix=affine_transform_file,
+        out_file=out_file,
+        **verbosity_quietness_kwargs)
+    return (affine_transform_file, allineated_brain_file,
+            out_allineate.outputs.out_file)
+
+
+def _init_warp_anat(affine_transform_file, centered_head_file, steps):
+    """ Transforms the affine transform to a warp, for initializing the
+    non-linear registration.
+    """
+    out_nwarp_cat = steps.nwarp_cat(
+        in_files=[('IDENT', centered_head_file), affine_transform_file],
+        out_file=fname_presuffix(centered_head_file, suffix='_iniwarp'))
+    return out_nwarp_cat.outputs.out_file
+
+
+def _warp_anat(warp_file, centered_head_file, base_file, weight_file,
+               inilev, n_iter, steps, **qwarp_kwargs):
+    """ Non-linearly registers the centered head to the base, initialized
+    with the given warp.
+
+    Returns
+    -------
+    warped_file, warp_file : str
+        Paths to the warped head and to the warp.
+    """
+    out_file = fname_presuffix(centered_head_file,
+                               suffix='_warped{}'.format(n_iter))
+    if weight_file is not None:
+        qwarp_kwargs['weight'] = weight_file
+
+    out_qwarp = steps.qwarp(
+        in_file=centered_head_file,
+        base_file=base_file,
+        noneg=True,
+        iwarp=True,
+        iniwarp=[warp_file],
+        inilev=inilev,
+        out_file=out_file,
+        **qwarp_kwargs)
+    return out_qwarp.outputs.warped_source, out_qwarp.outputs.source_warp
+
+
+def _downsample_anat(in_file, factor, write_dir, steps, resample_mode='Li'):
+    """ Resamples the image on a grid with voxels `factor` times larger.
+    """
+    zooms = nibabel.load(in_file).header.get_zooms()[:3]
+    suffixed_file = fname_presuffix(in_file,
+                                    suffix='_down{}'.format(factor))
+    out_resample = steps.resample(
+        in_file=in_file,
+        voxel_size=tuple(float(factor * zoom) for zoom in zooms),
+        resample_mode=resample_mode,
+        out_file=os.path.join(write_dir, os.path.basename(suffixed_file)),
+        outputtype='NIFTI_GZ')
+    return out_resample.outputs.out_file
+
+
+def _regrid_anat(in_file, master_file, suffix, write_dir, steps):
+    """ Linearly resamples the image or the warp on the grid of the master.
+    """
+    suffixed_file = fname_presuffix(in_file, suffix=suffix)
+    out_resample = steps.resample(
+        in_file=in_file,
+        master=master_file,
+        resample_mode='Li',
+        out_file=os.path.join(write_dir, os.path.basename(suffixed_file)),
+        outputtype='NIFTI_GZ')
+    return out_resample.outputs.out_file
+
+
+def _apply_warp_anat(centered_head_file, warp_file, master_file, suffix,
+                     write_dir, steps, verb_quietness_kwargs):
+    suffixed_file = fname_presuffix(centered_head_file, suffix=suffix)
+    out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
+    out_warp_apply = steps.warp_apply(
+        in_file=centered_head_file,
+        warp=warp_file,
+        master=master_file,
+        out_file=out_file,
+        **verb_quietness_kwargs)
+    return out_warp_apply.outputs.out_file
+
+
+def _apply_affine_anat(centered_head_file, transform_file, master_file,
+                       suffix, write_dir, steps, verbosity_quietness_kwargs):
+    suffixed_file = fname_presuffix(centered_head_file, suffix=suffix)
+    out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
+    out_allineate = steps.allineate(
+        in_file=centered_head_file,
+        master=master_file,
+        in_matrix=transform_file,
+        out_file=out_file,
+        **verbosity_quietness_kwargs)
+    return out_allineate.outputs.out_file
 
 
 def anats_to_common(anat_filenames, write_dir, brain_volume,
@@ -16,7 +625,13 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
                     nonlinear_weight_file=None,
                     convergence=0.005, blur_radius_coarse=1.1,
                     caching=False, verbose=1,
-                    unifize_kwargs=None, brain_masking_unifize_kwargs=None):
+                    unifize_kwargs=None, brain_masking_unifize_kwargs=None,
+                    n_jobs=1, plugin=None, resume=False,
+                    template_convergence=None, crop_margin=None,
+                    nonlinear_downsampling_factors=None,
+                    nonlinear_subset=None, nonlinear_subset_strata=None,
+                    random_state=None, backend='afni', qc_stacks=True,
+                    template_average='mean', average_memory_limit=512):
     """ Create common template from native anatomical images and achieve
     their registration to it.
 
@@ -74,6 +689,95 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
         Is passed to nipype.interfaces.afni.Unifize, to tune
         the seperate bias correction step done prior to brain masking.
 
+    n_jobs : int, optional
+        Number of animals processed in parallel for the per-animal steps.
+        Steps computing a mean across animals wait for all the animals.
+        -1 means all CPUs.
+
+    plugin : str or None, optional
+        If not None, the pipeline is built as a nipype workflow with one node
+        per animal and step, and run with this nipype execution plugin,
+        typically 'MultiProc'. Each step then starts as soon as its own inputs
+        are computed, and the outputs are saved within the workflow directory
+        `write_dir/anats_to_common`. For the 'MultiProc' plugin, n_jobs sets
+        the number of processes. Nipype workflows always cache their outputs,
+        whatever the value of `caching`.
+
+    resume : bool, optional
+        If True, the completed stages and nonlinear iterations are recorded
+        with their outputs in `write_dir/anats_to_common_manifest.json`. A
+        rerun with the same parameters and inputs skips the recorded stages
+        whose outputs are unchanged, and restarts at the first unfinished one.
+        Existing AFNI outputs are overwritten. Ignored if `plugin` is given.
+
+    template_convergence : float or None, optional
+        If not None, the remaining nonlinear iterations are skipped once the
+        relative template change falls below this value. The change is the
+        root mean square difference between successive templates within the
+        nonlinear weight mask, relative to the root mean square of the
+        previous template. Ignored if `plugin` is given.
+
+    crop_margin : float or None, optional
+        If not None, the centered images are cropped to the bounding box of
+        all the centered brains, extended by this margin in mm, and the
+        rigid, affine and nonlinear registrations are computed on the cropped
+        images. The transforms are then mapped back to the whole grid of the
+        centered heads, on which the registered images and the template are
+        computed. A user `nonlinear_weight_file` is cropped the same way.
+        Ignored if `plugin` is given.
+
+    nonlinear_downsampling_factors : list of int or None, optional
+        Downsampling factors of the images for each nonlinear warping
+        iteration, one per element of `nonlinear_levels`. For instance,
+        [4, 2, 1] runs the first iteration on images with 4 times larger
+        voxels, the second on images with 2 times larger voxels and the last
+        one at full resolution. The warps of each iteration are resampled to
+        initialize the next one. The minimal patches iterations always run at
+        full resolution. If None, all iterations run at full resolution.
+        Ignored if `plugin` is given.
+
+    nonlinear_subset : float, int or None, optional
+        If not None, the nonlinear iterations of `nonlinear_levels` build the
+        template from a random subset of the animals, given by its fraction
+        of the animals if float or by its number of animals if int. The
+        remaining animals join at the first `nonlinear_minimal_patches`
+        iteration, starting from their affine transforms. At least 5 animals
+        are required in the subset. Ignored if `plugin` is given.
+
+    nonlinear_subset_strata : list or None, optional
+        Stratum label of each animal, for instance its group or sex. If
+        given, the animals of `nonlinear_subset` are drawn within each stratum
+        in proportion to its size.
+
+    random_state : int, RandomState instance or None, optional
+        Seed or random number generator used to draw `nonlinear_subset`.
+
+    backend : one of {'afni', 'native'}, optional
+        Backend of the trivial voxelwise steps (3dcalc, 3dTstat mean,
+        3dTcat, 3dcopy, 3dUndump and 3drefit origin changes) and of the
+        warps adjustment (3dNwarpAdjust). With 'native', they run in-process
+        with nibabel and NumPy, avoiding a subprocess and a compressed file
+        round trip per step, and the warps adjustment reads one warp at a
+        time, so that its memory use does not grow with the number of
+        animals. Registration steps always use AFNI. Ignored if `plugin` is
+        given.
+
+    qc_stacks : bool, optional
+        If True, the images of each stage are concatenated into 4D quality
+        check movies. The stage means are computed by streaming the images
+        in any case.
+
+    template_average : one of {'mean', 'median', 'trimmed_mean'}, optional
+        Voxelwise statistic used for the rigid and affine templates and the
+        quality check averages. The trimmed mean discards the 10% lowest
+        and highest values of each voxel. The nonlinear templates are always
+        the mean computed by the warps adjustment. Ignored if `plugin` is
+        given.
+
+    average_memory_limit : float, optional
+        Memory budget in megabytes of the median and trimmed mean, which are
+        computed over slabs of all the images.
+
     Returns
     -------
     data : sklearn.datasets.base.Bunch
@@ -85,6 +789,18 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
         - `transforms` : list of str.
                          Paths to the transforms from the raw
                          images to the registered images.
+        - `template` : str.
+                       Path to the template head.
+        - `centered` : list of str.
+                       Paths to the bias corrected and centered
+                       heads, the transforms apply to.
+        - `centers` : list of list of float.
+                      Brain centers of mass of the raw images in DICOM
+                      coordinates, moved to the origin by the centering.
+        - `template_changes` : list of float.
+                               Relative template change at each
+                               nonlinear iteration, for nonlinear
+                               registration only.
                          
     Notes
     -----
@@ -120,239 +836,275 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
         raise ValueError(
             'Registration kind must be one of {0}, you entered {1}'.format(
                 registration_kinds, registration_kind))
+
+    if template_average not in _TEMPLATE_AVERAGES:
+        raise ValueError(
+            'Template average must be one of {0}, you entered {1}'.format(
+                _TEMPLATE_AVERAGES, template_average))
                 
     if registration_kind is 'nonlinear' and len(anat_filenames) < 5:
         raise ValueError('At least 5 input files are required to make a ' 
                          'template by non-linear \n registration. Only ' 
                          '{0} have been provided.'.format(len(anat_filenames)))
 
-    if use_rats_tool:
-        if segmentation.interfaces.Info().version() is None:
-            raise ValueError('Can not locate RATS')
-        else:
-            ComputeMask = segmentation.MathMorphoMask
-    else:
-        ComputeMask = segmentation.HistogramMask
-
-    if verbose:
-        terminal_output = 'stream'
-        verbosity_kwargs = {'verbose': verbose > 1}
-        quietness_kwargs = {}
-        verb_quietness_kwargs = {'verb': verbose > 2}
-        verbosity_quietness_kwargs = {'verbose': verbose > 2}
-    else:
-        terminal_output = 'none'
-        verbosity_kwargs = {}
-        quietness_kwargs = {'quiet': True}
-        verb_quietness_kwargs = {'quiet': True}
-        verbosity_quietness_kwargs = {'quiet': True}
+    if nonlinear_levels is None:
+        nonlinear_levels = [1, 2, 3]
 
-    if caching:
-        memory = Memory(write_dir)
-        copy = memory.cache(afni.Copy)
-        unifize = memory.cache(afni.Unifize)
-        clip_level = memory.cache(afni.ClipLevel)
-        compute_mask = memory.cache(ComputeMask)
-        calc = memory.cache(afni.Calc)
-        center_mass = memory.cache(afni.CenterMass)
-        refit = memory.cache(afni.Refit)
-        refit2 = memory.cache(afni.Refit)
-        tcat = memory.cache(afni.TCat)
-        tstat = memory.cache(afni.TStat)
-        undump = memory.cache(afni.Undump)
-        resample = memory.cache(afni.Resample)
-        allineate = memory.cache(afni.Allineate)
-        allineate2 = memory.cache(afni.Allineate)
-        mask_tool = memory.cache(afni.MaskTool)
-        catmatvec = memory.cache(afni.CatMatvec)
-        qwarp = memory.cache(afni.Qwarp)
-        qwarp2 = memory.cache(afni.Qwarp)  # workaround to initialize inputs
-        nwarp_adjust = memory.cache(afni.NwarpAdjust)
-        nwarp_cat = memory.cache(afni.NwarpCat)
-        warp_apply = memory.cache(afni.NwarpApply)
-        for step in [copy, unifize, calc, refit, refit2,
-                     tcat, tstat, undump, resample, allineate, allineate2,
-                     mask_tool, catmatvec, qwarp, nwarp_cat, warp_apply,
-                     nwarp_adjust]:
-            step.interface().set_default_terminal_output(terminal_output)
+    if nonlinear_downsampling_factors is None:
+        nonlinear_downsampling_factors = [1] * len(nonlinear_levels)
+    elif len(nonlinear_downsampling_factors) != len(nonlinear_levels):
+        raise ValueError(
+            'One downsampling factor per nonlinear level is required, you '
+            'entered {0} for levels {1}'.format(
+                nonlinear_downsampling_factors, nonlinear_levels))
+
+    subset_indices = list(range(len(anat_filenames)))
+    if nonlinear_subset is not None and registration_kind == 'nonlinear':
+        if isinstance(nonlinear_subset, float):
+            subset_size = int(round(nonlinear_subset * len(anat_filenames)))
+        else:
+            subset_size = nonlinear_subset
+        if subset_size < 5 or subset_size > len(anat_filenames):
+            raise ValueError(
+                'The nonlinear subset must contain between 5 and {0} '
+                'animals, you entered {1}'.format(len(anat_filenames),
+                                                  nonlinear_subset))
+        if not nonlinear_minimal_patches:
+            raise ValueError('Minimal patches iterations are required for '
+                             'the animals out of the nonlinear subset')
+        subset_indices = _select_subset(len(anat_filenames), subset_size,
+                                        strata=nonlinear_subset_strata,
+                                        random_state=random_state)
+
+    ComputeMask = _get_compute_mask_interface(use_rats_tool)
+    (terminal_output, verbosity_kwargs, quietness_kwargs,
+     verb_quietness_kwargs, verbosity_quietness_kwargs) = \
+        _get_verbosity_kwargs(verbose)
+
+    if plugin is not None:
+        workflow, outputs = _create_anats_to_common_workflow(
+            anat_filenames, write_dir, brain_volume, ComputeMask,
+            registration_kind=registration_kind,
+            nonlinear_levels=nonlinear_levels,
+            nonlinear_minimal_patches=nonlinear_minimal_patches,
+            nonlinear_weight_file=nonlinear_weight_file,
+            convergence=convergence, blur_radius_coarse=blur_radius_coarse,
+            verbose=verbose, terminal_output=terminal_output,
+            verbosity_kwargs=verbosity_kwargs,
+            verb_quietness_kwargs=verb_quietness_kwargs,
+            verbosity_quietness_kwargs=verbosity_quietness_kwargs,
+            unifize_kwargs=dict(unifize_kwargs or {}, **quietness_kwargs),
+            brain_masking_unifize_kwargs=dict(
+                brain_masking_unifize_kwargs or {}, **quietness_kwargs))
+        outputs = _run_workflow(workflow, outputs, plugin=plugin,
+                                n_jobs=n_jobs)
+        return Bunch(registered=outputs['registered'],
+                     transforms=outputs['transforms'],
+                     template=outputs['template'][0],
+                     centered=outputs['centered'],
+                     centers=[list(cm[0]) for cm in outputs['centers']])
+
+    # All the outputs are given absolute paths, so that the working
+    # directory of the process is never changed
+    write_dir = os.path.abspath(write_dir)
+    if resume:
+        environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+        parameters_hash = hash_parameters(
+            {'anat_filenames': list(anat_filenames),
+             'brain_volume': brain_volume,
+             'registration_kind': registration_kind,
+             'use_rats_tool': use_rats_tool,
+             'nonlinear_levels': nonlinear_levels,
+             'nonlinear_minimal_patches': nonlinear_minimal_patches,
+             'nonlinear_weight_file': nonlinear_weight_file,
+             'convergence': convergence,
+             'blur_radius_coarse': blur_radius_coarse,
+             'unifize_kwargs': unifize_kwargs,
+             'brain_masking_unifize_kwargs': brain_masking_unifize_kwargs,
+             'crop_margin': crop_margin,
+             'nonlinear_downsampling_factors':
+                 nonlinear_downsampling_factors,
+             'subset_indices': subset_indices,
+             'template_average': template_average,
+             'backend': backend})
+        manifest = RunManifest(
+            os.path.join(write_dir, 'anats_to_common_manifest.json'),
+            parameters_hash, verbose=verbose)
     else:
-        copy = afni.Copy(terminal_output=terminal_output).run
-        unifize = afni.Unifize(terminal_output=terminal_output).run
-        clip_level = afni.ClipLevel().run  # XXX fix nipype bug with 'none'
-        compute_mask = ComputeMask().run
-        calc = afni.Calc(terminal_output=terminal_output).run
-        center_mass = afni.CenterMass().run  # XXX fix nipype bug with 'none'
-        refit = afni.Refit(terminal_output=terminal_output).run
-        refit2 = afni.Refit(terminal_output=terminal_output).run
-        tcat = afni.TCat(terminal_output=terminal_output).run
-        tstat = afni.TStat(terminal_output=terminal_output).run
-        undump = afni.Undump(terminal_output=terminal_output).run
-        resample = afni.Resample(terminal_output=terminal_output).run
-        allineate = afni.Allineate(terminal_output=terminal_output).run
-        allineate2 = afni.Allineate(terminal_output=terminal_output).run
-        mask_tool = afni.MaskTool(terminal_output=terminal_output).run
-        catmatvec = afni.CatMatvec(terminal_output=terminal_output).run
-        qwarp = afni.Qwarp(terminal_output=terminal_output).run
-        qwarp2 = afni.Qwarp(terminal_output=terminal_output).run
-        nwarp_cat = afni.NwarpCat(terminal_output=terminal_output).run
-        warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
-        nwarp_adjust = afni.NwarpAdjust(terminal_output=terminal_output).run
-
-    current_dir = os.getcwd()
-    os.chdir(write_dir)
-
-    ###########################################################################
-    # First copy anatomical files to make sure the originals are never changed
-    # and they have different names across individuals. Then produce a video of
-    # this raw data and a mean
-    copied_anat_filenames = []
-    for n, anat_file in enumerate(anat_filenames):
-        suffixed_file = fname_presuffix(anat_file, suffix='_{}'.format(n))
-        out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
-        out_copy = copy(in_file=anat_file, out_file=out_file,
-                        **verbosity_kwargs)
-        copied_anat_filenames.append(out_copy.outputs.out_file)
-
-
-    out_tcat = tcat(in_files=copied_anat_filenames,
-                    out_file=os.path.join(write_dir, 'raw_heads.nii.gz'),
-                    outputtype='NIFTI_GZ', **verbosity_kwargs)
-    out_tstat = tstat(in_file=out_tcat.outputs.out_file, outputtype='NIFTI_GZ')
+        environ = None
+        manifest = None
+
+    steps = _get_template_steps(ComputeMask, write_dir, caching=caching,
+                                terminal_output=terminal_output,
+                                environ=environ, backend=backend,
+                                n_jobs=n_jobs)
+    tcat = steps.tcat
+    undump = steps.undump
+    refit = steps.refit
+    mask_tool = steps.mask_tool
+    nwarp_adjust = steps.nwarp_adjust
+
+    def average(in_files, stack_name):
+        # Quality check movie and mean of the images. The mean is named after
+        # the movie, as when computed by 3dTstat.
+        stack_file = os.path.join(write_dir, stack_name)
+        if qc_stacks:
+            tcat(in_files=in_files, out_file=stack_file, **verbosity_kwargs)
+        return _average_anats(in_files,
+                              fname_presuffix(stack_file, suffix='_tstat'),
+                              template_average=template_average,
+                              memory_limit=average_memory_limit)
 
-    ###########################################################################
-    # Bias correct and register using center of mass
-    # -----------------------------
-    # An initial coarse registration is done using brain centre of mass (CoM).
-    #
-    # First we loop through anatomical scans and correct intensities for bias. 
-    # This is done twice with parameters that can be set differently: once to 
-    # create an image for automatic brain mask generation, and a another time 
-    # for the image that will actually have its brain extracted by this mask and 
-    # also be passed on to the rest of the function. This separation is useful
-    # because in some circumstances the ideal bias correction can create zones 
-    # of signal and noise that confuse the brain masker, so it is best if that 
-    # calculation is performed on a differently-corrected image. In a lot(most?) 
-    # cases, the same parameters can be used for both bias correctors (the 
-    # default) as though the correction was only ever done once.
-    #
-    # Second, image centers are redefined based on the CoM of brains extracted 
-    # by the brain masks. The images are then translated to force the new 
-    # centers to all be at the same position: the center of the image matrix. 
-    # This is a crude form of translation-only registration amongst images that 
-    # simultaneously shifts the position of all brains to being in the centre of 
-    # the image if this was not already the case (which it often is not in small 
-    # mammal head imaging where the brain is usually in the upper half).
-    #
-    # Note that the heads created at the end will be the start point for all 
-    # subsequent transformations (meaning any transformation generated from now
-    # on will be a concatenation of itself and previous ones for direct 
-    # application to CoM-registered heads). This avoids the accumulation of 
-    # reslice error from one registration to the next. Ideally, the start point 
-    # should be the bias-corrected images prior to center correction (which 
-    # itself involes reslicing). However, I have not yet figured out the best 
-    # way to convert CoM change into an affine transform and then use it. The 
-    # conversion should be relatively easy, using nibabel to extract the two 
-    # affines then numpy to calculate the difference. Using it is not so simple. 
-    # Unlike 3dQwarp, 3dAllineate does not have a simple initialization flag. 
-    # Instead, it is necessary to use -parini to initialize any given affine 
-    # parameter individually. However, -parini can be overidden by other flags, 
-    # so careful checks need to be made to ensure that this will never happen 
-    # with the particular command or set of commands used here.
-    
-    # bias correction for images to be used for brain mask creation
     if brain_masking_unifize_kwargs is None:
         brain_masking_unifize_kwargs = {}
     brain_masking_unifize_kwargs.update(quietness_kwargs)
-    brain_masking_in_files = []
-    for n, anat_file in enumerate(copied_anat_filenames):
-        out_unifize = unifize(in_file=anat_file,
-                              out_file='%s_Unifized_for_brain_masking',
-                              outputtype='NIFTI_GZ',
-                              **brain_masking_unifize_kwargs)
-        brain_masking_in_files.append(out_unifize.outputs.out_file)
-
-    # brain mask creation
-    brain_mask_files = []
-    for n, brain_masking_in_file in enumerate(brain_masking_in_files):
-        out_clip_level = clip_level(in_file=brain_masking_in_file)
-        out_compute_mask = compute_mask(
-            in_file=brain_masking_in_file,
-            out_file=fname_presuffix(brain_masking_in_file, suffix='_mask'),
-            volume_threshold=brain_volume,
-            intensity_threshold=int(out_clip_level.outputs.clip_val))
-        brain_mask_files.append(out_compute_mask.outputs.out_file)
-
-    # bias correction for images to be both brain-extracted with the mask 
-    # generated above and then passed on to the rest of the function
     if unifize_kwargs is None:
         unifize_kwargs = {}
 
     unifize_kwargs.update(quietness_kwargs)
-    unifized_files = []
-    for n, anat_file in enumerate(copied_anat_filenames):
-        out_unifize = unifize(in_file=anat_file,
-                              out_file='%s_Unifized_for_brain_extraction',
-                              outputtype='NIFTI_GZ',
-                              **unifize_kwargs)
-        unifized_files.append(out_unifize.outputs.out_file)
-
-    # extrcat brains and set NIfTI image center (as defined in the header) to 
-    # the brain CoM
-    brain_files = []
-    for (brain_mask_file, unifized_file) in zip(brain_mask_files,
-                                                unifized_files):
-        out_calc_mask = calc(in_file_a=unifized_file,
-                             in_file_b=brain_mask_file,
-                             expr='a*b',
-                             outputtype='NIFTI_GZ')
-        out_center_mass = center_mass(
-            in_file=out_calc_mask.outputs.out_file,
-            cm_file=fname_presuffix(unifized_file, suffix='_cm.txt',
-                                    use_ext=False),
-            set_cm=(0, 0, 0))
-        brain_files.append(out_center_mass.outputs.out_file)
-
-    # apply center change to head files too
-    head_files = []    
-    for unifized_file, brain_file in zip(unifized_files, brain_files):
-        out_refit = refit(in_file=unifized_file, duporigin_file=brain_file)
-        head_files.append(out_refit.outputs.out_file)
-
-    # create an empty template with a center at the image matrix center
-    out_undump = undump(in_file=out_tstat.outputs.out_file,
-                        out_file=os.path.join(write_dir, 'undump.nii.gz'),
-                        outputtype='NIFTI_GZ')
-    out_refit = refit2(in_file=out_undump.outputs.out_file,
-                       xorigin='cen', yorigin='cen', zorigin='cen')
-
-    # shift brains to place their new centers at the same central position. 
-    # make a quality check video and mean
-    centered_brain_files = []
-    for brain_file in brain_files:
-        out_resample = resample(in_file=brain_file,
-                                resample_mode='Cu',
-                                master=out_refit.outputs.out_file,
-                                outputtype='NIFTI_GZ')
-        centered_brain_files.append(out_resample.outputs.out_file)
-    out_tcat = tcat(in_files=centered_brain_files,
-                    out_file=os.path.join(write_dir, 'centered_brains.nii.gz'),
-                    **verbosity_kwargs)
-    out_tstat_centered_brain = tstat(in_file=out_tcat.outputs.out_file,
-                                     outputtype='NIFTI_GZ')
-    
-    # do the same for heads. is also a better quality check than the brain
-    centered_head_files = []
-    for head_file in head_files:
-        out_resample = resample(in_file=head_file,
-                                resample_mode='Cu',
-                                master=out_refit.outputs.out_file,
-                                outputtype='NIFTI_GZ')
-        centered_head_files.append(out_resample.outputs.out_file)
-    out_tcat = tcat(in_files=centered_head_files,
-                    out_file=os.path.join(write_dir, 'centered_heads.nii.gz'),
-                    **verbosity_kwargs)
-    out_tstat_centered_brain = tstat(in_file=out_tcat.outputs.out_file,
-                                     outputtype='NIFTI_GZ')
+
+    def center_stage():
+        #######################################################################
+        # First copy anatomical files to make sure the originals are never
+        # changed and they have different names across individuals. Then
+        # produce a video of this raw data and a mean
+        def copy_anat(n, anat_file):
+            return _copy_anat(n, anat_file, write_dir, steps,
+                              verbosity_kwargs)
+
+        copied_anat_filenames = _map_animals(copy_anat, n_jobs,
+                                             range(len(anat_filenames)),
+                                             anat_filenames)
+
+        raw_mean_file = average(copied_anat_filenames, 'raw_heads.nii.gz')
+
+        #######################################################################
+        # Bias correct and register using center of mass
+        # -----------------------------
+        # An initial coarse registration is done using brain centre of mass
+        # (CoM).
+        #
+        # First we loop through anatomical scans and correct intensities for
+        # bias. This is done twice with parameters that can be set
+        # differently: once to create an image for automatic brain mask
+        # generation, and a another time for the image that will actually
+        # have its brain extracted by this mask and also be passed on to the
+        # rest of the function. This separation is useful because in some
+        # circumstances the ideal bias correction can create zones of signal
+        # and noise that confuse the brain masker, so it is best if that
+        # calculation is performed on a differently-corrected image. In a
+        # lot(most?) cases, the same parameters can be used for both bias
+        # correctors (the default) as though the correction was only ever
+        # done once.
+        #
+        # Second, image centers are redefined based on the CoM of brains
+        # extracted by the brain masks. The images are then translated to
+        # force the new centers to all be at the same position: the center of
+        # the image matrix. This is a crude form of translation-only
+        # registration amongst images that simultaneously shifts the position
+        # of all brains to being in the centre of the image if this was not
+        # already the case (which it often is not in small mammal head
+        # imaging where the brain is usually in the upper half).
+        #
+        # Note that the heads created at the end will be the start point for
+        # all subsequent transformations (meaning any transformation
+        # generated from now on will be a concatenation of itself and
+        # previous ones for direct application to CoM-registered heads). This
+        # avoids the accumulation of reslice error from one registration to
+        # the next. Ideally, the start point should be the bias-corrected
+        # images prior to center correction (which itself involes
+        # reslicing). However, I have not yet figured out the best way to
+        # convert CoM change into an affine transform and then use it. The
+        # conversion should be relatively easy, using nibabel to extract the
+        # two affines then numpy to calculate the difference. Using it is not
+        # so simple. Unlike 3dQwarp, 3dAllineate does not have a simple
+        # initialization flag. Instead, it is necessary to use -parini to
+        # initialize any given affine parameter individually. However,
+        # -parini can be overidden by other flags, so careful checks need to
+        # be made to ensure that this will never happen with the particular
+        # command or set of commands used here.
+        #
+        # All these steps only depend on the animal itself and on the empty
+        # template, so they are chained per animal.
+
+        # create an empty template with a center at the image matrix center
+        out_undump = undump(in_file=raw_mean_file,
+                            out_file=os.path.join(write_dir, 'undump.nii.gz'),
+                            outputtype='NIFTI_GZ')
+        out_refit = refit(in_file=out_undump.outputs.out_file,
+                          xorigin='cen', yorigin='cen', zorigin='cen')
+        empty_template_file = out_refit.outputs.out_file
+
+        def center_anat(anat_file):
+            return _center_anat(anat_file, empty_template_file, brain_volume,
+                                write_dir, steps, unifize_kwargs,
+                                brain_masking_unifize_kwargs)
+
+        centered_files = _map_animals(center_anat, n_jobs,
+                                      copied_anat_filenames)
+        centered_brain_files = [files[0] for files in centered_files]
+        centered_head_files = [files[1] for files in centered_files]
+
+        # make a quality check video and mean
+        average(centered_brain_files, 'centered_brains.nii.gz')
+
+        # do the same for heads. is also a better quality check than the brain
+        centered_head_mean_file = average(centered_head_files,
+                                          'centered_heads.nii.gz')
+        return {'brains': centered_brain_files,
+                'heads': centered_head_files,
+                'centers': [list(files[2]) for files in centered_files],
+                'mean': centered_head_mean_file}
+
+    centered = run_stage(manifest, 'center', center_stage)
+    centered_brain_files = centered['brains']
+    centered_head_files = centered['heads']
+    whole_head_files = centered_head_files
+    centers = centered['centers']
+
+    ###########################################################################
+    # Optionally, the registrations are computed on the bounding box of the
+    # brains only, which avoids wasting time on the background. All the
+    # centered images share the same grid, so they are cropped to the same
+    # box and the affine transforms, expressed in world coordinates, are
+    # valid for the whole images.
+    if crop_margin is not None:
+        def crop_stage():
+            box = _get_crop_box(centered_brain_files, crop_margin)
+            cropped = {
+                'brains': [_crop(brain_file, box)
+                           for brain_file in centered_brain_files],
+                'heads': [_crop(head_file, box)
+                          for head_file in centered_head_files],
+                'weight': None}
+            if nonlinear_weight_file is not None:
+                cropped['weight'] = _crop(nonlinear_weight_file, box,
+                                          write_dir=write_dir)
+            return cropped
+
+        cropped = run_stage(manifest, 'crop', crop_stage)
+        centered_brain_files = cropped['brains']
+        centered_head_files = cropped['heads']
+        if nonlinear_weight_file is not None:
+            nonlinear_weight_file = cropped['weight']
+
+    def whole_grid_results(transform_files, suffix):
+        # Apply the transforms computed on the cropped images to the whole
+        # centered heads, and average them into the template
+        def apply_transform_anat(whole_head_file, transform_file):
+            return _apply_affine_anat(
+                whole_head_file, transform_file, whole_head_files[0], suffix,
+                write_dir, steps, verbosity_quietness_kwargs)
+
+        registered_files = _map_animals(apply_transform_anat, n_jobs,
+                                        whole_head_files, transform_files)
+        template_file = average(registered_files,
+                                'uncropped{}_heads.nii.gz'.format(suffix))
+        return Bunch(registered=registered_files,
+                     transforms=transform_files,
+                     template=template_file,
+                     centered=whole_head_files,
+                     centers=centers)
 
     ###########################################################################
     # At this point, we have achieved a translation-only registration of the 
@@ -371,59 +1123,40 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     # angles, it may be worth running this twice or even more (for which there 
     # is no current functionality), but we have never found a case that extreme 
     # so it is not implemented.
-    
-    # rigid-body registration
-    shift_rotated_brain_files = []
-    rigid_transform_files = []
-    for centered_brain_file in centered_brain_files:
-        suffixed_matrix = fname_presuffix(centered_brain_file,
-                                          suffix='_shr.aff12.1D',
-                                          use_ext=False)
-        out_matrix = os.path.join(write_dir, os.path.basename(suffixed_matrix))
-        out_allineate = allineate(
-            in_file=centered_brain_file,
-            reference=out_tstat_centered_brain.outputs.out_file,
-            out_matrix=out_matrix,
-            convergence=convergence,
-            two_blur=blur_radius_coarse,
-            warp_type='shift_rotate',
-            out_file=fname_presuffix(centered_brain_file, suffix='_shr'),
-            **verbosity_quietness_kwargs)
-        rigid_transform_files.append(out_allineate.outputs.out_matrix)
-        shift_rotated_brain_files.append(out_allineate.outputs.out_file)
-
-    # application to the head images
-    shift_rotated_head_files = []
-    for centered_head_file, rigid_transform_file in zip(centered_head_files,
-                                                        rigid_transform_files):
-        suffixed_file = fname_presuffix(centered_head_file, suffix='_shr')
-        out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
-        out_allineate = allineate2(
-            in_file=centered_head_file,
-            master=out_tstat_centered_brain.outputs.out_file,
-            in_matrix=rigid_transform_file,
-            out_file=out_file,
-            **verbosity_quietness_kwargs)
-        shift_rotated_head_files.append(out_allineate.outputs.out_file)
-
-    # quality check video and mean for head and brain
-    out_tcat = tcat(
-        in_files=shift_rotated_head_files,
-        out_file=os.path.join(write_dir, 'rigid_body_registered_heads.nii.gz'),
-        **verbosity_kwargs)
-    out_tstat_shr = tstat(in_file=out_tcat.outputs.out_file,
-                          outputtype='NIFTI_GZ')
-    out_tcat = tcat(
-        in_files=shift_rotated_brain_files,
-        out_file=os.path.join(write_dir, 'rigid_body_registered_brains.nii.gz'),
-        **verbosity_kwargs)
-    out_tstat_shr = tstat(in_file=out_tcat.outputs.out_file,
-                          outputtype='NIFTI_GZ')
+    def rigid_stage():
+        def rigid_register_anat(centered_brain_file, centered_head_file):
+            return _rigid_register_anat(
+                centered_brain_file, centered_head_file, centered['mean'],
+                write_dir, steps, convergence, blur_radius_coarse,
+                verbosity_quietness_kwargs)
+
+        rigid_outputs = _map_animals(rigid_register_anat, n_jobs,
+                                     centered_brain_files,
+                                     centered_head_files)
+        shift_rotated_brain_files = [outputs[1] for outputs in rigid_outputs]
+        shift_rotated_head_files = [outputs[2] for outputs in rigid_outputs]
+
+        # quality check video and mean for head and brain
+        shr_head_mean_file = average(shift_rotated_head_files,
+                                     'rigid_body_registered_heads.nii.gz')
+        shr_brain_mean_file = average(shift_rotated_brain_files,
+                                      'rigid_body_registered_brains.nii.gz')
+        return {'transforms': [outputs[0] for outputs in rigid_outputs],
+                'heads': shift_rotated_head_files,
+                'heads_mean': shr_head_mean_file,
+                'brains': shift_rotated_brain_files,
+                'brains_mean': shr_brain_mean_file}
+
+    rigid = run_stage(manifest, 'rigid', rigid_stage)
 
     if registration_kind == 'rigid':
-        os.chdir(current_dir)
-        return Bunch(registered=shift_rotated_head_files,
-                     transforms=rigid_transform_files)
+        if crop_margin is not None:
+            return whole_grid_results(rigid['transforms'], '_shr')
+        return Bunch(registered=rigid['heads'],
+                     transforms=rigid['transforms'],
+                     template=rigid['heads_mean'],
+                     centered=centered_head_files,
+                     centers=centers)
 
     ###########################################################################
     # Affine transform
@@ -439,88 +1172,53 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     #    the count mask, whose main purpose is to demonstrate variability in 
     #    brain size and extraction quality.
     # 3) There is an extra step for concatenation of transform results.
-    
-    # make the count mask
-    out_mask_tool = mask_tool(in_file=out_tcat.outputs.out_file,
-                              count=True,
-                              verbose=verbose,
-                              outputtype='NIFTI_GZ')
-
-    #affine transform
-    affine_transform_files = []
-    for shift_rotated_head_file, rigid_transform_file in zip(
-            shift_rotated_head_files, rigid_transform_files):
-        out_allineate = allineate(
-            in_file=shift_rotated_head_file,
-            reference=out_tstat_shr.outputs.out_file,
-            out_matrix=fname_presuffix(shift_rotated_head_file,
-                                       suffix='_affine.aff12.1D',
-                                       use_ext=False),
-            convergence=convergence,
-            two_blur=blur_radius_coarse,
-            one_pass=True,
-            weight=out_mask_tool.outputs.out_file,
-            out_file=fname_presuffix(shift_rotated_head_file,
-                                     suffix='_affine'),
-            **verbosity_quietness_kwargs)
-        # matrix concatenation
-        suffixed_matrix = fname_presuffix(shift_rotated_head_file,
-                                          suffix='_affine_catenated.aff12.1D',
-                                          use_ext=False)
-        catmatvec_out_file = os.path.join(write_dir,
-                                          os.path.basename(suffixed_matrix))
-        out_catmatvec = catmatvec(in_file=[(rigid_transform_file, 'ONELINE'),
-                                           (out_allineate.outputs.out_matrix,
-                                            'ONELINE')],
-                                  out_file=catmatvec_out_file)
-        affine_transform_files.append(out_catmatvec.outputs.out_file)
-
-    # application to brains
-    allineated_brain_files = []
-    for centered_brain_file, affine_transform_file in zip(
-            centered_brain_files, affine_transform_files):
-        out_allineate = allineate2(
-            in_file=centered_brain_file,
-            master=out_tstat_shr.outputs.out_file,
-            in_matrix=affine_transform_file,
-            out_file=fname_presuffix(centered_brain_file,
-                                     suffix='_shr_affine_catenated'),
-            **verbosity_quietness_kwargs)
-        allineated_brain_files.append(out_allineate.outputs.out_file)
-
-    # application to heads
-    allineated_head_files = []
-    for centered_head_file, affine_transform_file in zip(
-            centered_head_files, affine_transform_files):
-        suffixed_file = fname_presuffix(centered_head_file,
-                                        suffix='_shr_affine_catenated')
-        out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
-        out_allineate = allineate2(
-            in_file=centered_head_file,
-            master=out_tstat_shr.outputs.out_file,
-            in_matrix=affine_transform_file,
-            out_file=out_file,
-            **verbosity_quietness_kwargs)
-        allineated_head_files.append(out_allineate.outputs.out_file)
-
-    #quality check videos and template for head and brain
-    out_tcat_head = tcat(
-        in_files=allineated_head_files,
-        out_file=os.path.join(write_dir, 'affine_registered_heads.nii.gz'),
-        **verbosity_kwargs)
-    out_tstat_allineated_head = tstat(in_file=out_tcat_head.outputs.out_file,
-                                      outputtype='NIFTI_GZ')
-    out_tcat_brain = tcat(
-        in_files=allineated_brain_files,
-        out_file=os.path.join(write_dir, 'affine_registered_brains.nii.gz'),
-        **verbosity_kwargs)
-    out_tstat_allineated_brain = tstat(in_file=out_tcat_brain.outputs.out_file,
-                                       outputtype='NIFTI_GZ')
+    def affine_stage():
+        # make the count mask
+        out_mask_tool = mask_tool(in_file=rigid['brains'],
+                                  count=True,
+                                  out_file=os.path.join(
+                                      write_dir, 'rigid_body_registered_'
+                                                 'brains_mask.nii.gz'),
+                                  verbose=verbose,
+                                  outputtype='NIFTI_GZ')
+
+        def affine_register_anat(shift_rotated_head_file,
+                                 rigid_transform_file, centered_brain_file,
+                                 centered_head_file):
+            return _affine_register_anat(
+                shift_rotated_head_file, rigid_transform_file,
+                centered_brain_file, centered_head_file,
+                rigid['brains_mean'], out_mask_tool.outputs.out_file,
+                write_dir, steps, convergence, blur_radius_coarse,
+                verbosity_quietness_kwargs)
+
+        affine_outputs = _map_animals(affine_register_anat, n_jobs,
+                                      rigid['heads'],
+                                      rigid['transforms'],
+                                      centered_brain_files,
+                                      centered_head_files)
+        allineated_brain_files = [outputs[1] for outputs in affine_outputs]
+        allineated_head_files = [outputs[2] for outputs in affine_outputs]
+
+        #quality check videos and template for head and brain
+        allineated_head_mean_file = average(allineated_head_files,
+                                            'affine_registered_heads.nii.gz')
+        average(allineated_brain_files, 'affine_registered_brains.nii.gz')
+        return {'transforms': [outputs[0] for outputs in affine_outputs],
+                'heads': allineated_head_files,
+                'heads_mean': allineated_head_mean_file}
+
+    affine = run_stage(manifest, 'affine', affine_stage)
+    affine_transform_files = affine['transforms']
 
     if registration_kind == 'affine':
-        os.chdir(current_dir)
-        return Bunch(registered=allineated_head_files,
-                     transforms=affine_transform_files)
+        if crop_margin is not None:
+            return whole_grid_results(affine_transform_files, '_affine')
+        return Bunch(registered=affine['heads'],
+                     transforms=affine_transform_files,
+                     template=affine['heads_mean'],
+                     centered=centered_head_files,
+                     centers=centers)
 
     ###########################################################################
     # Non-linear registration
@@ -530,7 +1228,7 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     # boundary.
     if nonlinear_weight_file is None:
         out_mask_tool = mask_tool(
-            in_file=out_tcat.outputs.out_file,
+            in_file=rigid['brains'],
             union=True,
             out_file=os.path.join(
                 write_dir,
@@ -557,58 +1255,137 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
     # We choose the final patch size relatively large in the first cycle
     # and substantially reduce it with each subsequent cycle. The intermediate
     # and final templates are all means in intensity space of transformed
-    # images.
-    # 
-    if nonlinear_levels is None:
-        nonlinear_levels = [1, 2, 3]
-
-    for n_lev, maxlev in enumerate(nonlinear_levels):        
+    # images. Each cycle is a stage of the run manifest, so that a resumed
+    # run starts at the first unfinished cycle.
+    #
+    # Optionally, the first cycles run on downsampled images. The warps of
+    # a cycle are then resampled on the grid of the next cycle to initialize
+    # it, and the template is recomputed on this grid from the resampled
+    # warps.
+    #
+    # Optionally again, these cycles only use a subset of the animals, and
+    # the remaining animals join the minimal patches cycles.
+    subset_head_files = [centered_head_files[n] for n in subset_indices]
+    subset_affine_files = [affine_transform_files[n] for n in subset_indices]
+
+    def regrid_stage(factor, warp_files, template_file, name):
+        if factor == 1:
+            head_files = subset_head_files
+            weight_file = nonlinear_weight_file
+        else:
+            def downsample_anat(centered_head_file):
+                return _downsample_anat(centered_head_file, factor,
+                                        write_dir, steps)
+
+            head_files = _map_animals(downsample_anat, n_jobs,
+                                      subset_head_files)
+            weight_file = _downsample_anat(nonlinear_weight_file, factor,
+                                           write_dir, steps,
+                                           resample_mode='NN')
+
+        suffix = '_grid{}'.format(name)
+        if warp_files == subset_affine_files:
+            # Affine transforms do not depend on the grid
+            template_file = _regrid_anat(template_file, head_files[0], suffix,
+                                         write_dir, steps)
+        else:
+            def regrid_warp(warp_file):
+                return _regrid_anat(warp_file, head_files[0], suffix,
+                                    write_dir, steps)
+
+            warp_files = _map_animals(regrid_warp, n_jobs, warp_files)
+            template_file = os.path.join(
+                write_dir, 'warped{}_adjusted_mean.nii.gz'.format(suffix))
+            warp_files = _adjust_warps(nwarp_adjust, warp_files, write_dir,
+                                       in_files=head_files,
+                                       out_file=template_file)
+        return {'heads': head_files, 'weight': weight_file,
+                'warps': warp_files, 'template': template_file}
+
+    # The change of the template is measured after each cycle, to stop
+    # once the template is stable
+    template_changes = []
+
+    def has_converged(previous_template_file, template_file, weight_file):
+        change = _template_change(previous_template_file, template_file,
+                                  weight_file)
+        template_changes.append(change)
+        if verbose:
+            print('Template change at nonlinear iteration {0}: {1:.5f}'.format(
+                len(template_changes), change))
+        return template_convergence is not None and \
+            change < template_convergence
+
+    converged = False
+    grid_factor = 1
+    level_head_files = subset_head_files
+    level_weight_file = nonlinear_weight_file
+    for n_lev, maxlev in enumerate(nonlinear_levels):
         if n_lev == 0:
             inilev = 0
             # first cycle registers the centered heads to the affine template
-            common_head_file = out_tstat_allineated_head.outputs.out_file
-            # Transform the affine transforms to warps for initializing
-            # the first cycle non-linear registration
-            previous_warp_files = []
-            for affine_file, centered_head_file in zip(affine_transform_files, 
-                                                       centered_head_files):
-                out_nwarp_cat = nwarp_cat(
-                    in_files=[('IDENT', centered_head_file), affine_file],
-                    out_file=fname_presuffix(centered_head_file,
-                                             suffix='_iniwarp'))
-                previous_warp_files.append(out_nwarp_cat.outputs.out_file)
-
-        warped_files = []
-        warp_files = []
-        for warp_file, centered_head_file in zip(previous_warp_files, 
-                                                 centered_head_files):
-            out_file = fname_presuffix(centered_head_file,
-                                       suffix='_warped{}'.format(n_lev))
-            out_qwarp = qwarp(
-                in_file=centered_head_file,
-                base_file=common_head_file,
-                noneg=True,
-                iwarp=True,
-                weight=nonlinear_weight_file,
-                iniwarp=[warp_file],
-                inilev=inilev,
-                maxlev=maxlev,
-                out_file=out_file,
-                **verb_quietness_kwargs)
-            warped_files.append(out_qwarp.outputs.warped_source)
-            # Collect the current warps to initialize the transforms of
-            # the next non-linear cycle
-            warp_files.append(out_qwarp.outputs.source_warp)
-            previous_warp_files = warp_files
-
-        inilev = maxlev + 1
-        # Compute the average of the warped images while accounting
-        # for systematic biases in the non-linear transforms
-        common_head_file = os.path.join(
+            common_head_file = affine['heads_mean']
+            previous_warp_files = subset_affine_files
+
+        factor = nonlinear_downsampling_factors[n_lev]
+        if factor != grid_factor:
+            grid = run_stage(
+                manifest, 'nonlinear_grid_{}'.format(n_lev),
+                lambda: regrid_stage(factor, previous_warp_files,
+                                     common_head_file, n_lev))
+            level_head_files = grid['heads']
+            level_weight_file = grid['weight']
+            previous_warp_files = grid['warps']
+            common_head_file = grid['template']
+            grid_factor = factor
+
+        def level_stage():
+            def warp_level_anat(warp_file, centered_head_file):
+                if n_lev == 0:
+                    # Transform the affine transforms to warps for
+                    # initializing the first cycle non-linear registration
+                    warp_file = _init_warp_anat(warp_file, centered_head_file,
+                                                steps)
+                return _warp_anat(warp_file, centered_head_file,
+                                  common_head_file, level_weight_file,
+                                  inilev, n_lev, steps, maxlev=maxlev,
+                                  **verb_quietness_kwargs)
+
+            qwarp_outputs = _map_animals(warp_level_anat, n_jobs,
+                                         previous_warp_files,
+                                         level_head_files)
+            warp_files = [outputs[1] for outputs in qwarp_outputs]
+
+            # Compute the average of the warped images while accounting
+            # for systematic biases in the non-linear transforms
+            adjusted_mean_file = os.path.join(
                 write_dir, 'warped_{0}_adjusted_mean.nii.gz'.format(n_lev))
-        out_nwarp_adjust = nwarp_adjust(warps=warp_files,
-                                        in_files=centered_head_files,
-                                        out_file=common_head_file)                            
+            warp_files = _adjust_warps(nwarp_adjust, warp_files, write_dir,
+                                       in_files=level_head_files,
+                                       out_file=adjusted_mean_file)
+            return {'warps': warp_files, 'mean': adjusted_mean_file}
+
+        level = run_stage(manifest, 'nonlinear_level_{}'.format(n_lev),
+                          level_stage)
+        # Collect the current warps to initialize the transforms of
+        # the next non-linear cycle
+        warp_files = level['warps']
+        previous_warp_files = warp_files
+        inilev = maxlev + 1
+        converged = has_converged(common_head_file, level['mean'],
+                                  level_weight_file)
+        common_head_file = level['mean']
+        if converged:
+            break
+
+    # The remaining cycles and the final transforms are at full resolution
+    if grid_factor != 1:
+        grid = run_stage(manifest, 'nonlinear_grid_full',
+                         lambda: regrid_stage(1, previous_warp_files,
+                                              common_head_file, 'full'))
+        warp_files = grid['warps']
+        previous_warp_files = warp_files
+        common_head_file = grid['template']
 
     if nonlinear_levels == []:
         previous_warp_files = affine_transform_files
@@ -616,72 +1393,676 @@ def anats_to_common(anat_filenames, write_dir, brain_volume,
         n_lev = 0
     else:
         inilev = maxlev + 1    # not ideal
+
+    # The animals out of the subset start the first minimal patches cycle
+    # from their affine transforms
+    joining = [False] * len(centered_head_files)
+    if nonlinear_levels and len(subset_indices) < len(centered_head_files):
+        subset_warp_files = dict(zip(subset_indices, previous_warp_files))
+        joining = [n not in subset_warp_files
+                   for n in range(len(centered_head_files))]
+        previous_warp_files = [
+            subset_warp_files.get(n, affine_transform_file)
+            for n, affine_transform_file in enumerate(affine_transform_files)]
   
     if nonlinear_minimal_patches is None:
        nonlinear_minimal_patches = []
        n_iter = n_lev
 
+    warped_mean_file = None
     for n_patch, minpatch in enumerate(nonlinear_minimal_patches):        
-        warped_files = []
-        warp_files = []
-        n_iter = n_lev + n_patch
-        for warp_file, centered_head_file in zip(previous_warp_files, 
-                                                 centered_head_files):            
-            out_file = fname_presuffix(centered_head_file,
-                                       suffix='_warped{}'.format(n_iter))
-            out_qwarp = qwarp2(
-                in_file=centered_head_file,
-                base_file=common_head_file,
-                noneg=True,
-                iwarp=True,
-                weight=nonlinear_weight_file,
-                iniwarp=[warp_file],
-                inilev=inilev,
-                minpatch=minpatch,
-                out_file=out_file,
-                **verb_quietness_kwargs)
-                    
-            warped_files.append(out_qwarp.outputs.warped_source)
-            warp_files.append(out_qwarp.outputs.source_warp)
-            previous_warp_files = warp_files
+        if converged and not any(joining):
+            break
 
-        out_tcat = tcat(
-            in_files=warped_files,
-            out_file=os.path.join(
-                write_dir,
-                'warped_{0}iters_template.nii.gz'.format(n_iter)),
-            **verbosity_kwargs)
-        out_tstat_warp_head = tstat(in_file=out_tcat.outputs.out_file,
-                                    outputtype='NIFTI_GZ')
+        n_iter = n_lev + n_patch
 
-        common_head_file = os.path.join(
+        def patch_stage():
+            def warp_patch_anat(warp_file, centered_head_file, joins):
+                patch_inilev = inilev
+                if joins:
+                    warp_file = _init_warp_anat(warp_file, centered_head_file,
+                                                steps)
+                    patch_inilev = 0
+                return _warp_anat(warp_file, centered_head_file,
+                                  common_head_file, nonlinear_weight_file,
+                                  patch_inilev, n_iter, steps,
+                                  minpatch=minpatch, **verb_quietness_kwargs)
+
+            qwarp_outputs = _map_animals(warp_patch_anat, n_jobs,
+                                         previous_warp_files,
+                                         centered_head_files, joining)
+            warped_files = [outputs[0] for outputs in qwarp_outputs]
+            warp_files = [outputs[1] for outputs in qwarp_outputs]
+
+            warped_mean_file = average(
+                warped_files,
+                'warped_{0}iters_template.nii.gz'.format(n_iter))
+
+            adjusted_mean_file = os.path.join(
                 write_dir, 'warped_{0}_adjusted_mean.nii.gz'.format(n_iter))
-        out_nwarp_adjust = nwarp_adjust(warps=warp_files,
-                                        in_files=centered_head_files,
-                                        out_file=common_head_file)                            
-                                    
+            warp_files = _adjust_warps(nwarp_adjust, warp_files, write_dir,
+                                       in_files=centered_head_files,
+                                       out_file=adjusted_mean_file)
+            return {'warps': warp_files, 'mean': adjusted_mean_file,
+                    'warped_mean': warped_mean_file}
+
+        patch = run_stage(manifest, 'nonlinear_patch_{}'.format(n_patch),
+                          patch_stage)
+        warp_files = patch['warps']
+        previous_warp_files = warp_files
+        joining = [False] * len(centered_head_files)
+        converged = has_converged(common_head_file, patch['mean'],
+                                  nonlinear_weight_file)
+        common_head_file = patch['mean']
+        warped_mean_file = patch['warped_mean']
+
+    if warped_mean_file is None:
+        warped_mean_file = common_head_file
+
+    # The warps computed on the cropped images are extended to the whole
+    # grid, and the template recomputed from the whole heads
+    if crop_margin is not None:
+        def uncrop_warp(warp_file):
+            return _uncrop_warp(warp_file, whole_head_files[0],
+                                write_dir=write_dir)
+
+        warp_files = _map_animals(uncrop_warp, n_jobs, warp_files)
+        centered_head_files = whole_head_files
+        common_head_file = os.path.join(write_dir,
+                                        'uncropped_adjusted_mean.nii.gz')
+        warp_files = _adjust_warps(nwarp_adjust, warp_files, write_dir,
+                                   in_files=centered_head_files,
+                                   out_file=common_head_file)
+        warped_mean_file = common_head_file
+
     ###########################################################################
     # Register to template
     # --------------------
     # Apply non-linear registration results to uncorrected images
     # XXX has already been computed !
-    warped_files = []
-    for centered_head_file, warp_file in zip(centered_head_files, warp_files):
-        suffixed_file = fname_presuffix(
-            centered_head_file,
-            suffix='affine_warp{}_catenated'.format(len(nonlinear_levels)))
-        out_file = os.path.join(write_dir, os.path.basename(suffixed_file))
-        out_warp_apply = warp_apply(
-            in_file=centered_head_file,
-            warp=warp_file,
-            master=out_tstat_warp_head.outputs.out_file,
-            out_file=out_file,
-            **verb_quietness_kwargs)
-        warped_files.append(out_warp_apply.outputs.out_file)
-
-    os.chdir(current_dir)
+    def apply_warp_anat(centered_head_file, warp_file):
+        return _apply_warp_anat(
+            centered_head_file, warp_file, warped_mean_file,
+            'affine_warp{}_catenated'.format(len(nonlinear_levels)),
+            write_dir, steps, verb_quietness_kwargs)
+
+    warped_files = _map_animals(apply_warp_anat, n_jobs,
+                                centered_head_files, warp_files)
+
     return Bunch(registered=warped_files,
-                 transforms=warp_files)
+                 transforms=warp_files,
+                 template=common_head_file,
+                 centered=centered_head_files,
+                 centers=centers,
+                 template_changes=template_changes)
+
+
+def add_anats_to_common(anat_filenames, previous, write_dir, brain_volume,
+                        registration_kind='affine',
+                        use_rats_tool=True,
+                        nonlinear_levels=[1, 2, 3],
+                        nonlinear_minimal_patches=[75],
+                        nonlinear_weight_file=None,
+                        n_update_iterations=1,
+                        convergence=0.005, blur_radius_coarse=1.1,
+                        caching=False, verbose=1,
+                        unifize_kwargs=None, brain_masking_unifize_kwargs=None,
+                        n_jobs=1, backend='afni', qc_stacks=True,
+                        template_average='mean', average_memory_limit=512):
+    """ Adds new anatomical images to a common template built by
+    `anats_to_common`, registering only the new images.
+
+    Parameters
+    ----------
+    anat_filenames : list of str
+        Paths to the new anatomical images.
+
+    previous : sklearn.datasets.base.Bunch
+        Output of `anats_to_common` or `add_anats_to_common` for the
+        previously processed images, with the same registration kind.
+
+    write_dir : str
+        Path to an existant directory to save output files to.
+
+    brain_volume : int
+        Volume of the brain in mm3 used for brain extraction.
+        Typically 400 for mouse and 1800 for rat.
+
+    registration_kind : one of {'rigid', 'affine', 'nonlinear'}, optional
+        The allowed transform kind.
+
+    use_rats_tool : bool, optional
+        If True, brain mask is computed using RATS Mathematical Morphology.
+        Otherwise, a histogram-based brain segmentation is used.
+
+    nonlinear_levels : list of int, optional
+        Maximal levels used for the previous nonlinear warping iterations.
+        Only the last one is used, if no minimal patch is given.
+
+    nonlinear_minimal_patches : list of int, optional
+        Minimal patches used for the previous final nonlinear warps. The
+        new images are warped down to the last one.
+
+    nonlinear_weight_file : str, optional
+        Path to a mask used to weight the affine and non-linear
+        registrations, typically the weight used for the previous images.
+
+    n_update_iterations : int, optional
+        Number of times the new images are registered again to the updated
+        template. The previous images are never registered again.
+
+    convergence : float, optional
+        Convergence limit, passed to nipype.interfaces.afni.Allineate
+
+    blur_radius_coarse : float, optional
+        Radius passed to nipype.interfaces.afni.Allineate for
+        the "-twoblur" option
+
+    caching : bool, optional
+        If True, caching is used for all the registration steps.
+
+    verbose : int, optional
+        Verbosity level. Note that caching implies some
+        verbosity in any case.
+
+    unifize_kwargs : dict, optional
+        Is passed to nipype.interfaces.afni.Unifize, to
+        control bias correction of the template.
+
+    brain_masking_unifize_kwargs : dict, optional
+        Is passed to nipype.interfaces.afni.Unifize, to tune
+        the seperate bias correction step done prior to brain masking.
+
+    n_jobs : int, optional
+        Number of animals processed in parallel for the per-animal steps.
+        -1 means all CPUs.
+
+    backend : one of {'afni', 'native'}, optional
+        Backend of the trivial voxelwise steps, see `anats_to_common`.
+
+    qc_stacks : bool, optional
+        If True, the registered images are concatenated into a 4D quality
+        check movie.
+
+    template_average : one of {'mean', 'median', 'trimmed_mean'}, optional
+        Voxelwise statistic of the updated rigid and affine templates, see
+        `anats_to_common`.
+
+    average_memory_limit : float, optional
+        Memory budget in megabytes of the median and trimmed mean.
+
+    Returns
+    -------
+    data : sklearn.datasets.base.Bunch
+        Dictionary-like object with the attributes `registered`,
+        `transforms`, `template`, `centered` and `centers` of the output of
+        `anats_to_common`, for the previous images followed by the new ones.
+        `centers` is None if the previous results have none. For nonlinear
+        registration, the transforms of the previous images are adjusted
+        with the new ones, and all the images are registered again to the
+        updated template.
+
+    Notes
+    -----
+    The new images are registered to the previous template, which is then
+    updated with the new images and registered to again
+    `n_update_iterations` times. For nonlinear registration, the updated
+    template is the average of all the warped images accounting for the
+    systematic biases in all the warps, as in `anats_to_common`. Otherwise,
+    it is the `template_average` of all the registered images.
+    """
+    registration_kinds = ['rigid', 'affine', 'nonlinear']
+    if registration_kind not in registration_kinds:
+        raise ValueError(
+            'Registration kind must be one of {0}, you entered {1}'.format(
+                registration_kinds, registration_kind))
+
+    if template_average not in _TEMPLATE_AVERAGES:
+        raise ValueError(
+            'Template average must be one of {0}, you entered {1}'.format(
+                _TEMPLATE_AVERAGES, template_average))
+
+    for key in ['registered', 'transforms', 'template', 'centered']:
+        if key not in previous:
+            raise ValueError('Previous results must be the output of '
+                             'anats_to_common, {0} is missing.'.format(key))
+
+    ComputeMask = _get_compute_mask_interface(use_rats_tool)
+    (terminal_output, verbosity_kwargs, quietness_kwargs,
+     verb_quietness_kwargs, verbosity_quietness_kwargs) = \
+        _get_verbosity_kwargs(verbose)
+    # Each update pass writes the registration outputs of the previous one
+    steps = _get_template_steps(ComputeMask, write_dir, caching=caching,
+                                terminal_output=terminal_output,
+                                environ={'AFNI_DECONFLICT': 'OVERWRITE'},
+                                backend=backend, n_jobs=n_jobs)
+
+    if brain_masking_unifize_kwargs is None:
+        brain_masking_unifize_kwargs = {}
+    brain_masking_unifize_kwargs.update(quietness_kwargs)
+    if unifize_kwargs is None:
+        unifize_kwargs = {}
+
+    unifize_kwargs.update(quietness_kwargs)
+
+    if nonlinear_levels is None:
+        nonlinear_levels = [1, 2, 3]
+
+    if nonlinear_minimal_patches is None:
+        nonlinear_minimal_patches = []
+
+    # The new images are warped in one go down to the last level or patch,
+    # then only the last level or patch is refined
+    if registration_kind == 'nonlinear':
+        if nonlinear_minimal_patches:
+            last_qwarp_kwargs = {'minpatch': nonlinear_minimal_patches[-1]}
+            if nonlinear_levels:
+                refine_inilev = nonlinear_levels[-1] + 1
+            else:
+                refine_inilev = 0
+        else:
+            last_qwarp_kwargs = {'maxlev': nonlinear_levels[-1]}
+            refine_inilev = nonlinear_levels[-1]
+
+    write_dir = os.path.abspath(write_dir)
+
+    # Copy, bias correct and center the new images on the previous template
+    # grid. Animals numbering follows the previous animals.
+    n_previous = len(previous.centered)
+
+    def copy_anat(n, anat_file):
+        return _copy_anat(n, anat_file, write_dir, steps, verbosity_kwargs)
+
+    copied_anat_filenames = _map_animals(
+        copy_anat, n_jobs, range(n_previous, n_previous + len(anat_filenames)),
+        anat_filenames)
+
+    def center_anat(anat_file):
+        return _center_anat(anat_file, previous.template, brain_volume,
+                            write_dir, steps, unifize_kwargs,
+                            brain_masking_unifize_kwargs)
+
+    centered_files = _map_animals(center_anat, n_jobs,
+                                  copied_anat_filenames)
+    centered_brain_files = [files[0] for files in centered_files]
+    centered_head_files = [files[1] for files in centered_files]
+
+    # Successive registrations of the new images to the template, followed
+    # by template update
+    template_file = previous.template
+    previous_transforms = previous.transforms
+    warp_files = None
+    for n_update in range(n_update_iterations + 1):
+        if registration_kind == 'nonlinear' and warp_files is not None:
+            def register_anat(centered_brain_file, centered_head_file,
+                              warp_file):
+                warped_file, warp_file = _warp_anat(
+                    warp_file, centered_head_file, template_file,
+                    nonlinear_weight_file, refine_inilev,
+                    'added{}'.format(n_update), steps,
+                    **dict(last_qwarp_kwargs, **verb_quietness_kwargs))
+                return warp_file
+
+            register_args = (centered_brain_files, centered_head_files,
+                             warp_files)
+        else:
+            def register_anat(centered_brain_file, centered_head_file):
+                rigid_transform_file, _, shift_rotated_head_file = \
+                    _rigid_register_anat(
+                        centered_brain_file, centered_head_file,
+                        template_file, write_dir, steps, convergence,
+                        blur_radius_coarse, verbosity_quietness_kwargs)
+                if registration_kind == 'rigid':
+                    return rigid_transform_file
+
+                affine_transform_file, _, _ = _affine_register_anat(
+                    shift_rotated_head_file, rigid_transform_file,
+                    centered_brain_file, centered_head_file,
+                    template_file, nonlinear_weight_file, write_dir, steps,
+                    convergence, blur_radius_coarse,
+                    verbosity_quietness_kwargs)
+                if registration_kind == 'affine':
+                    return affine_transform_file
+
+                warp_file = _init_warp_anat(affine_transform_file,
+                                            centered_head_file, steps)
+                warped_file, warp_file = _warp_anat(
+                    warp_file, centered_head_file, template_file,
+                    nonlinear_weight_file, 0, 'added{}'.format(n_update),
+                    steps, **dict(last_qwarp_kwargs, **verb_quietness_kwargs))
+                return warp_file
+
+            register_args = (centered_brain_files, centered_head_files)
+
+        transform_files = _map_animals(register_anat, n_jobs, *register_args)
+
+        # Update the template with all the images. For nonlinear
+        # registration, the warps of all the animals are adjusted.
+        if registration_kind == 'nonlinear':
+            template_file = os.path.join(
+                write_dir,
+                'added_{0}_adjusted_mean.nii.gz'.format(n_update))
+            adjusted_warp_files = _adjust_warps(
+                steps.nwarp_adjust, previous_transforms + transform_files,
+                write_dir, in_files=previous.centered + centered_head_files,
+                out_file=template_file)
+            previous_transforms = adjusted_warp_files[:n_previous]
+            warp_files = adjusted_warp_files[n_previous:]
+            transform_files = warp_files
+        else:
+            def apply_transform_anat(centered_head_file, transform_file):
+                return _apply_affine_anat(
+                    centered_head_file, transform_file, template_file,
+                    '_registered', write_dir, steps,
+                    verbosity_quietness_kwargs)
+
+            registered_files = _map_animals(apply_transform_anat, n_jobs,
+                                            centered_head_files,
+                                            transform_files)
+            stack_file = os.path.join(
+                write_dir,
+                'added_{0}_registered_heads.nii.gz'.format(n_update))
+            if qc_stacks:
+                steps.tcat(in_files=previous.registered + registered_files,
+                           out_file=stack_file, **verbosity_kwargs)
+            template_file = _average_anats(
+                previous.registered + registered_files,
+                fname_presuffix(stack_file, suffix='_tstat'),
+                template_average=template_average,
+                memory_limit=average_memory_limit)
+
+    # The adjusted warps of all the animals are applied to the updated
+    # template, as in anats_to_common
+    if registration_kind == 'nonlinear':
+        n_animals = n_previous + len(anat_filenames)
+
+        def apply_warp_anat(centered_head_file, warp_file):
+            return _apply_warp_anat(
+                centered_head_file, warp_file, template_file,
+                '_added{}_catenated'.format(n_animals), write_dir, steps,
+                verb_quietness_kwargs)
+
+        registered_files = _map_animals(
+            apply_warp_anat, n_jobs, previous.centered + centered_head_files,
+            previous_transforms + transform_files)
+    else:
+        registered_files = previous.registered + registered_files
+
+    centers = previous.get('centers')
+    if centers is not None:
+        centers = centers + [list(files[2]) for files in centered_files]
+
+    return Bunch(registered=registered_files,
+                 transforms=previous_transforms + transform_files,
+                 template=template_file,
+                 centered=previous.centered + centered_head_files,
+                 centers=centers)
+
+
+def merge_anats_to_common(groups, write_dir, brain_volume,
+                          registration_kind='affine',
+                          use_rats_tool=True,
+                          nonlinear_levels=[1, 2, 3],
+                          nonlinear_minimal_patches=[75],
+                          convergence=0.005, blur_radius_coarse=1.1,
+                          caching=False, verbose=1,
+                          unifize_kwargs=None,
+                          brain_masking_unifize_kwargs=None,
+                          n_jobs=1, backend='afni'):
+    """ Registers the templates of groups of animals built separately by
+    `anats_to_common` to a common top-level template, and composes the
+    transform of each animal with the transform of its group template.
+
+    Parameters
+    ----------
+    groups : list of sklearn.datasets.base.Bunch
+        Outputs of `anats_to_common` for disjoint groups of animals, with
+        the given registration kind.
+
+    write_dir : str
+        Path to an existant directory to save output files to.
+
+    brain_volume : int
+        Volume of the brain in mm3 used for brain extraction.
+        Typically 400 for mouse and 1800 for rat.
+
+    registration_kind : one of {'rigid', 'affine', 'nonlinear'}, optional
+        The allowed transform kind, for the groups and the top-level
+        template.
+
+    Other parameters are passed to `anats_to_common` for the top-level
+    template.
+
+    Returns
+    -------
+    data : sklearn.datasets.base.Bunch
+        Dictionary-like object, the interest attributes are :
+
+        - `registered` : list of str.
+                         Paths to the images registered to the top-level
+                         template, for the animals of all the groups.
+        - `transforms` : list of str.
+                         Paths to the composed transforms from the
+                         centered images to the registered images.
+        - `template` : str.
+                       Path to the top-level template head.
+        - `centered` : list of str.
+                       Paths to the centered heads of the groups, the
+                       transforms apply to.
+    """
+    registration_kinds = ['rigid', 'affine', 'nonlinear']
+    if registration_kind not in registration_kinds:
+        raise ValueError(
+            'Registration kind must be one of {0}, you entered {1}'.format(
+                registration_kinds, registration_kind))
+
+    for group in groups:
+        for key in ['registered', 'transforms', 'template', 'centered']:
+            if key not in group:
+                raise ValueError('Groups must be outputs of anats_to_common, '
+                                 '{0} is missing.'.format(key))
+
+    top = anats_to_common(
+        [group.template for group in groups], write_dir, brain_volume,
+        registration_kind=registration_kind, use_rats_tool=use_rats_tool,
+        nonlinear_levels=nonlinear_levels,
+        nonlinear_minimal_patches=nonlinear_minimal_patches,
+        convergence=convergence, blur_radius_coarse=blur_radius_coarse,
+        caching=caching, verbose=verbose, unifize_kwargs=unifize_kwargs,
+        brain_masking_unifize_kwargs=brain_masking_unifize_kwargs,
+        n_jobs=n_jobs, backend=backend)
+
+    ComputeMask = _get_compute_mask_interface(use_rats_tool)
+    (terminal_output, _, _, verb_quietness_kwargs,
+     verbosity_quietness_kwargs) = _get_verbosity_kwargs(verbose)
+    steps = _get_template_steps(ComputeMask, write_dir, caching=caching,
+                                terminal_output=terminal_output,
+                                backend=backend, n_jobs=n_jobs)
+
+    registered_files = []
+    transform_files = []
+    centered_head_files = []
+    for n_group, (group, center, group_transform_file) in enumerate(
+            zip(groups, top.centers, top.transforms)):
+        # The top-level centering translates the group template brain
+        # center of mass to the origin
+        centering_file = os.path.join(
+            write_dir, 'group{}_centering.aff12.1D'.format(n_group))
+        np.savetxt(centering_file, [[1, 0, 0, center[0],
+                                     0, 1, 0, center[1],
+                                     0, 0, 1, center[2]]])
+        prefix = 'group{}_'.format(n_group)
+
+        def compose_anat(transform_file, centered_head_file):
+            composed_file = fname_presuffix(transform_file, prefix=prefix,
+                                            newpath=write_dir)
+            if registration_kind == 'nonlinear':
+                out_nwarp_cat = steps.nwarp_cat(
+                    in_files=[group_transform_file, centering_file,
+                              transform_file],
+                    out_file=composed_file)
+                composed_file = out_nwarp_cat.outputs.out_file
+                registered_file = _apply_warp_anat(
+                    centered_head_file, composed_file, top.template,
+                    '_' + prefix + 'registered', write_dir, steps,
+                    verb_quietness_kwargs)
+            else:
+                out_catmatvec = steps.catmatvec(
+                    in_file=[(transform_file, 'ONELINE'),
+                             (centering_file, 'ONELINE'),
+                             (group_transform_file, 'ONELINE')],
+                    out_file=composed_file)
+                composed_file = out_catmatvec.outputs.out_file
+                registered_file = _apply_affine_anat(
+                    centered_head_file, composed_file, top.template,
+                    '_' + prefix + 'registered', write_dir, steps,
+                    verbosity_quietness_kwargs)
+            return composed_file, registered_file
+
+        outputs = _map_animals(compose_anat, n_jobs, group.transforms,
+                               group.centered)
+        transform_files.extend([output[0] for output in outputs])
+        registered_files.extend([output[1] for output in outputs])
+        centered_head_files.extend(group.centered)
+
+    return Bunch(registered=registered_files,
+                 transforms=transform_files,
+                 template=top.template,
+                 centered=centered_head_files)
+
+
+def hierarchical_anats_to_common(anat_filenames, write_dir, brain_volume,
+                                 group_size, registration_kind='affine',
+                                 use_rats_tool=True,
+                                 nonlinear_levels=[1, 2, 3],
+                                 nonlinear_minimal_patches=[75],
+                                 convergence=0.005, blur_radius_coarse=1.1,
+                                 caching=False, verbose=1,
+                                 unifize_kwargs=None,
+                                 brain_masking_unifize_kwargs=None,
+                                 n_jobs=1, backend='afni', group_kwargs=None):
+    """ Create common template from native anatomical images of a large
+    cohort, by building templates of groups of animals and merging them.
+
+    Parameters
+    ----------
+    anat_filenames : list of str
+        Paths to the anatomical images.
+
+    write_dir : str
+        Path to an existant directory to save output files to. The group
+        outputs are saved to its subdirectories `group0`, `group1`, ...
+
+    brain_volume : int
+        Volume of the brain in mm3 used for brain extraction.
+        Typically 400 for mouse and 1800 for rat.
+
+    group_size : int
+        Maximal number of animals per group. Consecutive animals are split
+        into groups of equal sizes, up to one animal.
+
+    registration_kind : one of {'rigid', 'affine', 'nonlinear'}, optional
+        The allowed transform kind. Nonlinear registration requires at
+        least 5 groups of at least 5 animals.
+
+    group_kwargs : dict, optional
+        Additional parameters passed to `anats_to_common` for each group,
+        for instance `resume` or `nonlinear_weight_file`.
+
+    Other parameters are passed to `anats_to_common` for each group and for
+    the top-level template.
+
+    Returns
+    -------
+    data : sklearn.datasets.base.Bunch
+        Dictionary-like object with the attributes of the output of
+        `merge_anats_to_common`, and
+
+        - `groups` : list of list of int.
+                     Indices of the animals of each group.
+
+    Notes
+    -----
+    Each group only holds its own animals in memory, so peak memory is
+    bounded by the group size. The groups can also be processed on separate
+    machines with `anats_to_common`, and their outputs merged with
+    `merge_anats_to_common`.
+    """
+    if group_kwargs is None:
+        group_kwargs = {}
+
+    n_groups = int(np.ceil(len(anat_filenames) / float(group_size)))
+    groups_indices = np.array_split(np.arange(len(anat_filenames)), n_groups)
+    if registration_kind == 'nonlinear':
+        if len(groups_indices[-1]) < 5 or n_groups < 5:
+            raise ValueError(
+                'At least 5 groups of 5 animals are required for nonlinear '
+                'registration, group size {0} gives {1} groups with at least '
+                '{2} animals.'.format(group_size, n_groups,
+                                      len(groups_indices[-1])))
+
+    groups = []
+    for n_group, indices in enumerate(groups_indices):
+        group_dir = os.path.join(write_dir, 'group{}'.format(n_group))
+        if not os.path.isdir(group_dir):
+            os.makedirs(group_dir)
+        groups.append(anats_to_common(
+            [anat_filenames[n] for n in indices], group_dir, brain_volume,
+            registration_kind=registration_kind,
+            use_rats_tool=use_rats_tool, nonlinear_levels=nonlinear_levels,
+            nonlinear_minimal_patches=nonlinear_minimal_patches,
+            convergence=convergence, blur_radius_coarse=blur_radius_coarse,
+            caching=caching, verbose=verbose, unifize_kwargs=unifize_kwargs,
+            brain_masking_unifize_kwargs=brain_masking_unifize_kwargs,
+            n_jobs=n_jobs, backend=backend, **group_kwargs))
+
+    merged = merge_anats_to_common(
+        groups, write_dir, brain_volume, registration_kind=registration_kind,
+        use_rats_tool=use_rats_tool, nonlinear_levels=nonlinear_levels,
+        nonlinear_minimal_patches=nonlinear_minimal_patches,
+        convergence=convergence, blur_radius_coarse=blur_radius_coarse,
+        caching=caching, verbose=verbose, unifize_kwargs=unifize_kwargs,
+        brain_masking_unifize_kwargs=brain_masking_unifize_kwargs,
+        n_jobs=n_jobs, backend=backend)
+    merged.groups = [[int(n) for n in indices] for indices in groups_indices]
+    return merged
+
+
+def _compute_dilated_head_mask(head_template_filename, write_dir,
+                               caching=False, terminal_output='stream',
+                               environ=None, verbose=1):
+    """ Computes the mask of the non-background voxels of the head template
+    after dilation, and returns it with the intermediate thresholded
+    template.
+    """
+    environ = thread_environ(environ)
+    if caching:
+        memory = Memory(write_dir)
+        clip_level = memory.cache(afni.ClipLevel)
+        threshold = memory.cache(fsl.Threshold)
+        mask_tool = memory.cache(afni.MaskTool)
+        for step in [threshold, mask_tool]:
+            step.interface().set_default_terminal_output(terminal_output)
+    else:
+        clip_level = afni.ClipLevel().run
+        threshold = fsl.Threshold(terminal_output=terminal_output).run
+        mask_tool = afni.MaskTool(terminal_output=terminal_output).run
+
+    out_clip_level = clip_level(in_file=head_template_filename)
+    out_threshold = threshold(
+        in_file=head_template_filename,
+        thresh=out_clip_level.outputs.clip_val,
+        out_file=fname_presuffix(head_template_filename,
+                                 suffix='_thresholded', newpath=write_dir))
+    out_mask_tool = mask_tool(in_file=out_threshold.outputs.out_file,
+                              dilate_inputs='3',
+                              out_file=fname_presuffix(
+                                  out_threshold.outputs.out_file,
+                                  suffix='_mask'),
+                              outputtype='NIFTI_GZ',
+                              environ=environ,
+                              verbose=verbose)
+    return out_mask_tool.outputs.out_file, out_threshold.outputs.out_file
 
 
 def anat_to_template(anat_filename, brain_filename,
@@ -690,7 +2071,7 @@ def anat_to_template(anat_filename, brain_filename,
                      dilated_head_mask_filename=None, convergence=.005,
                      maxlev=None,
                      caching=False, verbose=1, environ=None,
-                     registration_kind='nonlinear'):
+                     registration_kind='nonlinear', crop_margin=None):
     """ Registers an unbiased anatomical image to a given template.
     Parameters
     ----------
@@ -724,6 +2105,11 @@ def anat_to_template(anat_filename, brain_filename,
     unifize_kwargs : dict, optional
         Is passed to nipype.interfaces.afni.Unifize, to
         control bias correction of the template.
+    crop_margin : float or None, optional
+        If not None, the affine registration is computed between the bounding
+        boxes of the brains and the nonlinear registration within the bounding
+        box of the brain template, extended by this margin in mm. The warp is
+        then extended to the whole template grid.
     Returns
     -------
     data : sklearn.datasets.base.Bunch
@@ -751,7 +2137,7 @@ def anat_to_template(anat_filename, brain_filename,
                 registration_kinds, registration_kind))
 
     if environ is None:
-        environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+        environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
     if verbose:
         terminal_output = 'stream'
         verb_quietness_kwargs = {'verb': verbose > 2}
@@ -766,37 +2152,41 @@ def anat_to_template(anat_filename, brain_filename,
 
     if caching:
         memory = Memory(write_dir)
-        clip_level = memory.cache(afni.ClipLevel)
-        threshold = memory.cache(fsl.Threshold)
-        mask_tool = memory.cache(afni.MaskTool)
         allineate = memory.cache(afni.Allineate)
         allineate_apply = memory.cache(afni.Allineate)
         qwarp = memory.cache(afni.Qwarp)
-        for step in [allineate, allineate_apply, threshold, mask_tool, qwarp]:
+        warp_apply = memory.cache(afni.NwarpApply)
+        for step in [allineate, allineate_apply, qwarp, warp_apply]:
             step.interface().set_default_terminal_output(terminal_output)
     else:
-        clip_level = afni.ClipLevel().run
-        threshold = fsl.Threshold(terminal_output=terminal_output).run
-        mask_tool = afni.MaskTool(terminal_output=terminal_output).run
         allineate = afni.Allineate(terminal_output=terminal_output).run
         allineate_apply = afni.Allineate(terminal_output=terminal_output).run
         qwarp = afni.Qwarp(terminal_output=terminal_output).run
+        warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
 
     intermediate_files = []
     if dilated_head_mask_filename is None:
-        out_clip_level = clip_level(in_file=head_template_filename)
-        out_threshold = threshold(
-            in_file=head_template_filename,
-            thresh=out_clip_level.outputs.clip_val,
-            out_file=fname_presuffix(head_template_filename,
-                                     suffix='_thresholded', newpath=write_dir))
-        out_mask_tool = mask_tool(in_file=out_threshold.outputs.out_file,
-                                  dilate_inputs='3',
-                                  outputtype='NIFTI_GZ',
-                                  environ=environ,
-                                  verbose=verbose)
-        dilated_head_mask_filename = out_mask_tool.outputs.out_file
-        intermediate_files.append(out_threshold.outputs.out_file)
+        dilated_head_mask_filename, thresholded_filename = \
+            _compute_dilated_head_mask(head_template_filename, write_dir,
+                                       caching=caching,
+                                       terminal_output=terminal_output,
+                                       environ=environ, verbose=verbose)
+        intermediate_files.append(thresholded_filename)
+
+    # Registrations are computed within the bounding boxes of the brains.
+    # The affine transform is expressed in world coordinates, so it applies
+    # as such to the whole images.
+    if crop_margin is not None:
+        template_box = _get_crop_box([brain_template_filename], crop_margin)
+        allineate_in_file = _crop(
+            brain_filename, _get_crop_box([brain_filename], crop_margin),
+            write_dir=write_dir)
+        allineate_reference = _crop(brain_template_filename, template_box,
+                                    write_dir=write_dir)
+        intermediate_files.extend([allineate_in_file, allineate_reference])
+    else:
+        allineate_in_file = brain_filename
+        allineate_reference = brain_template_filename
 
     # the actual T1anat to template registration using the brain extracted
     # image could do in one 3dQwarp step using allineate flags but will
@@ -807,9 +2197,9 @@ def anat_to_template(anat_filename, brain_filename,
                                                 use_ext=False,
                                                 newpath=write_dir)
     out_allineate = allineate(
-        in_file=brain_filename,
-        reference=brain_template_filename,
-        master=brain_template_filename,
+        in_file=allineate_in_file,
+        reference=allineate_reference,
+        master=allineate_reference,
         out_matrix=affine_transform_filename,
         two_blur=convergence * 11. / .05,
         cost='nmi',
@@ -845,34 +2235,66 @@ def anat_to_template(anat_filename, brain_filename,
         warp_transform = None
     else:
         intermediate_files.extend(allineated_filename)
+        if crop_margin is not None:
+            qwarp_in_file, qwarp_base_file, qwarp_weight_file = [
+                _crop(filename, template_box, write_dir=write_dir)
+                for filename in [allineated_filename, head_template_filename,
+                                 dilated_head_mask_filename]]
+            intermediate_files.extend([qwarp_in_file, qwarp_base_file,
+                                       qwarp_weight_file])
+        else:
+            qwarp_in_file = allineated_filename
+            qwarp_base_file = head_template_filename
+            qwarp_weight_file = dilated_head_mask_filename
+
         if maxlev is not None:
             out_qwarp = qwarp(
-                in_file=allineated_filename,
-                base_file=head_template_filename,
-                weight=dilated_head_mask_filename,
+                in_file=qwarp_in_file,
+                base_file=qwarp_base_file,
+                weight=qwarp_weight_file,
                 nmi=True,
                 noneg=True,
                 blur=[0],
                 maxlev=maxlev,
-                out_file=fname_presuffix(allineated_filename, suffix='_warped'),
+                out_file=fname_presuffix(qwarp_in_file, suffix='_warped'),
                 environ=environ,
                 **verb_quietness_kwargs)
         else:
             out_qwarp = qwarp(
-                in_file=allineated_filename,
-                base_file=head_template_filename,
-                weight=dilated_head_mask_filename,
+                in_file=qwarp_in_file,
+                base_file=qwarp_base_file,
+                weight=qwarp_weight_file,
                 nmi=True,
                 noneg=True,
                 blur=[0],
-                out_file=fname_presuffix(allineated_filename, suffix='_warped'),
+                out_file=fname_presuffix(qwarp_in_file, suffix='_warped'),
                 environ=environ,
                 **verb_quietness_kwargs)
-        registered = fix_obliquity(out_qwarp.outputs.warped_source,
+
+        if crop_margin is not None:
+            # Extend the warp to the whole template grid
+            warp_transform = _uncrop_warp(out_qwarp.outputs.source_warp,
+                                          head_template_filename,
+                                          write_dir=write_dir)
+            out_warp_apply = warp_apply(
+                in_file=allineated_filename,
+                warp=warp_transform,
+                master=head_template_filename,
+                out_file=fname_presuffix(allineated_filename,
+                                         suffix='_warped'),
+                environ=environ,
+                **verb_quietness_kwargs)
+            warped_filename = out_warp_apply.outputs.out_file
+            intermediate_files.extend([out_qwarp.outputs.warped_source,
+                                       out_qwarp.outputs.source_warp])
+        else:
+            warped_filename = out_qwarp.outputs.warped_source
+            warp_transform = out_qwarp.outputs.source_warp
+
+        registered = fix_obliquity(warped_filename,
                                    head_template_filename,
                                    caching=caching,
                                    caching_dir=write_dir, environ=environ)
-        warp_transform = out_qwarp.outputs.source_warp
 
     if not caching:
         for intermediate_file in intermediate_files:
@@ -894,7 +2316,8 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
                       dilated_head_mask_filename=None, convergence=.005,
                       maxlev=None,
                       caching=False, verbose=1, unifize_kwargs=None,
-                      brain_masking_unifize_kwargs=None):
+                      brain_masking_unifize_kwargs=None, crop_margin=None,
+                      n_jobs=1, n_threads=None):
     """ Registers raw anatomical images to a given template.
 
     Parameters
@@ -953,6 +2376,22 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
         Is passed to nipype.interfaces.afni.Unifize, to tune
         the seperate bias correction step done prior to brain extraction.
 
+    crop_margin : float or None, optional
+        If not None, the affine registrations are computed between the
+        bounding boxes of the brains and the nonlinear registrations within
+        the bounding box of the brain template, extended by this margin in mm.
+        The warps are then extended to the whole template grid.
+
+    n_jobs : int, optional
+        Number of animals registered in parallel. -1 means all CPUs. If not
+        1, an animal whose registration fails is reported by a warning, its
+        outputs are None and the other animals are still registered.
+
+    n_threads : int or None, optional
+        Number of OpenMP threads of each AFNI process. If None, it is set by
+        the thread budget of `sammba.threads.set_thread_budget`, shared
+        between the parallel animals.
+
     Returns
     -------
     data : sklearn.datasets.base.Bunch
@@ -1009,8 +2448,9 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
         allineate2 = memory.cache(afni.Allineate)
         unifize = memory.cache(afni.Unifize)
         qwarp = memory.cache(afni.Qwarp)
+        warp_apply = memory.cache(afni.NwarpApply)
         for step in [allineate, allineate2, calc,
-                     mask_tool, unifize, qwarp]:
+                     mask_tool, unifize, qwarp, warp_apply]:
             step.interface().set_default_terminal_output(terminal_output)
     else:
         unifize = afni.Unifize(terminal_output=terminal_output).run
@@ -1021,20 +2461,30 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
         allineate = afni.Allineate(terminal_output=terminal_output).run
         allineate2 = afni.Allineate(terminal_output=terminal_output).run  # TODO: remove after fixed bug
         qwarp = afni.Qwarp(terminal_output=terminal_output).run
+        warp_apply = afni.NwarpApply(terminal_output=terminal_output).run
         environ['AFNI_DECONFLICT'] = 'OVERWRITE'
 
-    current_dir = os.getcwd()
-    os.chdir(write_dir)
+    if n_threads is None:
+        environ = thread_environ(environ, n_jobs=n_jobs)
+    else:
+        environ['OMP_NUM_THREADS'] = str(n_threads)
+
+    write_dir = os.path.abspath(write_dir)
     intermediate_files = []
     if brain_template_filename is None:
         out_clip_level = clip_level(in_file=head_template_filename)
         out_rats = compute_mask(
             in_file=head_template_filename,
+            out_file=fname_presuffix(head_template_filename, suffix='_mask',
+                                     newpath=write_dir),
             volume_threshold=brain_volume,
             intensity_threshold=int(out_clip_level.outputs.clip_val))
         out_calc_mask = calc(in_file_a=head_template_filename,
                              in_file_b=out_rats.outputs.out_file,
                              expr='a*b',
+                             out_file=fname_presuffix(head_template_filename,
+                                                      suffix='_calc',
+                                                      newpath=write_dir),
                              outputtype='NIFTI_GZ')
         brain_template_filename = out_calc_mask.outputs.out_file
 
@@ -1043,9 +2493,15 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
         out_calc_threshold = calc(
             in_file_a=head_template_filename,
             expr='ispositive(a-{0})*a'.format(out_clip_level.outputs.clip_val),
+            out_file=fname_presuffix(head_template_filename,
+                                     suffix='_thresholded',
+                                     newpath=write_dir),
             outputtype='NIFTI_GZ')
         out_mask_tool = mask_tool(in_file=out_calc_threshold.outputs.out_file,
                                   dilate_inputs='3',
+                                  out_file=fname_presuffix(
+                                      out_calc_threshold.outputs.out_file,
+                                      suffix='_mask'),
                                   outputtype='NIFTI_GZ',
                                   environ=environ,
                                   verbose=verbose)
@@ -1057,46 +2513,68 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
 
     brain_masking_unifize_kwargs.update(quietness_kwargs)
 
-    brain_extraction_in_files = []
-    for anat_filename in anat_filenames:
+    if unifize_kwargs is None:
+        unifize_kwargs = {}
+    unifize_kwargs.update(quietness_kwargs)
+
+    if registration_kind == 'rigid':
+        warp_type = 'shift_rotate'
+    else:
+        warp_type = 'affine_general'
+
+    if crop_margin is not None:
+        template_box = _get_crop_box([brain_template_filename], crop_margin)
+        allineate_reference = _crop(brain_template_filename, template_box,
+                                    write_dir=write_dir)
+        intermediate_files.append(allineate_reference)
+    else:
+        allineate_reference = brain_template_filename
+
+    if registration_kind == 'nonlinear':
+        if crop_margin is not None:
+            qwarp_base_file = _crop(head_template_filename, template_box,
+                                    write_dir=write_dir)
+            qwarp_weight_file = _crop(dilated_head_mask_filename,
+                                      template_box, write_dir=write_dir)
+            intermediate_files.extend([qwarp_base_file, qwarp_weight_file])
+        else:
+            qwarp_base_file = head_template_filename
+            qwarp_weight_file = dilated_head_mask_filename
+
+    # Each animal is registered independently to the template
+    def register_anat(anat_filename):
+        anat_intermediate_files = []
         out_unifize = unifize(in_file=anat_filename, outputtype='NIFTI_GZ',
+                              out_file=fname_presuffix(
+                                  anat_filename,
+                                  suffix='_unifized_for_brain_masking',
+                                  newpath=write_dir),
                               environ=environ,
                               **brain_masking_unifize_kwargs)
-        brain_extraction_in_files.append(out_unifize.outputs.out_file)
+        brain_extraction_in_file = out_unifize.outputs.out_file
 
-    brain_mask_files = []
-    for brain_extraction_in_file in brain_extraction_in_files:
         out_clip_level = clip_level(in_file=brain_extraction_in_file)
         out_rats = compute_mask(
             in_file=brain_extraction_in_file,
+            out_file=fname_presuffix(brain_extraction_in_file,
+                                     suffix='_mask'),
             volume_threshold=brain_volume,
             intensity_threshold=int(out_clip_level.outputs.clip_val))
-        brain_mask_files.append(out_rats.outputs.out_file)
-
-    if unifize_kwargs is None:
-        unifize_kwargs = {}
-    unifize_kwargs.update(quietness_kwargs)
+        brain_mask_file = out_rats.outputs.out_file
 
-    unbiased_anat_filenames = []
-    for anat_filename in anat_filenames:
         out_unifize = unifize(in_file=anat_filename, environ=environ,
                               urad=18.3, outputtype='NIFTI_GZ',
+                              out_file=fname_presuffix(anat_filename,
+                                                       suffix='_unifized',
+                                                       newpath=write_dir),
                               **unifize_kwargs)
-        unbiased_anat_filenames.append(out_unifize.outputs.out_file)
-
-    if registration_kind == 'rigid':
-        warp_type = 'shift_rotate'
-    else:
-        warp_type = 'affine_general'
+        unbiased_anat_filename = out_unifize.outputs.out_file
 
-    affine_transforms = []
-    allineated_filenames = []
-    for (unbiased_anat_filename,
-         brain_mask_file) in zip(unbiased_anat_filenames,
-                                 brain_mask_files):
         out_calc_mask = calc(in_file_a=unbiased_anat_filename,
                              in_file_b=brain_mask_file,
                              expr='a*b',
+                             out_file=fname_presuffix(unbiased_anat_filename,
+                                                      suffix='_calc'),
                              outputtype='NIFTI_GZ')
         masked_anat_filename = out_calc_mask.outputs.out_file
 
@@ -1107,10 +2585,18 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
         affine_transform_filename = fname_presuffix(masked_anat_filename,
                                                     suffix='_aff.aff12.1D',
                                                     use_ext=False)
+        if crop_margin is not None:
+            allineate_in_file = _crop(
+                masked_anat_filename,
+                _get_crop_box([brain_mask_file], crop_margin))
+            anat_intermediate_files.append(allineate_in_file)
+        else:
+            allineate_in_file = masked_anat_filename
+
         out_allineate = allineate(
-            in_file=masked_anat_filename,
-            reference=brain_template_filename,
-            master=brain_template_filename,
+            in_file=allineate_in_file,
+            reference=allineate_reference,
+            master=allineate_reference,
             out_matrix=affine_transform_filename,
             two_blur=1,
             cost='nmi',
@@ -1122,7 +2608,6 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
             out_file=fname_presuffix(masked_anat_filename, suffix='_aff'),
             environ=environ,
             **verbosity_quietness_kwargs)
-        affine_transforms.append(affine_transform_filename)
 
         # Apply the registration to the whole head
         out_allineate2 = allineate2(
@@ -1133,54 +2618,103 @@ def anats_to_template(anat_filenames, head_template_filename, write_dir,
                                      suffix='_' + warp_type),
             environ=environ,
             **verbosity_quietness_kwargs)
-        allineated_filenames.append(out_allineate2.outputs.out_file)
-        intermediate_files.extend([unbiased_anat_filename,
-                                   masked_anat_filename,
-                                   out_allineate.outputs.out_file])
+        allineated_filename = out_allineate2.outputs.out_file
+        anat_intermediate_files.extend([unbiased_anat_filename,
+                                        masked_anat_filename,
+                                        out_allineate.outputs.out_file])
+        if registration_kind != 'nonlinear':
+            return (allineated_filename, None, affine_transform_filename,
+                    anat_intermediate_files)
+
+        anat_intermediate_files.append(allineated_filename)
+        if crop_margin is not None:
+            qwarp_in_file = _crop(allineated_filename, template_box)
+            anat_intermediate_files.append(qwarp_in_file)
+        else:
+            qwarp_in_file = allineated_filename
+
+        # Non-linear registration of affine pre-registered whole head image
+        # to template. Don't initiate straight from the original with an
+        # iniwarp due to weird errors (like it creating an Allin it then can't
+        # find)
+        # XXX what is the need to the iwarp ?
+        if maxlev is not None:
+            out_qwarp = qwarp(
+                in_file=qwarp_in_file,
+                base_file=qwarp_base_file,
+                weight=qwarp_weight_file,
+                nmi=True,
+                noneg=True,
+                blur=[0],
+                maxlev=maxlev,
+                out_file=fname_presuffix(qwarp_in_file,
+                                         suffix='_warped'),
+                environ=environ,
+                **verb_quietness_kwargs)
+        else:
+            out_qwarp = qwarp(
+                in_file=qwarp_in_file,
+                base_file=qwarp_base_file,
+                weight=qwarp_weight_file,
+                nmi=True,
+                noneg=True,
+                blur=[0],
+                out_file=fname_presuffix(qwarp_in_file,
+                                         suffix='_warped'),
+                environ=environ,
+                **verb_quietness_kwargs)
+
+        if crop_margin is not None:
+            # Extend the warp to the whole template grid
+            warp_transform = _uncrop_warp(out_qwarp.outputs.source_warp,
+                                          head_template_filename)
+            out_warp_apply = warp_apply(
+                in_file=allineated_filename,
+                warp=warp_transform,
+                master=head_template_filename,
+                out_file=fname_presuffix(allineated_filename,
+                                         suffix='_warped'),
+                environ=environ,
+                **verb_quietness_kwargs)
+            anat_intermediate_files.extend([out_qwarp.outputs.warped_source,
+                                            out_qwarp.outputs.source_warp])
+            return (out_warp_apply.outputs.out_file, warp_transform,
+                    affine_transform_filename, anat_intermediate_files)
+
+        return (out_qwarp.outputs.warped_source,
+                out_qwarp.outputs.source_warp, affine_transform_filename,
+                anat_intermediate_files)
+
+    if n_jobs == 1:
+        anats_outputs = [register_anat(anat_filename)
+                         for anat_filename in anat_filenames]
+    else:
+        # A failing animal is reported without stopping the others
+        def try_register_anat(anat_filename):
+            try:
+                return register_anat(anat_filename)
+            except Exception as error:
+                return error
+
+        anats_outputs = _map_animals(try_register_anat, n_jobs,
+                                     anat_filenames)
+        for n, (anat_filename, anat_outputs) in enumerate(
+                zip(anat_filenames, anats_outputs)):
+            if isinstance(anat_outputs, Exception):
+                warnings.warn('Registration of {0} failed: {1}'.format(
+                    anat_filename, anat_outputs))
+                anats_outputs[n] = (None, None, None, [])
+
+    registered = [anat_outputs[0] for anat_outputs in anats_outputs]
+    affine_transforms = [anat_outputs[2] for anat_outputs in anats_outputs]
+    for anat_outputs in anats_outputs:
+        intermediate_files.extend(anat_outputs[3])
 
     if registration_kind != 'nonlinear':
-        registered = allineated_filenames
         warp_transforms = [None]
     else:
-        intermediate_files.extend(allineated_filenames)
-        warp_transforms = []
-        registered = []
-        for allineated_filename in allineated_filenames:
-            # Non-linear registration of affine pre-registered whole head image
-            # to template. Don't initiate straight from the original with an
-            # iniwarp due to weird errors (like it creating an Allin it then can't
-            # find)
-            # XXX what is the need to the iwarp ?
-            if maxlev is not None:
-                out_qwarp = qwarp(
-                    in_file=allineated_filename,
-                    base_file=head_template_filename,
-                    weight=dilated_head_mask_filename,
-                    nmi=True,
-                    noneg=True,
-                    blur=[0],
-                    maxlev=maxlev,
-                    out_file=fname_presuffix(allineated_filename,
-                                             suffix='_warped'),
-                    environ=environ,
-                    **verb_quietness_kwargs)
-            else:
-                out_qwarp = qwarp(
-                    in_file=allineated_filename,
-                    base_file=head_template_filename,
-                    weight=dilated_head_mask_filename,
-                    nmi=True,
-                    noneg=True,
-                    blur=[0],
-                    out_file=fname_presuffix(allineated_filename,
-                                             suffix='_warped'),
-                    environ=environ,
-                    **verb_quietness_kwargs)
-    
-            registered.append(out_qwarp.outputs.warped_source)
-            warp_transforms.append(out_qwarp.outputs.source_warp)
-    
-    os.chdir(current_dir)
+        warp_transforms = [anat_outputs[1] for anat_outputs in anats_outputs]
+
     if not caching:
         for intermediate_file in intermediate_files:
             if os.path.isfile(intermediate_file):
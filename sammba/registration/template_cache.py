@@ -0,0 +1,102 @@
+"""
+On-disk cache of the products derived from a template, shared across
+animals and output directories.
+"""
+import os
+import json
+import hashlib
+from .manifest import _file_checksum, _file_stat
+
+
+# Checksums of the files seen by this process, by path, size and
+# modification time
+_CHECKSUMS = {}
+
+# Products found or computed by this process, by cache directory and key
+_PRODUCTS = {}
+
+
+def file_checksum(filename):
+    """ Returns the checksum of the file content, computed once per process
+    as long as the file is not modified.
+    """
+    filename = os.path.abspath(filename)
+    stat = _file_stat(filename)
+    key = (filename, stat['size'], stat['mtime'])
+    if key not in _CHECKSUMS:
+        _CHECKSUMS[key] = _file_checksum(filename)
+
+    return _CHECKSUMS[key]
+
+
+class TemplateCache(object):
+    """ Directory of products derived from templates, such as brain masks.
+    Each product is stored in its own subdirectory, named after the checksum
+    of the template content and the product parameters, so that it is
+    computed once and reused whatever the path of the template.
+
+    Parameters
+    ----------
+    cache_dir : str
+        Path to the cache directory, created if needed.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = os.path.abspath(cache_dir)
+
+    def _key(self, product, template, parameters):
+        # Existing files are identified by their content
+        parameters = dict(
+            (name, file_checksum(value)
+             if isinstance(value, str) and os.path.isfile(value) else value)
+            for name, value in parameters.items())
+        description = json.dumps([product, file_checksum(template),
+                                  parameters], sort_keys=True)
+        return hashlib.sha1(description.encode('utf-8')).hexdigest()
+
+    def get(self, product, template, compute, **parameters):
+        """ Returns the path to the product of the template with the given
+        parameters, computing it if it is not cached yet.
+
+        Parameters
+        ----------
+        product : str
+            Name of the product.
+
+        template : str
+            Path to the template image.
+
+        compute : callable
+            Function writing the product within the directory given as
+            argument, and returning its path.
+
+        parameters : dict
+            JSON serializable parameters of the product. Existing files are
+            identified by their content.
+        """
+        key = self._key(product, template, parameters)
+        product_dir = os.path.join(self.cache_dir, product, key)
+        if (product_dir in _PRODUCTS and
+                os.path.isfile(_PRODUCTS[product_dir])):
+            return _PRODUCTS[product_dir]
+
+        record_filename = os.path.join(product_dir, 'product.json')
+        if os.path.isfile(record_filename):
+            with open(record_filename) as fp:
+                filename = json.load(fp)['filename']
+            if os.path.isfile(filename):
+                _PRODUCTS[product_dir] = filename
+                return filename
+
+        if not os.path.isdir(product_dir):
+            os.makedirs(product_dir)
+        filename = os.path.abspath(compute(product_dir))
+
+        # The record is written last and atomically, so that an interrupted
+        # computation is never reused
+        temporary_filename = record_filename + '.tmp'
+        with open(temporary_filename, 'w') as fp:
+            json.dump({'filename': filename, 'parameters': parameters}, fp,
+                      indent=1, sort_keys=True)
+        os.replace(temporary_filename, record_filename)
+        _PRODUCTS[product_dir] = filename
+        return filename
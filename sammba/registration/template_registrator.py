@@ -9,7 +9,8 @@ from .base import _apply_perslice_warp, _apply_transforms
 from .perfusion import coregister as coregister_perf
 from .func import _realign, _slice_time
 from .func import coregister as coregister_func
-from .struct import anat_to_template
+from .struct import anat_to_template, _compute_dilated_head_mask
+from .template_cache import TemplateCache
 from .base_registrator import BaseRegistrator
 
 
@@ -64,6 +65,15 @@ class TemplateRegistrator(BaseRegistrator):
     registration_kind : one of {'rigid', 'affine', 'nonlinear'}, optional
         The allowed transform kind from the anatomical image to the template.
 
+    template_cache_dir : str or None, optional
+        Path to a directory where the products of the template (brain mask,
+        brain, dilated head mask and grids resampled to a given voxel size)
+        are cached, keyed by the template content and their parameters. They
+        are then computed once and reused across animals and output
+        directories. If None, they are computed in the output directory at
+        each anatomical fit, except for the resampled grids which are reused
+        within the process.
+
     Attributes
     ----------
     `template_brain_` : str
@@ -77,7 +87,7 @@ class TemplateRegistrator(BaseRegistrator):
                  dilated_template_mask=None, output_dir=None, caching=False,
                  verbose=True, use_rats_tool=True,
                  clipping_fraction=.2, convergence=0.005,
-                 registration_kind='nonlinear'):
+                 registration_kind='nonlinear', template_cache_dir=None):
         self.template = template
         self.template_brain_mask = template_brain_mask
         self.dilated_template_mask = dilated_template_mask
@@ -89,6 +99,7 @@ class TemplateRegistrator(BaseRegistrator):
         self.clipping_fraction = clipping_fraction
         self.convergence = convergence
         self.registration_kind = registration_kind
+        self.template_cache_dir = template_cache_dir
 
     def _check_inputs(self):
         if not os.path.isfile(self.template):
@@ -112,6 +123,16 @@ class TemplateRegistrator(BaseRegistrator):
                              'transform_anat() or fit_modality().'
                              % self.__class__.__name__)
 
+    def _template_product(self, product, compute, **parameters):
+        """ Computes the product of the template in the output directory,
+        or retrieves it from the template cache.
+        """
+        if self.template_cache_dir is None:
+            return compute(self.output_dir)
+
+        return TemplateCache(self.template_cache_dir).get(
+            product, self.template, compute, **parameters)
+
     def fit_anat(self, anat_file, brain_mask_file=None):
         """Estimates registration from anatomical to template space.
         """
@@ -122,21 +143,38 @@ class TemplateRegistrator(BaseRegistrator):
             compute_brain_mask = compute_histo_brain_mask               
 
         if not self.template_brain_mask:
-            template_brain_mask_file = compute_brain_mask(
-                self.template, self.brain_volume,
-                write_dir=self.output_dir,
-                caching=self.caching,
-                terminal_output=self.terminal_output,
-                unifize=False,
-                verbose=self.verbose)
+            template_brain_mask_file = self._template_product(
+                'brain_mask',
+                lambda write_dir: compute_brain_mask(
+                    self.template, self.brain_volume,
+                    write_dir=write_dir,
+                    caching=self.caching,
+                    terminal_output=self.terminal_output,
+                    unifize=False,
+                    verbose=self.verbose),
+                brain_volume=self.brain_volume,
+                use_rats_tool=self.use_rats_tool)
         else:
             template_brain_mask_file = self.template_brain_mask
 
-        self.template_brain_ = _apply_mask(
-            self.template, template_brain_mask_file,
-            write_dir=self.output_dir,
-            caching=self.caching,
-            terminal_output=self.terminal_output)
+        self.template_brain_ = self._template_product(
+            'brain',
+            lambda write_dir: _apply_mask(
+                self.template, template_brain_mask_file,
+                write_dir=write_dir,
+                caching=self.caching,
+                terminal_output=self.terminal_output),
+            brain_mask=template_brain_mask_file)
+
+        dilated_template_mask = self.dilated_template_mask
+        if dilated_template_mask is None and \
+                self.template_cache_dir is not None:
+            dilated_template_mask = self._template_product(
+                'dilated_head_mask',
+                lambda write_dir: _compute_dilated_head_mask(
+                    self.template, write_dir, caching=self.caching,
+                    terminal_output=self.terminal_output,
+                    verbose=self.verbose)[0])
 
         self.anat_ = anat_file
         if brain_mask_file is None:
@@ -155,7 +193,7 @@ class TemplateRegistrator(BaseRegistrator):
         normalization = anat_to_template(
             self._unifized_anat, self.anat_brain_, self.template,
             self.template_brain_, write_dir=self.output_dir,
-            dilated_head_mask_filename=self.dilated_template_mask,
+            dilated_head_mask_filename=dilated_template_mask,
             caching=self.caching, verbose=self.verbose, maxlev=None,
             convergence=self.convergence,
             registration_kind=self.registration_kind)
@@ -210,7 +248,8 @@ class TemplateRegistrator(BaseRegistrator):
 
     def fit_modality(self, in_file, modality, slice_timing=True, t_r=None,
                      prior_rigid_body_registration=None, reorient_only=False,
-                     voxel_size=None):
+                     voxel_size=None, resampling_operator=False,
+                     mask_file=None):
         """Estimates registration from the space of a given modality to
         the template space.
 
@@ -238,6 +277,18 @@ class TemplateRegistrator(BaseRegistrator):
         reorient_only :  bool, optional
             If True, the rigid-body registration of the anat to the func is
             not performed and only reorientation is done.
+
+        voxel_size : 3-tuple or None, optional
+            The target voxels size. If None, the final voxels size will match
+            the template.
+
+        resampling_operator : bool, optional
+            If True, the normalization to the template is applied with the
+            sparse resampling operator, as in `transform_modality_like`.
+
+        mask_file : str or None, optional
+            Template mask restricting the voxels computed with the resampling
+            operator.
         """
         if prior_rigid_body_registration is not None:
             warn_str = ("The parameter 'prior_rigid_body_registration' is "
@@ -327,7 +378,10 @@ class TemplateRegistrator(BaseRegistrator):
                 self.undistorted_func_, self.template, self.output_dir,
                 self._normalization_transforms + [self._func_to_anat_transform],
                 transforms_kind=self.registration_kind,
-                voxel_size=voxel_size, caching=self.caching)
+                voxel_size=voxel_size,
+                grid_cache_dir=self.template_cache_dir, caching=self.caching,
+                resampling_operator=resampling_operator,
+                mask_filename=mask_file)
         elif modality == 'perf':
             self.perf_brain_ = brain_file
             coregistration = coregister_perf(
@@ -347,13 +401,17 @@ class TemplateRegistrator(BaseRegistrator):
                 self.undistorted_perf_, self.template, self.output_dir,
                 self._normalization_transforms + [self._perf_to_anat_transform],
                 transforms_kind=self.registration_kind,
-                voxel_size=voxel_size, caching=self.caching,
-                verbose=self.verbose)
+                voxel_size=voxel_size,
+                grid_cache_dir=self.template_cache_dir, caching=self.caching,
+                verbose=self.verbose,
+                resampling_operator=resampling_operator,
+                mask_filename=mask_file)
 
         return self
 
     def transform_modality_like(self, in_file, modality,
-                                interpolation='wsinc5', voxel_size=None):
+                                interpolation='wsinc5', voxel_size=None,
+                                resampling_operator=False, mask_file=None):
         """Transforms the given file from the space of the given modality to
         the template space. If the given modality has been corrected for
         EPI distorsions, the same correction is applied.
@@ -375,6 +433,16 @@ class TemplateRegistrator(BaseRegistrator):
             The target voxels size. If None, the final voxels size will match
             the template.
 
+        resampling_operator : bool, optional
+            If True, the transforms are precomputed as a sparse matrix of
+            linear interpolation, stored in the output directory and reused
+            for the files of the same grid, and all the volumes are resampled
+            with a single matrix product. `interpolation` is then ignored.
+
+        mask_file : str or None, optional
+            Template mask, for instance of the brain, restricting the voxels
+            computed with the resampling operator.
+
         Returns
         -------
         transformed_file : str
@@ -396,7 +464,9 @@ class TemplateRegistrator(BaseRegistrator):
             undistorted_file, self.template, self.output_dir,
             self._normalization_transforms + [coreg_transform_file],
             transforms_kind=self.registration_kind,
-            voxel_size=voxel_size, caching=self.caching, verbose=self.verbose)
+            voxel_size=voxel_size, grid_cache_dir=self.template_cache_dir,
+            caching=self.caching, verbose=self.verbose,
+            resampling_operator=resampling_operator, mask_filename=mask_file)
         return normalized_file
 
     def inverse_transform_towards_modality(self, in_file, modality,
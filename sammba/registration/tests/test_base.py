@@ -1,7 +1,9 @@
 import os
+import numpy as np
 from nose import with_setup
-from nose.tools import assert_true
+from nose.tools import assert_true, assert_equal
 import nibabel
+from sklearn.utils import Bunch
 from nilearn.datasets.tests import test_utils as tst
 from nilearn.image import index_img
 from sammba.registration import base
@@ -25,3 +27,134 @@ def test_warp():
     assert_true(_check_same_fov(nibabel.load(registered_anat_oblique_file),
                                 func_img0))
     assert_true(os.path.isfile(mat_file))
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_crop_and_uncrop_warp():
+    affine = np.diag([-.2, -.2, .3, 1.])
+    affine[:3, 3] = [5., 6., -7.]
+    mask_data = np.zeros((20, 22, 10))
+    mask_data[5:9, 6:15, 3:5] = 1
+    mask_file = os.path.join(tst.tmpdir, 'mask.nii.gz')
+    nibabel.Nifti1Image(mask_data, affine).to_filename(mask_file)
+
+    box = base._get_crop_box([mask_file], .4)
+    assert_equal(box, (slice(3, 11), slice(4, 17), slice(1, 7)))
+    cropped_img = nibabel.load(base._crop(mask_file, box))
+    np.testing.assert_array_equal(cropped_img.get_data(),
+                                  mask_data[box])
+    np.testing.assert_array_almost_equal(
+        cropped_img.affine.dot([0, 0, 0, 1]),
+        affine.dot([3, 4, 1, 1]))
+
+    # An affine displacement field is exactly extended to the whole grid
+    linear = np.array([[.1, .02, 0.], [0., -.05, .01], [.03, 0., .02]])
+
+    def affine_displacements(img):
+        voxels = np.indices(img.shape[:3]).reshape(3, -1)
+        world = img.affine[:3, :3].dot(voxels) + img.affine[:3, 3:]
+        return (linear.dot(world) + 1.).T.reshape(img.shape[:3] + (1, 3))
+
+    warp_file = os.path.join(tst.tmpdir, 'warp.nii.gz')
+    nibabel.Nifti1Image(affine_displacements(cropped_img),
+                        cropped_img.affine).to_filename(warp_file)
+    uncropped_img = nibabel.load(base._uncrop_warp(warp_file, mask_file))
+    assert_equal(uncropped_img.shape, (20, 22, 10, 1, 3))
+    np.testing.assert_array_almost_equal(
+        uncropped_img.get_data(),
+        affine_displacements(nibabel.load(mask_file)), decimal=5)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_resample_grid():
+    target_file = os.path.join(tst.tmpdir, 'target.nii.gz')
+    nibabel.Nifti1Image(np.zeros((2, 3, 4)), np.eye(4)).to_filename(
+        target_file)
+    calls = []
+
+    def resample(in_file, voxel_size, out_file, **kwargs):
+        calls.append(voxel_size)
+        nibabel.load(in_file).to_filename(out_file)
+        return Bunch(outputs=Bunch(out_file=out_file))
+
+    # The grid is resampled once per voxel size within the process
+    write_dirs = [os.path.join(tst.tmpdir, name) for name in ['a', 'b']]
+    for write_dir in write_dirs:
+        os.makedirs(write_dir)
+        grid_file = base._resample_grid(target_file, (.3, .3, .3),
+                                        write_dir, resample)
+        assert_true(grid_file.startswith(write_dirs[0]))
+    assert_equal(calls, [(.3, .3, .3)])
+    base._resample_grid(target_file, [.2, .2, .2], write_dirs[1], resample)
+    assert_equal(len(calls), 2)
+
+    # and once per cache directory across processes
+    grid_cache_dir = os.path.join(tst.tmpdir, 'cache')
+    grid_file = base._resample_grid(target_file, (.3, .3, .3),
+                                    write_dirs[1], resample,
+                                    grid_cache_dir=grid_cache_dir)
+    assert_true(grid_file.startswith(grid_cache_dir))
+    base._RESAMPLED_GRIDS.clear()
+    assert_equal(base._resample_grid(target_file, (.3, .3, .3),
+                                     write_dirs[1], resample,
+                                     grid_cache_dir=grid_cache_dir),
+                 grid_file)
+    assert_equal(len(calls), 3)
+
+
+def test_map_slices():
+    # Slices outputs are returned in the slices order
+    for n_jobs in [1, 2]:
+        assert_equal(base._map_slices(pow, n_jobs, range(6), [2] * 6),
+                     [0, 1, 4, 9, 16, 25])
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_save_and_split_perslice_warps():
+    affine = np.diag([.1, .1, .5, 1.])
+    grid_file = os.path.join(tst.tmpdir, 'grid_slice.nii.gz')
+    nibabel.Nifti1Image(np.zeros((3, 4, 1)), affine).to_filename(grid_file)
+    warp_files = []
+    for n in range(3):
+        if n == 1:
+            warp_files.append(None)
+            continue
+        slice_affine = affine.copy()
+        slice_affine[2, 3] = .5 * n
+        warp_files.append(os.path.join(tst.tmpdir, 'warp{}.nii.gz'.format(n)))
+        warp_img = nibabel.Nifti1Image(np.full((3, 4, 1, 1, 3), n + 1.),
+                                       slice_affine)
+        warp_img.set_qform(slice_affine, code=1)
+        warp_img.set_sform(slice_affine, code=1)
+        warp_img.header.set_intent('vector', name='3dQwarp')
+        warp_img.to_filename(warp_files[-1])
+
+    # The warps are stacked in a single image
+    warps_file = base._save_perslice_warps(
+        warp_files, grid_file, os.path.join(tst.tmpdir, 'warps.nii'))
+    warps_img = nibabel.load(warps_file)
+    assert_equal(warps_img.shape, (3, 4, 3, 1, 3))
+    np.testing.assert_array_equal(warps_img.get_fdata()[:, :, 1], 0)
+
+    # and split back with their geometry, without warp for empty slices
+    split_dir = os.path.join(tst.tmpdir, 'split')
+    os.makedirs(split_dir)
+    split_files = base._split_perslice_warps(warps_file, split_dir)
+    assert_true(split_files[1] is None)
+    for warp_file, split_file in zip(warp_files[::2], split_files[::2]):
+        assert_true(split_file.startswith(split_dir))
+        warp_img = nibabel.load(warp_file)
+        split_img = nibabel.load(split_file)
+        np.testing.assert_array_equal(split_img.get_fdata(),
+                                      warp_img.get_fdata())
+        np.testing.assert_array_almost_equal(split_img.affine,
+                                             warp_img.affine)
+
+    # with the header codes and intent of the warps
+    for img in [warps_img] + [nibabel.load(split_file)
+                              for split_file in split_files[::2]]:
+        assert_equal((int(img.header['qform_code']),
+                      int(img.header['sform_code'])), (1, 1))
+        assert_equal(img.header.get_intent(), ('vector', (), '3dQwarp'))
+        np.testing.assert_array_almost_equal(img.get_qform(), img.affine)
+    assert_equal(len(nibabel.load(split_files[0]).header.extensions), 0)
@@ -1,12 +1,12 @@
 import os
-from nose.tools import assert_true, assert_equal, assert_less
+from nose.tools import assert_true, assert_equal
 from nose import with_setup
 import nibabel
 from nilearn.datasets.tests import test_utils as tst
 from nilearn._utils.testing import assert_raises_regex
 from nilearn._utils.niimg_conversions import _check_same_fov
 from nilearn.image import mean_img
-from sammba.registration import FMRISession, func
+from sammba.registration import FMRISession, func, base
 from sammba.orientation import _check_same_obliquity
 from sammba import testing_data
 
@@ -28,10 +28,13 @@ def test_coregister():
     assert_true(_check_same_obliquity(bunch.coreg_anat_,
                                       bunch.coreg_func_))
     assert_true(os.path.isfile(bunch.coreg_transform_))
-    assert_less(0, len(bunch.coreg_warps_))
-    assert_true(bunch.coreg_warps_[-1] is None)  # Last slice in functional
-                                                 # is without signal
-    for warp_file in bunch.coreg_warps_[:-1]:
+    # The per-slice warps are stored in a single file
+    assert_true(os.path.isfile(bunch.coreg_warps_))
+    warp_files = base._split_perslice_warps(bunch.coreg_warps_, tst.tmpdir)
+    assert_equal(len(warp_files), nibabel.load(mean_func_file).shape[2])
+    assert_true(warp_files[-1] is None)  # Last slice in functional
+                                         # is without signal
+    for warp_file in warp_files[:-1]:
         assert_true(os.path.isfile(warp_file))
 
     # Check environement variables setting
@@ -48,8 +51,7 @@ def test_coregister():
     assert_equal(bunch.coreg_func_, bunch2.coreg_func_)
     assert_equal(bunch.coreg_anat_, bunch2.coreg_anat_)
     assert_equal(bunch.coreg_transform_, bunch2.coreg_transform_)
-    for warp_file, warp_file2 in zip(bunch.coreg_warps_, bunch2.coreg_warps_):
-        assert_equal(warp_file, warp_file2)
+    assert_equal(bunch.coreg_warps_, bunch2.coreg_warps_)
 
 
 @with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
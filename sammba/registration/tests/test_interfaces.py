@@ -0,0 +1,219 @@
+import os
+import numpy as np
+import nibabel
+from nose import with_setup
+from nose.tools import assert_equal, assert_false
+from numpy.testing import assert_array_almost_equal, assert_array_equal
+from nipype.interfaces.base import isdefined
+from nilearn._utils.testing import assert_raises_regex
+from nilearn.datasets.tests import test_utils as tst
+from sammba.registration import interfaces, base
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_native_interfaces():
+    affine = np.diag([-.2, .2, .3, 1.])
+    affine[:3, 3] = [5., 6., -7.]
+    data = np.arange(60, dtype=np.int16).reshape((3, 4, 5))
+    in_file = os.path.join(tst.tmpdir, 'in.nii.gz')
+    nibabel.Nifti1Image(data, affine).to_filename(in_file)
+    out_files = [os.path.join(tst.tmpdir, 'out{}.nii.gz'.format(n))
+                 for n in range(5)]
+
+    # The geometry and the datatype of the first image are kept
+    out_calc = interfaces.Calc(in_file_a=in_file, in_file_b=in_file,
+                               expr='ispositive(a-10)*b',
+                               out_file=out_files[0]).run()
+    calc_img = nibabel.load(out_calc.outputs.out_file)
+    assert_array_equal(calc_img.get_fdata(), (data > 10) * data)
+    assert_array_almost_equal(calc_img.affine, affine)
+    assert_equal(calc_img.get_data_dtype(), np.int16)
+    assert_raises_regex(ValueError, 'Unsupported expression',
+                        interfaces.Calc(in_file_a=in_file, expr='foo(a)',
+                                        out_file=out_files[0]).run)
+
+    out_tcat = interfaces.TCat(in_files=[in_file, out_files[0]],
+                               out_file=out_files[1]).run()
+    assert_equal(nibabel.load(out_tcat.outputs.out_file).shape, (3, 4, 5, 2))
+    out_tstat = interfaces.TStat(in_file=out_tcat.outputs.out_file,
+                                 out_file=out_files[2]).run()
+    assert_array_almost_equal(
+        nibabel.load(out_tstat.outputs.out_file).get_fdata(),
+        (data + (data > 10) * data) / 2.)
+
+    # The image center is placed at the origin
+    out_undump = interfaces.Undump(in_file=in_file,
+                                   out_file=out_files[3]).run()
+    out_refit = interfaces.Refit(in_file=out_undump.outputs.out_file,
+                                 xorigin='cen', yorigin='cen',
+                                 zorigin='cen').run()
+    centered_img = nibabel.load(out_refit.outputs.out_file)
+    assert_array_almost_equal(centered_img.affine.dot([1, 1.5, 2, 1]),
+                              [0, 0, 0, 1])
+    assert_array_equal(centered_img.get_fdata(), 0)
+
+    out_copy = interfaces.Copy(in_file=in_file, out_file=out_files[4]).run()
+    interfaces.Refit(in_file=out_copy.outputs.out_file,
+                     duporigin_file=out_refit.outputs.out_file).run()
+    copied_img = nibabel.load(out_copy.outputs.out_file)
+    assert_array_almost_equal(copied_img.affine, centered_img.affine)
+    assert_array_equal(copied_img.get_fdata(), data)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_nwarp_adjust():
+    affine = np.diag([-.5, .5, .6, 1.])
+    warp_files = []
+    head_files = []
+    for n in range(5):
+        # constant displacements along the DICOM x axis
+        displacements = np.zeros((3, 4, 5, 1, 3), dtype=np.float32)
+        displacements[..., 0] = .1 * n
+        warp_files.append(os.path.join(tst.tmpdir,
+                                       'warp{}.nii.gz'.format(n)))
+        nibabel.Nifti1Image(displacements, affine).to_filename(
+            warp_files[-1])
+        head_files.append(os.path.join(tst.tmpdir,
+                                       'head{}.nii.gz'.format(n)))
+        nibabel.Nifti1Image(np.full((3, 4, 5), n, dtype=np.float32),
+                            affine).to_filename(head_files[-1])
+
+    # The adjusted warps are the differences to the mean translation, and
+    # the input warps are left unchanged
+    out_file = os.path.join(tst.tmpdir, 'mean.nii.gz')
+    adjusted_warp_files = [os.path.join(tst.tmpdir,
+                                        'warp{}_adjusted.nii.gz'.format(n))
+                           for n in range(5)]
+    out_adjust = interfaces.NwarpAdjust(warps=warp_files,
+                                        adjusted_warps=adjusted_warp_files,
+                                        in_files=head_files,
+                                        out_file=out_file).run()
+    assert_equal(out_adjust.outputs.adjusted_warps, adjusted_warp_files)
+    for n, (warp_file, adjusted_warp_file) in enumerate(
+            zip(warp_files, adjusted_warp_files)):
+        assert_array_almost_equal(nibabel.load(warp_file).get_fdata()[..., 0],
+                                  .1 * n, decimal=5)
+        warp_img = nibabel.load(adjusted_warp_file)
+        assert_equal(warp_img.shape, (3, 4, 5, 1, 3))
+        assert_array_almost_equal(warp_img.get_fdata()[..., 0],
+                                  .1 * (n - 2), decimal=5)
+        assert_array_almost_equal(warp_img.get_fdata()[..., 1:], 0)
+
+    mean_img = nibabel.load(out_adjust.outputs.out_file)
+    assert_array_almost_equal(mean_img.get_fdata(), 2)
+    assert_array_almost_equal(mean_img.affine, affine)
+
+    # Adjusted warps are left unchanged by a second adjustment
+    readjusted_warp_files = [os.path.join(
+        tst.tmpdir, 'warp{}_readjusted.nii.gz'.format(n)) for n in range(5)]
+    out_adjust = interfaces.NwarpAdjust(
+        warps=adjusted_warp_files,
+        adjusted_warps=readjusted_warp_files).run()
+    assert_false(isdefined(out_adjust.outputs.out_file))
+    for n, warp_file in enumerate(out_adjust.outputs.adjusted_warps):
+        assert_array_almost_equal(nibabel.load(warp_file).get_fdata()[..., 0],
+                                  .1 * (n - 2), decimal=5)
+
+    assert_raises_regex(ValueError, 'number of adjusted warps 1 does not',
+                        interfaces.NwarpAdjust(
+                            warps=warp_files,
+                            adjusted_warps=readjusted_warp_files[:1]).run)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_slice_and_merge():
+    affine = np.diag([-.2, .2, .3, 1.])
+    affine[:3, 3] = [5., 6., -7.]
+    data = np.arange(120, dtype=np.int16).reshape((3, 4, 5, 2))
+    in_file = os.path.join(tst.tmpdir, 'in.nii.gz')
+    img = nibabel.Nifti1Image(data, affine)
+    img.set_qform(affine, code=1)
+    img.set_sform(affine, code=1)
+    img.to_filename(in_file)
+
+    # Slices are named as by fslslice and keep their position in space,
+    # with the qform and sform codes of the image
+    out_base_name = os.path.join(tst.tmpdir, 'in')
+    out_slice = interfaces.Slice(in_file=in_file,
+                                 out_base_name=out_base_name).run()
+    assert_equal(out_slice.outputs.out_files,
+                 [out_base_name + '_slice_{0:04d}.nii.gz'.format(n)
+                  for n in range(5)])
+    for n, slice_file in enumerate(out_slice.outputs.out_files):
+        slice_img = nibabel.load(slice_file)
+        assert_array_equal(slice_img.get_fdata(), data[:, :, n:n + 1])
+        assert_array_almost_equal(slice_img.affine.dot([0, 0, 0, 1]),
+                                  affine.dot([0, 0, n, 1]))
+        assert_array_almost_equal(slice_img.affine[:3, :3], affine[:3, :3])
+        qform, qform_code = slice_img.get_qform(coded=True)
+        sform, sform_code = slice_img.get_sform(coded=True)
+        assert_equal((qform_code, sform_code), (1, 1))
+        assert_array_almost_equal(qform, slice_img.affine)
+        assert_array_almost_equal(sform, slice_img.affine)
+
+    # Merging the slices gives back the image
+    out_merge = interfaces.Merge(
+        in_files=out_slice.outputs.out_files,
+        merged_file=os.path.join(tst.tmpdir, 'merged.nii.gz')).run()
+    merged_img = nibabel.load(out_merge.outputs.merged_file)
+    assert_array_equal(merged_img.get_fdata(), data)
+    assert_array_almost_equal(merged_img.affine, affine)
+    assert_equal(merged_img.get_data_dtype(), np.int16)
+
+    # The merged image is named after the first slice by default
+    current_dir = os.getcwd()
+    os.chdir(tst.tmpdir)
+    try:
+        out_merge = interfaces.Merge(
+            in_files=out_slice.outputs.out_files).run()
+    finally:
+        os.chdir(current_dir)
+    assert_equal(out_merge.outputs.merged_file,
+                 out_base_name + '_slice_0000_merged.nii.gz')
+    assert_array_equal(nibabel.load(out_merge.outputs.merged_file).get_fdata(),
+                       data)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_per_slice_nwarp_apply():
+    affine = np.diag([.2, .2, .5, 1.])
+    data = np.random.RandomState(0).rand(6, 5, 3, 4)
+    in_file = os.path.join(tst.tmpdir, 'in.nii.gz')
+    nibabel.Nifti1Image(data, affine).to_filename(in_file)
+
+    # Warps on a finer in-plane grid, shifting the first slice by one voxel
+    # along x, the last slice being without warp
+    warp_affine = np.diag([.1, .1, .5, 1.])
+    warp_files = []
+    for n in range(2):
+        warp_files.append(os.path.join(tst.tmpdir,
+                                       'warp{}.nii.gz'.format(n)))
+        displacements = np.zeros((12, 10, 1, 1, 3))
+        displacements[..., 0] = -.2 * (1 - n)  # DICOM x is towards the left
+        slice_affine = warp_affine.copy()
+        slice_affine[2, 3] = .5 * n
+        nibabel.Nifti1Image(displacements, slice_affine).to_filename(
+            warp_files[-1])
+    grid_file = warp_files[0]
+    warps_file = base._save_perslice_warps(
+        warp_files + [None], grid_file,
+        os.path.join(tst.tmpdir, 'warps.nii'))
+
+    out_file = os.path.join(tst.tmpdir, 'out.nii.gz')
+    out_apply = interfaces.PerSliceNwarpApply(in_file=in_file,
+                                              warps=warps_file,
+                                              block_size=3,
+                                              out_file=out_file).run()
+    out_img = nibabel.load(out_apply.outputs.out_file)
+    assert_equal(out_img.shape, data.shape)
+    assert_array_almost_equal(out_img.affine, affine)
+    out_data = out_img.get_fdata()
+    assert_array_almost_equal(out_data[:-1, :, 0], data[1:, :, 0], decimal=5)
+    assert_array_almost_equal(out_data[-1, :, 0], 0)
+    assert_array_almost_equal(out_data[:, :, 1:], data[:, :, 1:], decimal=5)
+
+    # The warps must match the slices
+    nibabel.Nifti1Image(data[:, :, :2], affine).to_filename(in_file)
+    assert_raises_regex(ValueError, 'number of warps 3 does not match',
+                        interfaces.PerSliceNwarpApply(
+                            in_file=in_file, warps=warps_file).run)
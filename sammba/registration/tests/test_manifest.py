@@ -0,0 +1,73 @@
+import os
+from nose.tools import assert_true, assert_equal
+from nose import with_setup
+from nilearn.datasets.tests import test_utils as tst
+from sammba.registration import manifest
+
+
+def _write(filename, content):
+    with open(filename, 'w') as fp:
+        fp.write(content)
+    return filename
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_run_manifest():
+    manifest_file = os.path.join(tst.tmpdir, 'manifest.json')
+    first_file = _write(os.path.join(tst.tmpdir, 'first.txt'), 'first')
+    second_file = _write(os.path.join(tst.tmpdir, 'second.txt'), 'second')
+    calls = []
+
+    def stage(outputs):
+        def run():
+            calls.append(outputs)
+            return outputs
+        return run
+
+    run_manifest = manifest.RunManifest(manifest_file, 'hash')
+    manifest.run_stage(run_manifest, 'first', stage({'files': [first_file]}))
+    manifest.run_stage(run_manifest, 'second', stage(second_file))
+    assert_true(os.path.isfile(manifest_file))
+    assert_equal(len(calls), 2)
+
+    # Completed stages are skipped on rerun
+    run_manifest = manifest.RunManifest(manifest_file, 'hash')
+    outputs = manifest.run_stage(run_manifest, 'first', stage(None))
+    assert_equal(outputs, {'files': [first_file]})
+    assert_equal(len(calls), 2)
+
+    # Touching a file without changing it keeps the stage valid
+    os.utime(first_file, (0, 0))
+    run_manifest = manifest.RunManifest(manifest_file, 'hash')
+    manifest.run_stage(run_manifest, 'first', stage(None))
+    assert_equal(len(calls), 2)
+
+    # A modified output invalidates its stage and the following ones
+    _write(first_file, 'modified')
+    run_manifest = manifest.RunManifest(manifest_file, 'hash')
+    manifest.run_stage(run_manifest, 'first', stage({'files': [first_file]}))
+    assert_equal(len(calls), 3)
+    assert_equal([stage['name'] for stage in run_manifest.stages], ['first'])
+
+    # Changed parameters discard all the stages
+    run_manifest = manifest.RunManifest(manifest_file, 'other_hash')
+    assert_equal(run_manifest.stages, [])
+
+    # Without manifest, stages are always run
+    manifest.run_stage(None, 'first', stage(first_file))
+    assert_equal(len(calls), 4)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_hash_parameters():
+    filename = _write(os.path.join(tst.tmpdir, 'anat.txt'), 'anat')
+    parameters_hash = manifest.hash_parameters({'files': [filename],
+                                                'level': 1})
+    assert_equal(parameters_hash,
+                 manifest.hash_parameters({'level': 1,
+                                           'files': [filename]}))
+    assert_true(parameters_hash !=
+                manifest.hash_parameters({'files': [filename], 'level': 2}))
+    _write(filename, 'modified anat')
+    assert_true(parameters_hash !=
+                manifest.hash_parameters({'files': [filename], 'level': 1}))
@@ -0,0 +1,51 @@
+import os
+import numpy as np
+import nibabel
+from nose.tools import assert_equal
+from nose import with_setup
+from numpy.testing import assert_array_almost_equal
+from nilearn.datasets.tests import test_utils as tst
+from scipy import sparse
+from sammba.registration import resampling
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_resampling_operator():
+    shape = (5, 4, 3)
+    affine = np.diag([.2, .2, .5, 1])
+    data = np.random.RandomState(0).rand(*(shape + (6,)))
+    in_file = os.path.join(tst.tmpdir, 'func.nii.gz')
+    nibabel.Nifti1Image(data, affine).to_filename(in_file)
+    coordinates_file = resampling.write_coordinates(
+        in_file, os.path.join(tst.tmpdir, 'coordinates.nii.gz'))
+    coordinates = nibabel.load(coordinates_file).get_fdata()
+    assert_equal(coordinates.shape, shape + (4,))
+    assert_array_almost_equal(coordinates[2, 1, 0], [2, 1, 0, 1])
+
+    # Half a voxel shift along x, the last target voxel being outside
+    coordinates[..., 0] += .5
+    shifted_file = os.path.join(tst.tmpdir, 'shifted_coordinates.nii.gz')
+    nibabel.Nifti1Image(coordinates, affine).to_filename(shifted_file)
+    operator = resampling.compute_operator(shifted_file, shape)
+    assert_equal(operator.shape, (60, 60))
+    operator_file = os.path.join(tst.tmpdir, 'operator.npz')
+    sparse.save_npz(operator_file, operator)
+    out_file = resampling.apply_operator(
+        operator_file, in_file, in_file,
+        os.path.join(tst.tmpdir, 'normalized.nii.gz'), block_size=4)
+    out_img = nibabel.load(out_file)
+    assert_equal(out_img.shape, data.shape)
+    assert_array_almost_equal(out_img.get_fdata()[:-1],
+                              (data[:-1] + data[1:]) / 2., decimal=5)
+    assert_array_almost_equal(out_img.get_fdata()[-1], data[-1] / 2.,
+                              decimal=5)
+
+    # Voxels outside the mask are not computed
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[1:3] = 1
+    mask_file = os.path.join(tst.tmpdir, 'mask.nii.gz')
+    nibabel.Nifti1Image(mask, affine).to_filename(mask_file)
+    operator = resampling.compute_operator(shifted_file, shape,
+                                           mask_file=mask_file)
+    assert_array_almost_equal(operator.getnnz(axis=1).reshape(shape),
+                              2 * mask)
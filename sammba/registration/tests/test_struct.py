@@ -1,6 +1,7 @@
 import os
 import numpy as np
-from nose.tools import assert_true
+import nibabel
+from nose.tools import assert_true, assert_equal
 from nose import with_setup
 from numpy.testing import assert_array_almost_equal
 from nilearn._utils.testing import assert_raises_regex
@@ -19,15 +20,224 @@ def test_anats_to_common():
     assert_raises_regex(ValueError, "Registration kind must be one of ",
                         struct.anats_to_common, [anat_file], tst.tmpdir, 400,
                         registration_kind='rigidd')
+    assert_raises_regex(ValueError, "One downsampling factor per nonlinear",
+                        struct.anats_to_common, [anat_file] * 5, tst.tmpdir,
+                        400, registration_kind='nonlinear',
+                        nonlinear_levels=[1, 2, 3],
+                        nonlinear_downsampling_factors=[4, 2])
 
     # test common space of one image is itself
+    current_dir = os.getcwd()
     rigid = struct.anats_to_common(
         [anat_file], tst.tmpdir, 400, registration_kind='rigid', verbose=0,
         use_rats_tool=False)
     transform = np.loadtxt(rigid.transforms[0])
+
+    # test the working directory is left unchanged
+    assert_equal(os.getcwd(), current_dir)
+    assert_true(os.path.isabs(rigid.template))
     assert_array_almost_equal(transform,
                               [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0])
 
+    # test parallel processing gives the same transforms
+    serial_dir = os.path.join(tst.tmpdir, 'serial')
+    parallel_dir = os.path.join(tst.tmpdir, 'parallel')
+    os.makedirs(serial_dir)
+    os.makedirs(parallel_dir)
+    serial = struct.anats_to_common(
+        [anat_file, anat_file], serial_dir, 400, registration_kind='rigid',
+        verbose=0, use_rats_tool=False)
+    parallel = struct.anats_to_common(
+        [anat_file, anat_file], parallel_dir, 400, registration_kind='rigid',
+        verbose=0, use_rats_tool=False, n_jobs=2)
+    for serial_transform, parallel_transform in zip(serial.transforms,
+                                                    parallel.transforms):
+        assert_array_almost_equal(np.loadtxt(serial_transform),
+                                  np.loadtxt(parallel_transform))
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_template_change():
+    affine = np.eye(4)
+    mask = np.zeros((5, 5, 5))
+    mask[1:4, 1:4, 1:4] = 1
+    previous_template = np.ones((5, 5, 5))
+    template = previous_template * 1.1
+    template[0] = 100  # outside the mask
+    mask_file = os.path.join(tst.tmpdir, 'mask.nii.gz')
+    previous_template_file = os.path.join(tst.tmpdir, 'previous.nii.gz')
+    template_file = os.path.join(tst.tmpdir, 'template.nii.gz')
+    nibabel.Nifti1Image(mask, affine).to_filename(mask_file)
+    nibabel.Nifti1Image(previous_template, affine).to_filename(
+        previous_template_file)
+    nibabel.Nifti1Image(template, affine).to_filename(template_file)
+    assert_array_almost_equal(
+        struct._template_change(previous_template_file, template_file,
+                                mask_file), .1)
+    assert_array_almost_equal(
+        struct._template_change(template_file, template_file, mask_file), 0)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_mean_anats():
+    affine = np.diag([.1, .2, .3, 1.])
+    in_files = []
+    for n in range(3):
+        in_files.append(os.path.join(tst.tmpdir, 'anat{}.nii.gz'.format(n)))
+        nibabel.Nifti1Image(np.full((3, 4, 5), n, dtype=np.int16),
+                            affine).to_filename(in_files[-1])
+    mean_file = struct._mean_anats(in_files,
+                                   os.path.join(tst.tmpdir, 'mean.nii.gz'))
+    mean_img = nibabel.load(mean_file)
+    assert_array_almost_equal(mean_img.get_fdata(), 1)
+    assert_array_almost_equal(mean_img.affine, affine)
+    assert_equal(mean_img.get_data_dtype(), np.float32)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_average_anats():
+    affine = np.eye(4)
+    in_files = []
+    for value in [0, 1, 2, 3, 4, 5, 6, 7, 8, 100]:
+        in_files.append(os.path.join(tst.tmpdir,
+                                     'anat{}.nii.gz'.format(value)))
+        nibabel.Nifti1Image(np.full((3, 4, 5), value, dtype=np.int16),
+                            affine).to_filename(in_files[-1])
+    out_file = os.path.join(tst.tmpdir, 'average.nii.gz')
+    assert_raises_regex(ValueError, "Template average must be one of ",
+                        struct._average_anats, in_files, out_file,
+                        template_average='mode')
+
+    # a memory limit of less than a slice still processes one slice at once
+    struct._average_anats(in_files, out_file, template_average='median',
+                          memory_limit=1e-4)
+    assert_array_almost_equal(nibabel.load(out_file).get_fdata(), 4.5)
+    struct._average_anats(in_files, out_file,
+                          template_average='trimmed_mean')
+    assert_array_almost_equal(nibabel.load(out_file).get_fdata(), 4.5)
+    struct._average_anats(in_files, out_file)
+    assert_array_almost_equal(nibabel.load(out_file).get_fdata(), 13.6)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_adjust_warps():
+    affine = np.diag([-.5, .5, .6, 1.])
+    warp_files = []
+    for n in range(5):
+        displacements = np.zeros((3, 4, 5, 1, 3), dtype=np.float32)
+        displacements[..., 0] = .1 * n
+        warp_files.append(os.path.join(tst.tmpdir,
+                                       'warp{}.nii.gz'.format(n)))
+        nibabel.Nifti1Image(displacements, affine).to_filename(
+            warp_files[-1])
+
+    # The warps are adjusted to new files, also when rerun from the cache
+    steps = struct._get_template_steps(
+        struct._get_compute_mask_interface(False), tst.tmpdir, caching=True,
+        backend='native')
+    for _ in range(2):
+        adjusted_warp_files = struct._adjust_warps(steps.nwarp_adjust,
+                                                   warp_files, tst.tmpdir)
+        assert_equal(adjusted_warp_files,
+                     [os.path.join(tst.tmpdir,
+                                   'warp{}_adjusted.nii.gz'.format(n))
+                      for n in range(5)])
+        for n, (warp_file, adjusted_warp_file) in enumerate(
+                zip(warp_files, adjusted_warp_files)):
+            assert_array_almost_equal(
+                nibabel.load(warp_file).get_fdata()[..., 0], .1 * n)
+            assert_array_almost_equal(
+                nibabel.load(adjusted_warp_file).get_fdata()[..., 0],
+                .1 * (n - 2), decimal=5)
+
+    # AFNI adjusts copies of the warps
+    adjusted_inputs = []
+
+    def nwarp_adjust(warps, **inputs):
+        adjusted_inputs.extend(warps)
+        return steps.nwarp_adjust(warps=warps, **inputs)
+
+    copy_dir = os.path.join(tst.tmpdir, 'copies')
+    os.makedirs(copy_dir)
+    adjusted_warp_files = struct._adjust_warps(
+        struct._copy_and_adjust(nwarp_adjust), warp_files, copy_dir)
+    assert_equal(adjusted_inputs, adjusted_warp_files)
+    assert_array_almost_equal(
+        nibabel.load(warp_files[1]).get_fdata()[..., 0], .1)
+
+
+def test_select_subset():
+    strata = [0] * 6 + [1] * 3
+    subset = struct._select_subset(9, 6, strata=strata, random_state=0)
+    assert_equal(len(subset), 6)
+    assert_equal(len([n for n in subset if strata[n] == 1]), 2)
+    assert_equal(subset, struct._select_subset(9, 6, strata=strata,
+                                               random_state=0))
+    assert_raises_regex(ValueError, "One stratum per animal",
+                        struct._select_subset, 9, 6, strata=[0, 1])
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_add_anats_to_common():
+    anat_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'anat.nii.gz')
+    # Check error is raised if previous results are incomplete
+    assert_raises_regex(ValueError, "template is missing",
+                        struct.add_anats_to_common, [anat_file],
+                        {'registered': [], 'transforms': [],
+                         'centered': []}, tst.tmpdir, 400)
+
+    rigid = struct.anats_to_common(
+        [anat_file], tst.tmpdir, 400, registration_kind='rigid', verbose=0,
+        use_rats_tool=False)
+    added = struct.add_anats_to_common(
+        [anat_file], rigid, tst.tmpdir, 400, registration_kind='rigid',
+        verbose=0, use_rats_tool=False)
+    assert_true(len(added.registered) == 2)
+    assert_true(len(added.transforms) == 2)
+    assert_equal(len(added.centers), 2)
+    assert_true(os.path.isfile(added.template))
+
+    # the new copy of the same image is registered to itself
+    assert_array_almost_equal(np.loadtxt(added.transforms[1]),
+                              [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0],
+                              decimal=2)
+
+    # the outputs of the previous update passes are overwritten
+    updated_dir = os.path.join(tst.tmpdir, 'updated')
+    os.makedirs(updated_dir)
+    updated = struct.add_anats_to_common(
+        [anat_file], rigid, updated_dir, 400, registration_kind='rigid',
+        n_update_iterations=2, caching=False, verbose=0,
+        use_rats_tool=False)
+    assert_true(os.path.isfile(updated.template))
+    assert_true(os.path.isfile(os.path.join(
+        updated_dir, 'added_2_registered_heads.nii.gz')))
+    assert_array_almost_equal(np.loadtxt(updated.transforms[1]),
+                              [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0],
+                              decimal=2)
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_hierarchical_anats_to_common():
+    anat_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'anat.nii.gz')
+    assert_raises_regex(ValueError, "At least 5 groups of 5 animals",
+                        struct.hierarchical_anats_to_common, [anat_file] * 10,
+                        tst.tmpdir, 400, 5, registration_kind='nonlinear')
+
+    # groups of the same image are registered to themselves
+    hierarchical = struct.hierarchical_anats_to_common(
+        [anat_file] * 3, tst.tmpdir, 400, 2, registration_kind='rigid',
+        verbose=0, use_rats_tool=False)
+    assert_equal(hierarchical.groups, [[0, 1], [2]])
+    assert_true(len(hierarchical.registered) == 3)
+    assert_true(os.path.isfile(hierarchical.template))
+    for transform_file in hierarchical.transforms:
+        assert_array_almost_equal(np.loadtxt(transform_file),
+                                  [1, 0, 0, 0, 0, 1, 0, 0, 0, 0, 1, 0],
+                                  decimal=1)
+
 
 @with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
 def test_anat_to_template():
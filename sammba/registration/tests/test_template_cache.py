@@ -0,0 +1,56 @@
+import os
+import shutil
+from nose.tools import assert_true, assert_equal, assert_not_equal
+from nose import with_setup
+from nilearn.datasets.tests import test_utils as tst
+from sammba.registration import template_cache
+
+
+def _write(filename, content):
+    with open(filename, 'w') as fp:
+        fp.write(content)
+    return filename
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_template_cache():
+    cache_dir = os.path.join(tst.tmpdir, 'cache')
+    template_file = _write(os.path.join(tst.tmpdir, 'template.txt'),
+                           'template')
+    mask_file = _write(os.path.join(tst.tmpdir, 'mask.txt'), 'mask')
+    calls = []
+
+    def compute(write_dir):
+        calls.append(write_dir)
+        return _write(os.path.join(write_dir, 'product.txt'), 'product')
+
+    cache = template_cache.TemplateCache(cache_dir)
+    product_file = cache.get('product', template_file, compute, size=1,
+                             mask=mask_file)
+    assert_true(os.path.isfile(product_file))
+    assert_true(product_file.startswith(cache_dir))
+    assert_equal(len(calls), 1)
+
+    # The product is reused for a copy of the template and of the mask
+    other_dir = os.path.join(tst.tmpdir, 'other')
+    os.makedirs(other_dir)
+    template_copy = shutil.copy(template_file, other_dir)
+    mask_copy = shutil.copy(mask_file, other_dir)
+    assert_equal(template_cache.TemplateCache(cache_dir).get(
+        'product', template_copy, compute, size=1, mask=mask_copy),
+        product_file)
+    assert_equal(len(calls), 1)
+
+    # The product is recomputed if the parameters or the template change
+    assert_not_equal(cache.get('product', template_file, compute, size=2,
+                               mask=mask_file), product_file)
+    assert_equal(len(calls), 2)
+    _write(template_copy, 'other template')
+    cache.get('product', template_copy, compute, size=1, mask=mask_file)
+    assert_equal(len(calls), 3)
+
+    # or if it was removed
+    os.remove(product_file)
+    assert_equal(cache.get('product', template_file, compute, size=1,
+                           mask=mask_file), product_file)
+    assert_equal(len(calls), 4)
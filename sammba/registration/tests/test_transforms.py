@@ -0,0 +1,65 @@
+import os
+from nose.tools import assert_true, assert_equal
+from nose import with_setup
+from numpy.testing import assert_array_almost_equal
+from nilearn.datasets.tests import test_utils as tst
+from nilearn._utils.testing import assert_raises_regex
+from sammba.registration import transforms
+
+
+def _write(filename, content):
+    with open(filename, 'w') as fp:
+        fp.write(content)
+    return filename
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_compose_chain():
+    # 1D files on one line or as 3 rows, with comments
+    shift_file = _write(os.path.join(tst.tmpdir, 'shift.aff12.1D'),
+                        '# 3dAllineate matrix\n'
+                        '1 0 0 2 0 1 0 0 0 0 1 0\n')
+    scale_file = _write(os.path.join(tst.tmpdir, 'scale.aff12.1D'),
+                        '2 0 0 0\n0 2 0 0\n0 0 2 0  # rows\n')
+    warp_file = _write(os.path.join(tst.tmpdir, 'warp.nii.gz'), 'warp')
+    shift = transforms.load_transform(shift_file)
+    scale = transforms.load_transform(scale_file)
+    assert_array_almost_equal(shift.compose(scale).matrix.dot([1, 0, 0, 1]),
+                              [4, 0, 0, 1])
+
+    # Successive affine transforms are collapsed
+    out_prefix = os.path.join(tst.tmpdir, 'chain')
+    composed_files = transforms.compose_chain(
+        [warp_file, shift_file, scale_file], out_prefix)
+    assert_equal(composed_files, [warp_file, out_prefix + '.aff12.1D'])
+    composed = transforms.load_transform(composed_files[1])
+    assert_array_almost_equal(composed.matrix,
+                              shift.compose(scale).matrix)
+    composed_files = transforms.compose_chain(
+        [shift_file, warp_file, scale_file], out_prefix)
+    assert_equal(composed_files, [out_prefix + '_0.aff12.1D', warp_file,
+                                  out_prefix + '_2.aff12.1D'])
+
+    # Affine chains are inverted, and reused while unchanged
+    inverse_file, = transforms.compose_chain([shift_file, scale_file],
+                                             out_prefix + '_INV',
+                                             inverse=True)
+    inverse = transforms.load_transform(inverse_file)
+    assert_array_almost_equal(inverse.matrix.dot([4, 0, 0, 1]),
+                              [1, 0, 0, 1])
+    mtime = os.stat(inverse_file).st_mtime_ns
+    assert_equal(transforms.compose_chain([shift_file, scale_file],
+                                          out_prefix + '_INV',
+                                          inverse=True),
+                 [inverse_file])
+    assert_equal(os.stat(inverse_file).st_mtime_ns, mtime)
+    transforms._CHAINS.clear()
+
+    assert_raises_regex(ValueError, 'Only affine chains can be inverted',
+                        transforms.compose_chain, [warp_file, shift_file],
+                        out_prefix, inverse=True)
+    _write(shift_file, '1 0 0 2\n')
+    assert_raises_regex(ValueError, 'must contain a single affine',
+                        transforms.load_transform, shift_file)
+    assert_true(isinstance(transforms.load_transform(warp_file),
+                           transforms.WarpTransform))
@@ -0,0 +1,76 @@
+import os
+from nose.tools import assert_true, assert_equal, assert_false
+from nose import with_setup
+from nilearn.datasets.tests import test_utils as tst
+from sammba.registration import workflows
+from sammba.segmentation import HistogramMask
+from sammba import testing_data
+
+
+def test_create_anats_to_common_workflow():
+    anat_file = os.path.join(os.path.dirname(testing_data.__file__),
+                             'anat.nii.gz')
+    workflow, outputs = \
+        workflows._create_anats_to_common_workflow(
+            [anat_file] * 5, '/tmp', 400, HistogramMask,
+            registration_kind='nonlinear', nonlinear_levels=[1, 2],
+            nonlinear_minimal_patches=[75])
+    node_names = workflow.list_node_names()
+    registered = outputs['registered']
+    transforms = outputs['transforms']
+    assert_equal(len(registered), 5)
+    assert_equal(len(transforms), 5)
+    for node_name, _ in registered + transforms:
+        assert_true(node_name in node_names)
+
+    # per-animal steps are separate nodes
+    for n in range(5):
+        assert_true('shift_rotate_{}'.format(n) in node_names)
+        assert_true('qwarp2_{}'.format(n) in node_names)
+
+    # last warps are the adjusted warps of the minimal patch cycle, which
+    # are applied and initialize the next cycle
+    assert_equal(transforms[0], ('select_adjusted_warp2_0', 'out'))
+    assert_equal(outputs['template'], [('nwarp_adjust2', 'out_file')])
+    nodes = dict((node.name, node) for node in workflow._graph.nodes())
+    assert_true(nodes['select_adjusted_warp2_0'] in
+                workflow._graph.predecessors(nodes['warp_apply_0']))
+    assert_true(nodes['select_adjusted_warp1_0'] in
+                workflow._graph.predecessors(nodes['qwarp2_0']))
+
+    workflow, outputs = \
+        workflows._create_anats_to_common_workflow(
+            [anat_file] * 2, '/tmp', 400, HistogramMask,
+            registration_kind='rigid')
+    assert_equal(outputs['registered'], [('apply_shift_rotate_0', 'out_file'),
+                              ('apply_shift_rotate_1', 'out_file')])
+    assert_equal(outputs['transforms'], [('shift_rotate_0', 'out_matrix'),
+                                         ('shift_rotate_1', 'out_matrix')])
+    assert_equal(outputs['centered'], [('center_head_0', 'out_file'),
+                                       ('center_head_1', 'out_file')])
+
+
+@with_setup(tst.setup_tmpdata, tst.teardown_tmpdata)
+def test_copied_nwarp_adjust():
+    warp_files = []
+    for n in range(5):
+        warp_files.append(os.path.join(tst.tmpdir,
+                                       'warp{}.nii.gz'.format(n)))
+        open(warp_files[-1], 'w').close()
+
+    # 3dNwarpAdjust runs on the copies in the working directory
+    current_dir = os.getcwd()
+    os.chdir(tst.tmpdir)
+    try:
+        adjust = workflows._CopiedNwarpAdjust(warps=warp_files)
+        adjusted_warp_files = adjust._list_outputs()['adjusted_warps']
+        cmdline = adjust.cmdline
+    finally:
+        os.chdir(current_dir)
+    assert_equal(adjusted_warp_files,
+                 [os.path.join(tst.tmpdir, 'warp{}_adjusted.nii.gz'.format(n))
+                  for n in range(5)])
+    for warp_file, adjusted_warp_file in zip(warp_files,
+                                             adjusted_warp_files):
+        assert_true(adjusted_warp_file in cmdline)
+        assert_false(warp_file + ' ' in cmdline)
@@ -0,0 +1,148 @@
+"""
+In-process handling of the chains of AFNI transforms: affine matrices stored
+in 1D files are composed and inverted with NumPy, so that a chain is applied
+with a single resampling and without 3dcatmatvec.
+"""
+import os
+import numpy as np
+from .template_cache import file_checksum
+
+
+# Composed chains of this process, by source, target, transforms and
+# inversion
+_CHAINS = {}
+
+
+class AffineTransform(object):
+    """ Affine transform of AFNI, mapping the DICOM coordinates of the
+    target to those of the source.
+
+    Parameters
+    ----------
+    matrix : numpy.ndarray of shape (4, 4)
+        Homogeneous matrix of the transform.
+    """
+    def __init__(self, matrix):
+        self.matrix = np.asarray(matrix, dtype=float)
+
+    @classmethod
+    def from_file(cls, filename):
+        """ Reads the 12 numbers of the matrix rows from an AFNI 1D file,
+        on one or several lines.
+        """
+        values = []
+        with open(filename) as fp:
+            for line in fp:
+                line = line.split('#')[0].strip()
+                if line:
+                    values.extend(float(value) for value in line.split())
+        if len(values) != 12:
+            raise ValueError('{0} must contain a single affine transform, '
+                             'found {1} values'.format(filename,
+                                                       len(values)))
+
+        return cls(np.vstack([np.reshape(values, (3, 4)), [0, 0, 0, 1]]))
+
+    def to_file(self, filename):
+        """ Writes the matrix on one line, as 3dcatmatvec -ONELINE does.
+        """
+        with open(filename, 'w') as fp:
+            fp.write('# sammba composed transform\n')
+            fp.write(' '.join('{0:.9g}'.format(value)
+                              for value in self.matrix[:3].ravel()) + '\n')
+        return filename
+
+    def compose(self, other):
+        """ Returns the transform applying `other` first, then this one,
+        as listed in 3dcatmatvec or 3dNwarpApply.
+        """
+        return AffineTransform(self.matrix.dot(other.matrix))
+
+    def inverse(self):
+        return AffineTransform(np.linalg.inv(self.matrix))
+
+
+class WarpTransform(object):
+    """ Nonlinear transform of AFNI, stored as a warp image.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the warp image.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+
+
+def load_transform(filename):
+    """ Returns the affine transform of an AFNI 1D file, or the warp
+    transform of an image.
+    """
+    if filename.endswith('.1D'):
+        return AffineTransform.from_file(filename)
+
+    return WarpTransform(filename)
+
+
+def collapse_transforms(transforms):
+    """ Returns the transforms with each run of successive affine transforms
+    composed into a single one.
+    """
+    collapsed = []
+    for transform in transforms:
+        if (isinstance(transform, AffineTransform) and collapsed and
+                isinstance(collapsed[-1], AffineTransform)):
+            collapsed[-1] = collapsed[-1].compose(transform)
+        else:
+            collapsed.append(transform)
+
+    return collapsed
+
+
+def compose_chain(transform_files, out_prefix, source_file=None,
+                  target_file=None, inverse=False):
+    """ Composes the successive affine transforms of a chain, listed in
+    3dNwarpApply order, and returns the files of the composed chain. The
+    composed affine transforms are written to `out_prefix` with the
+    .aff12.1D extension, and an index suffix if several remain. If `inverse`
+    is True, the chain must be affine and its inverse is written. Chains
+    composed once in the process for the same source, target and transforms
+    content are reused as long as their files are unchanged.
+    """
+    key = (source_file and os.path.abspath(source_file),
+           target_file and os.path.abspath(target_file),
+           tuple((os.path.abspath(transform_file),
+                  file_checksum(transform_file))
+                 for transform_file in transform_files), inverse)
+    if key in _CHAINS:
+        composed_files, checksums = _CHAINS[key]
+        if all(os.path.isfile(composed_file) and
+               file_checksum(composed_file) == checksum
+               for (composed_file, checksum) in zip(composed_files,
+                                                    checksums)):
+            return composed_files
+
+    transforms = collapse_transforms([load_transform(transform_file)
+                                      for transform_file in transform_files])
+    if inverse:
+        if len(transforms) > 1 or isinstance(transforms[0], WarpTransform):
+            raise ValueError('Only affine chains can be inverted, you '
+                             'entered {0}'.format(transform_files))
+        transforms = [transforms[0].inverse()]
+
+    n_affines = sum(isinstance(transform, AffineTransform)
+                    for transform in transforms)
+    composed_files = []
+    for transform in transforms:
+        if isinstance(transform, WarpTransform):
+            composed_files.append(transform.filename)
+        elif n_affines == 1:
+            composed_files.append(transform.to_file(out_prefix + '.aff12.1D'))
+        else:
+            composed_files.append(transform.to_file('{0}_{1}.aff12.1D'.format(
+                out_prefix, len(composed_files))))
+
+    _CHAINS[key] = (composed_files,
+                    [file_checksum(composed_file)
+                     for composed_file in composed_files])
+    return composed_files
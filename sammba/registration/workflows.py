@@ -0,0 +1,468 @@
+"""
+Executable nipype workflows for the template building pipelines.
+"""
+import os
+import shutil
+from nipype.interfaces import afni
+from nipype.interfaces import utility as niu
+from nipype.interfaces.afni.base import AFNICommandOutputSpec
+from nipype.interfaces.base import OutputMultiPath, traits
+import nipype.pipeline.engine as pe
+from nipype.utils.filemanip import fname_presuffix
+
+
+def _to_int(value):
+    return int(value)
+
+
+def _to_list(value):
+    return [value]
+
+
+def _to_oneline_matrices(matrices):
+    return [(matrix, 'ONELINE') for matrix in matrices]
+
+
+def _to_identity_warp_inputs(files):
+    # files are the head and its affine transform
+    return [('IDENT', files[0]), files[1]]
+
+
+class _CopiedNwarpAdjustOutputSpec(AFNICommandOutputSpec):
+    adjusted_warps = OutputMultiPath(traits.File(exists=True),
+                                     desc='Adjusted warps')
+
+
+class _CopiedNwarpAdjust(afni.NwarpAdjust):
+    """ AFNI 3dNwarpAdjust run on copies of the warps in the node directory,
+    since it adjusts the warps in place, so that the outputs of the upstream
+    nodes are left unchanged. The adjusted copies are listed as outputs.
+    """
+    output_spec = _CopiedNwarpAdjustOutputSpec
+
+    def _adjusted_warps(self):
+        return [fname_presuffix(warp_file, suffix='_adjusted',
+                                newpath=os.getcwd())
+                for warp_file in self.inputs.warps]
+
+    def _format_arg(self, name, trait_spec, value):
+        if name == 'warps':
+            value = self._adjusted_warps()
+        return super(_CopiedNwarpAdjust, self)._format_arg(name, trait_spec,
+                                                           value)
+
+    def _run_interface(self, runtime):
+        for warp_file, adjusted_warp_file in zip(self.inputs.warps,
+                                                 self._adjusted_warps()):
+            shutil.copy(warp_file, adjusted_warp_file)
+        return super(_CopiedNwarpAdjust, self)._run_interface(runtime)
+
+    def _list_outputs(self):
+        outputs = super(_CopiedNwarpAdjust, self)._list_outputs()
+        outputs['adjusted_warps'] = self._adjusted_warps()
+        return outputs
+
+
+def _merge_across_animals(workflow, nodes, field, name):
+    """ Adds a node merging the given field of the per-animal nodes into a
+    list.
+    """
+    merge = pe.Node(niu.Merge(len(nodes)), name=name)
+    for n, node in enumerate(nodes):
+        workflow.connect(node, field, merge, 'in{}'.format(n + 1))
+
+    return merge
+
+
+def _create_anats_to_common_workflow(
+        anat_filenames, write_dir, brain_volume, compute_mask_interface,
+        registration_kind='affine', nonlinear_levels=[1, 2, 3],
+        nonlinear_minimal_patches=[75], nonlinear_weight_file=None,
+        convergence=0.005, blur_radius_coarse=1.1, verbose=1,
+        terminal_output='stream', verbosity_kwargs={},
+        verb_quietness_kwargs={}, verbosity_quietness_kwargs={},
+        unifize_kwargs={}, brain_masking_unifize_kwargs={},
+        name='anats_to_common'):
+    """ Builds the workflow equivalent to `anats_to_common`, with one node
+    per animal and step, so that each step starts as soon as its own
+    inputs are computed.
+
+    Returns
+    -------
+    workflow : nipype.pipeline.engine.Workflow
+        The workflow, with base directory write_dir.
+
+    outputs : dict
+        Node name and output field of each registered image, transform,
+        centered head, center of mass and of the template, with keys
+        'registered', 'transforms', 'centered', 'centers' and 'template'.
+    """
+    workflow = pe.Workflow(name=name, base_dir=write_dir)
+    stems = [os.path.basename(fname_presuffix(anat_file,
+                                              suffix='_{}'.format(n),
+                                              use_ext=False))
+             for n, anat_file in enumerate(anat_filenames)]
+
+    def node(interface, step_name, n=None):
+        if n is not None:
+            step_name = '{0}_{1}'.format(step_name, n)
+        return pe.Node(interface, name=step_name)
+
+    def average(nodes, field, step_name, tcat_file):
+        merge = _merge_across_animals(workflow, nodes, field,
+                                      'merge_{}'.format(step_name))
+        tcat = node(afni.TCat(terminal_output=terminal_output,
+                              out_file=tcat_file, **verbosity_kwargs),
+                    'tcat_{}'.format(step_name))
+        tstat = node(afni.TStat(terminal_output=terminal_output,
+                                outputtype='NIFTI_GZ'),
+                     'tstat_{}'.format(step_name))
+        workflow.connect(merge, 'out', tcat, 'in_files')
+        workflow.connect(tcat, 'out_file', tstat, 'in_file')
+        return tcat, tstat
+
+    ###########################################################################
+    # Copy and average the raw images, then create an empty template with a
+    # center at the image matrix center
+    copies = []
+    for n, (anat_file, stem) in enumerate(zip(anat_filenames, stems)):
+        copies.append(node(afni.Copy(
+            terminal_output=terminal_output, in_file=anat_file,
+            out_file=os.path.basename(fname_presuffix(anat_file,
+                                                      suffix='_{}'.format(n))),
+            **verbosity_kwargs), 'copy', n))
+
+    _, tstat_raw = average(copies, 'out_file', 'raw', 'raw_heads.nii.gz')
+    undump = node(afni.Undump(terminal_output=terminal_output,
+                              out_file='undump.nii.gz',
+                              outputtype='NIFTI_GZ'), 'undump')
+    refit_center = node(afni.Refit(terminal_output=terminal_output,
+                                   xorigin='cen', yorigin='cen',
+                                   zorigin='cen'), 'refit_center')
+    workflow.connect(tstat_raw, 'out_file', undump, 'in_file')
+    workflow.connect(undump, 'out_file', refit_center, 'in_file')
+
+    ###########################################################################
+    # Bias correct, extract the brains and center them on their CoM
+    centered_brains = []
+    centered_heads = []
+    center_masses = []
+    for n, (copy, stem) in enumerate(zip(copies, stems)):
+        unifize_masking = node(afni.Unifize(
+            terminal_output=terminal_output,
+            out_file='%s_Unifized_for_brain_masking',
+            outputtype='NIFTI_GZ', **brain_masking_unifize_kwargs),
+            'unifize_for_brain_masking', n)
+        clip_level = node(afni.ClipLevel(), 'clip_level', n)
+        compute_mask = node(compute_mask_interface(
+            volume_threshold=brain_volume), 'compute_mask', n)
+        unifize = node(afni.Unifize(
+            terminal_output=terminal_output,
+            out_file='%s_Unifized_for_brain_extraction',
+            outputtype='NIFTI_GZ', **unifize_kwargs),
+            'unifize_for_brain_extraction', n)
+        calc = node(afni.Calc(terminal_output=terminal_output, expr='a*b',
+                              outputtype='NIFTI_GZ'), 'apply_mask', n)
+        center_mass = node(afni.CenterMass(
+            cm_file='{}_Unifized_for_brain_extraction_cm.txt'.format(stem),
+            set_cm=(0, 0, 0)), 'center_mass', n)
+        refit = node(afni.Refit(terminal_output=terminal_output),
+                     'refit_duporigin', n)
+        resample_brain = node(afni.Resample(terminal_output=terminal_output,
+                                            resample_mode='Cu',
+                                            outputtype='NIFTI_GZ'),
+                              'center_brain', n)
+        resample_head = node(afni.Resample(terminal_output=terminal_output,
+                                           resample_mode='Cu',
+                                           outputtype='NIFTI_GZ'),
+                             'center_head', n)
+        workflow.connect(copy, 'out_file', unifize_masking, 'in_file')
+        workflow.connect(unifize_masking, 'out_file', clip_level, 'in_file')
+        workflow.connect(unifize_masking, 'out_file', compute_mask, 'in_file')
+        workflow.connect(clip_level, ('clip_val', _to_int),
+                         compute_mask, 'intensity_threshold')
+        workflow.connect(copy, 'out_file', unifize, 'in_file')
+        workflow.connect(unifize, 'out_file', calc, 'in_file_a')
+        workflow.connect(compute_mask, 'out_file', calc, 'in_file_b')
+        workflow.connect(calc, 'out_file', center_mass, 'in_file')
+        workflow.connect(unifize, 'out_file', refit, 'in_file')
+        workflow.connect(center_mass, 'out_file', refit, 'duporigin_file')
+        workflow.connect(center_mass, 'out_file', resample_brain, 'in_file')
+        workflow.connect(refit_center, 'out_file', resample_brain, 'master')
+        workflow.connect(refit, 'out_file', resample_head, 'in_file')
+        workflow.connect(refit_center, 'out_file', resample_head, 'master')
+        centered_brains.append(resample_brain)
+        centered_heads.append(resample_head)
+        center_masses.append(center_mass)
+
+    average(centered_brains, 'out_file', 'centered_brains',
+            'centered_brains.nii.gz')
+    # as in anats_to_common, the rigid-body target is the mean centered head
+    _, tstat_centered = average(centered_heads, 'out_file', 'centered_heads',
+                                'centered_heads.nii.gz')
+
+    ###########################################################################
+    # Rigid-body registration
+    rigid_transforms = []
+    rigid_heads = []
+    rigid_brains = []
+    for n, (centered_brain, centered_head, stem) in enumerate(
+            zip(centered_brains, centered_heads, stems)):
+        shift_rotate = node(afni.Allineate(
+            terminal_output=terminal_output,
+            out_matrix='{}_shr.aff12.1D'.format(stem),
+            convergence=convergence, two_blur=blur_radius_coarse,
+            warp_type='shift_rotate', out_file='{}_brain_shr.nii.gz'.format(
+                stem), **verbosity_quietness_kwargs), 'shift_rotate', n)
+        apply_shift_rotate = node(afni.Allineate(
+            terminal_output=terminal_output,
+            out_file='{}_shr.nii.gz'.format(stem),
+            **verbosity_quietness_kwargs), 'apply_shift_rotate', n)
+        workflow.connect(centered_brain, 'out_file', shift_rotate, 'in_file')
+        workflow.connect(tstat_centered, 'out_file',
+                         shift_rotate, 'reference')
+        workflow.connect(centered_head, 'out_file',
+                         apply_shift_rotate, 'in_file')
+        workflow.connect(tstat_centered, 'out_file',
+                         apply_shift_rotate, 'master')
+        workflow.connect(shift_rotate, 'out_matrix',
+                         apply_shift_rotate, 'in_matrix')
+        rigid_transforms.append(shift_rotate)
+        rigid_heads.append(apply_shift_rotate)
+        rigid_brains.append(shift_rotate)
+
+    _, tstat_rigid_head = average(rigid_heads, 'out_file',
+                                  'rigid_body_registered_heads',
+                                  'rigid_body_registered_heads.nii.gz')
+    tcat_rigid_brains, tstat_rigid = average(
+        rigid_brains, 'out_file', 'rigid_body_registered_brains',
+        'rigid_body_registered_brains.nii.gz')
+
+    def workflow_outputs(registered, registered_field, transforms,
+                         transforms_field, template):
+        return {'registered': [(node.name, registered_field)
+                               for node in registered],
+                'transforms': [(node.name, transforms_field)
+                               for node in transforms],
+                'centered': [(node.name, 'out_file')
+                             for node in centered_heads],
+                'centers': [(node.name, 'cm') for node in center_masses],
+                'template': [(template.name, 'out_file')]}
+
+    if registration_kind == 'rigid':
+        return workflow, workflow_outputs(rigid_heads, 'out_file',
+                                          rigid_transforms, 'out_matrix',
+                                          tstat_rigid_head)
+
+    ###########################################################################
+    # Affine registration
+    count_mask = node(afni.MaskTool(count=True, verbose=verbose,
+                                    outputtype='NIFTI_GZ'), 'count_mask')
+    workflow.connect(tcat_rigid_brains, 'out_file', count_mask, 'in_file')
+    affine_transforms = []
+    affine_heads = []
+    affine_brains = []
+    for n, (rigid_head, rigid_transform, centered_brain, centered_head,
+            stem) in enumerate(zip(rigid_heads, rigid_transforms,
+                                   centered_brains, centered_heads, stems)):
+        allineate = node(afni.Allineate(
+            terminal_output=terminal_output,
+            out_matrix='{}_shr_affine.aff12.1D'.format(stem),
+            convergence=convergence, two_blur=blur_radius_coarse,
+            one_pass=True, out_file='{}_shr_affine.nii.gz'.format(stem),
+            **verbosity_quietness_kwargs), 'allineate', n)
+        merge_matrices = node(niu.Merge(2), 'merge_matrices', n)
+        catmatvec = node(afni.CatMatvec(
+            terminal_output=terminal_output,
+            out_file='{}_shr_affine_catenated.aff12.1D'.format(stem)),
+            'catmatvec', n)
+        apply_affine_brain = node(afni.Allineate(
+            terminal_output=terminal_output,
+            out_file='{}_brain_shr_affine_catenated.nii.gz'.format(stem),
+            **verbosity_quietness_kwargs), 'apply_affine_brain', n)
+        apply_affine_head = node(afni.Allineate(
+            terminal_output=terminal_output,
+            out_file='{}_shr_affine_catenated.nii.gz'.format(stem),
+            **verbosity_quietness_kwargs), 'apply_affine_head', n)
+        workflow.connect(rigid_head, 'out_file', allineate, 'in_file')
+        workflow.connect(tstat_rigid, 'out_file', allineate, 'reference')
+        workflow.connect(count_mask, 'out_file', allineate, 'weight')
+        workflow.connect(rigid_transform, 'out_matrix',
+                         merge_matrices, 'in1')
+        workflow.connect(allineate, 'out_matrix', merge_matrices, 'in2')
+        workflow.connect(merge_matrices, ('out', _to_oneline_matrices),
+                         catmatvec, 'in_file')
+        for apply_affine, centered in [(apply_affine_brain, centered_brain),
+                                       (apply_affine_head, centered_head)]:
+            workflow.connect(centered, 'out_file', apply_affine, 'in_file')
+            workflow.connect(tstat_rigid, 'out_file', apply_affine, 'master')
+            workflow.connect(catmatvec, 'out_file',
+                             apply_affine, 'in_matrix')
+        affine_transforms.append(catmatvec)
+        affine_heads.append(apply_affine_head)
+        affine_brains.append(apply_affine_brain)
+
+    _, tstat_affine_head = average(affine_heads, 'out_file',
+                                   'affine_registered_heads',
+                                   'affine_registered_heads.nii.gz')
+    average(affine_brains, 'out_file', 'affine_registered_brains',
+            'affine_registered_brains.nii.gz')
+
+    if registration_kind == 'affine':
+        return workflow, workflow_outputs(affine_heads, 'out_file',
+                                          affine_transforms, 'out_file',
+                                          tstat_affine_head)
+
+    ###########################################################################
+    # Non-linear registration
+    if nonlinear_weight_file is None:
+        union_mask = node(afni.MaskTool(
+            union=True, out_file='affine_registered_brains_unionmask.nii.gz',
+            outputtype='NIFTI_GZ', verbose=verbose), 'union_mask')
+        dilated_mask = node(afni.MaskTool(
+            dilate_inputs='4',
+            out_file='affine_registered_brains_unionmask_dil4.nii.gz',
+            outputtype='NIFTI_GZ', verbose=verbose), 'dilate_union_mask')
+        workflow.connect(tcat_rigid_brains, 'out_file', union_mask, 'in_file')
+        workflow.connect(union_mask, 'out_file', dilated_mask, 'in_file')
+        weight, weight_field = dilated_mask, 'out_file'
+    else:
+        weight, weight_field = None, nonlinear_weight_file
+
+    if nonlinear_levels is None:
+        nonlinear_levels = [1, 2, 3]
+
+    if nonlinear_minimal_patches is None:
+        nonlinear_minimal_patches = []
+
+    # Each cycle registers the centered heads to the previous template,
+    # initialized with the previous warps
+    common_head, common_head_field = tstat_affine_head, 'out_file'
+    previous_warps = affine_transforms
+    previous_warp_field = 'out_file'
+    template = None
+    cycles = [({'maxlev': maxlev}, n_lev)
+              for n_lev, maxlev in enumerate(nonlinear_levels)]
+    n_lev = max(len(nonlinear_levels) - 1, 0)
+    cycles.extend([({'minpatch': minpatch}, n_lev + n_patch)
+                   for n_patch, minpatch in enumerate(
+                       nonlinear_minimal_patches)])
+    inilev = 0
+    for n_cycle, (qwarp_kwargs, n_iter) in enumerate(cycles):
+        warps = []
+        for n, (previous_warp, centered_head, stem) in enumerate(
+                zip(previous_warps, centered_heads, stems)):
+            qwarp = node(afni.Qwarp(
+                terminal_output=terminal_output, noneg=True, iwarp=True,
+                inilev=inilev,
+                out_file='{0}_warped{1}.nii.gz'.format(stem, n_iter),
+                **dict(qwarp_kwargs, **verb_quietness_kwargs)),
+                'qwarp{}'.format(n_cycle), n)
+            if n_cycle == 0 and nonlinear_levels:
+                # Transform the affine transforms to warps
+                merge_init = node(niu.Merge(2), 'merge_iniwarp', n)
+                nwarp_cat = node(afni.NwarpCat(
+                    terminal_output=terminal_output,
+                    out_file='{}_iniwarp.nii.gz'.format(stem)), 'iniwarp', n)
+                workflow.connect(centered_head, 'out_file', merge_init, 'in1')
+                workflow.connect(previous_warp, previous_warp_field,
+                                 merge_init, 'in2')
+                workflow.connect(merge_init, ('out', _to_identity_warp_inputs),
+                                 nwarp_cat, 'in_files')
+                workflow.connect(nwarp_cat, ('out_file', _to_list),
+                                 qwarp, 'iniwarp')
+            else:
+                workflow.connect(previous_warp, (previous_warp_field,
+                                                 _to_list),
+                                 qwarp, 'iniwarp')
+            workflow.connect(centered_head, 'out_file', qwarp, 'in_file')
+            workflow.connect(common_head, common_head_field,
+                             qwarp, 'base_file')
+            if weight is None:
+                qwarp.inputs.weight = weight_field
+            else:
+                workflow.connect(weight, weight_field, qwarp, 'weight')
+            warps.append(qwarp)
+
+        if 'maxlev' in qwarp_kwargs:
+            inilev = qwarp_kwargs['maxlev'] + 1
+        else:
+            _, template = average(
+                warps, 'warped_source', 'warped{}'.format(n_cycle),
+                'warped_{0}iters_template.nii.gz'.format(n_iter))
+
+        # Average the warped images while accounting for systematic biases
+        # in the non-linear transforms. The adjusted warps initialize the
+        # next cycle.
+        merge_warps = _merge_across_animals(
+            workflow, warps, 'source_warp', 'merge_warps{}'.format(n_cycle))
+        merge_heads = _merge_across_animals(
+            workflow, centered_heads, 'out_file',
+            'merge_heads{}'.format(n_cycle))
+        nwarp_adjust = node(_CopiedNwarpAdjust(
+            terminal_output=terminal_output,
+            out_file='warped_{0}_adjusted_mean.nii.gz'.format(n_iter)),
+            'nwarp_adjust{}'.format(n_cycle))
+        workflow.connect(merge_warps, 'out', nwarp_adjust, 'warps')
+        workflow.connect(merge_heads, 'out', nwarp_adjust, 'in_files')
+        common_head, common_head_field = nwarp_adjust, 'out_file'
+        previous_warps = []
+        for n in range(len(warps)):
+            select_warp = node(niu.Select(index=n),
+                               'select_adjusted_warp{}'.format(n_cycle), n)
+            workflow.connect(nwarp_adjust, 'adjusted_warps',
+                             select_warp, 'inlist')
+            previous_warps.append(select_warp)
+        previous_warp_field = 'out'
+
+    if template is None:
+        template = common_head
+
+    ###########################################################################
+    # Apply the final warps to the centered heads
+    warped_heads = []
+    for n, (warp, centered_head, stem) in enumerate(
+            zip(previous_warps, centered_heads, stems)):
+        warp_apply = node(afni.NwarpApply(
+            terminal_output=terminal_output,
+            out_file='{0}affine_warp{1}_catenated.nii.gz'.format(
+                stem, len(nonlinear_levels)),
+            **verb_quietness_kwargs), 'warp_apply', n)
+        workflow.connect(centered_head, 'out_file', warp_apply, 'in_file')
+        workflow.connect(warp, previous_warp_field, warp_apply, 'warp')
+        workflow.connect(template, 'out_file', warp_apply, 'master')
+        warped_heads.append(warp_apply)
+
+    return workflow, workflow_outputs(warped_heads, 'out_file',
+                                      previous_warps, previous_warp_field,
+                                      common_head)
+
+
+def _run_workflow(workflow, outputs, plugin='MultiProc', n_jobs=1):
+    """ Runs the workflow with the given nipype plugin and returns the
+    values of the requested outputs.
+
+    Parameters
+    ----------
+    workflow : nipype.pipeline.engine.Workflow
+        The workflow to run.
+
+    outputs : dict
+        Lists of node name and output field of the requested outputs.
+
+    plugin : str, optional
+        Nipype execution plugin.
+
+    n_jobs : int, optional
+        Number of processes used by the 'MultiProc' plugin. -1 means all
+        CPUs.
+    """
+    plugin_args = {}
+    if plugin == 'MultiProc' and n_jobs != -1:
+        plugin_args['n_procs'] = n_jobs
+
+    execution_graph = workflow.run(plugin=plugin, plugin_args=plugin_args)
+    nodes = dict((node.name, node) for node in execution_graph.nodes())
+    return dict((key, [getattr(nodes[node_name].result.outputs, field)
+                       for (node_name, field) in node_outputs])
+                for key, node_outputs in outputs.items())
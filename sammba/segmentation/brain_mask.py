@@ -10,6 +10,7 @@ from nipype.utils.filemanip import fname_presuffix
 from . import interfaces
 from ..preprocessing import afni_unifize
 from ..orientation import _check_same_geometry
+from ..threads import thread_environ
 
 
 def _get_volume(mask_img):
@@ -199,7 +200,7 @@ def compute_morpho_brain_mask(head_file, brain_volume, write_dir=None,
     if interfaces.Info().version() is None:
         raise ValueError('Can not locate Rats')
 
-    environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+    environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
 
     if caching:
         memory = Memory(write_dir)
@@ -297,7 +298,7 @@ def compute_histo_brain_mask(head_file, brain_volume, write_dir=None,
     if write_dir is None:
         write_dir = os.path.dirname(head_file)
 
-    environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+    environ = thread_environ({'AFNI_DECONFLICT': 'OVERWRITE'})
     if caching:
         memory = Memory(write_dir)
         clip_level = memory.cache(afni.ClipLevel)
@@ -0,0 +1,35 @@
+from nose.tools import assert_equal
+from nilearn._utils.testing import assert_raises_regex
+from sammba import threads
+
+
+def test_thread_environ():
+    environ = {'AFNI_DECONFLICT': 'OVERWRITE'}
+    try:
+        # Nothing is set by default for a single job
+        assert_equal(threads.thread_environ(environ), environ)
+
+        threads.set_thread_budget(n_cpus=12, n_concurrent=2)
+        assert_equal(threads.get_n_threads(), 6)
+        assert_equal(threads.get_n_threads(n_jobs=4), 1)
+        assert_equal(threads.thread_environ(environ, n_jobs=3),
+                     {'AFNI_DECONFLICT': 'OVERWRITE',
+                      'OMP_NUM_THREADS': '2',
+                      'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': '2'})
+        # the given variables are kept
+        assert_equal(threads.thread_environ({'OMP_NUM_THREADS': '3'}),
+                     {'OMP_NUM_THREADS': '3',
+                      'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': '6'})
+        assert_equal(environ, {'AFNI_DECONFLICT': 'OVERWRITE'})
+        # the variables of a single program are shared by parallel workers
+        single_environ = threads.thread_environ(environ)
+        assert_equal(single_environ['OMP_NUM_THREADS'], '6')
+        assert_equal(threads.thread_environ(single_environ, n_jobs=3,
+                                            override=True),
+                     {'AFNI_DECONFLICT': 'OVERWRITE',
+                      'OMP_NUM_THREADS': '2',
+                      'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS': '2'})
+        assert_raises_regex(ValueError, 'At least one CPU',
+                            threads.set_thread_budget, n_cpus=0)
+    finally:
+        threads.set_thread_budget()
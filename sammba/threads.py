@@ -0,0 +1,80 @@
+"""
+Number of threads of the multithreaded AFNI and ANTs programs, shared
+between the jobs running at once.
+"""
+from joblib import cpu_count, effective_n_jobs
+
+
+# Environment variables read by OpenMP (AFNI) and ITK (ANTs) programs
+THREAD_VARIABLES = ['OMP_NUM_THREADS', 'ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS']
+
+_BUDGET = {'n_cpus': None, 'n_concurrent': 1}
+
+
+def set_thread_budget(n_cpus=None, n_concurrent=1):
+    """ Sets the CPUs shared by the AFNI and ANTs programs launched by
+    sammba. Each program then gets an equal share of the CPUs for the
+    number of programs running at once.
+
+    Parameters
+    ----------
+    n_cpus : int or None, optional
+        Number of CPUs available. If None, all the CPUs of the machine are
+        used.
+
+    n_concurrent : int, optional
+        Number of sammba scripts or processes running at once on the
+        machine, which share the CPUs equally.
+
+    Notes
+    -----
+    Until this is called, the programs run with their default number of
+    threads unless animals are processed in parallel.
+    """
+    if n_cpus is not None and n_cpus < 1:
+        raise ValueError('At least one CPU is required, you entered '
+                         '{}'.format(n_cpus))
+    if n_concurrent < 1:
+        raise ValueError('At least one concurrent process is required, you '
+                         'entered {}'.format(n_concurrent))
+
+    _BUDGET['n_cpus'] = n_cpus
+    _BUDGET['n_concurrent'] = n_concurrent
+
+
+def get_n_threads(n_jobs=1):
+    """ Returns the number of threads of each program when `n_jobs` of
+    them run in parallel within this process.
+    """
+    n_cpus = _BUDGET['n_cpus']
+    if n_cpus is None:
+        n_cpus = cpu_count()
+    n_programs = _BUDGET['n_concurrent'] * effective_n_jobs(n_jobs)
+    return max(1, n_cpus // n_programs)
+
+
+def thread_environ(environ=None, n_jobs=1, override=False):
+    """ Returns a copy of the environment variables of an interface, with
+    the number of threads of the programs set from the budget and the
+    number `n_jobs` of programs running in parallel within this process.
+    Variables already in `environ` are kept, unless `override` is True, as
+    for the workers of a function given the environment of a single
+    program. Nothing is set if the budget was never set and the programs do
+    not run in parallel.
+    """
+    if environ is None:
+        environ = {}
+    else:
+        environ = dict(environ)
+
+    if _BUDGET == {'n_cpus': None, 'n_concurrent': 1} and n_jobs == 1:
+        return environ
+
+    n_threads = str(get_n_threads(n_jobs))
+    for variable in THREAD_VARIABLES:
+        if override:
+            environ[variable] = n_threads
+        else:
+            environ.setdefault(variable, n_threads)
+
+    return environ
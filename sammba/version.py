@@ -45,6 +45,10 @@ REQUIRED_MODULE_METADATA = (
         'min_version': '0.18.0',
         'required_at_installation': True,
         'install_info': _SAMMBA_INSTALL_MSG}),
+    ('joblib', {
+        'min_version': '0.12',
+        'required_at_installation': True,
+        'install_info': _SAMMBA_INSTALL_MSG}),
     ('nipype', {
         'min_version': '1.0.4',
         'required_at_installation': True,